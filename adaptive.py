@@ -0,0 +1,255 @@
+"""Adapts the JPEG quality, resolution and frame rate of camstream.CamStream
+to what the link to the bastion can carry, so as to hold a target end to end
+latency.
+
+StreamAdapter watches how long each frame message takes to write and how many
+bytes are still queued in the socket's send buffer, and estimates from these
+the link's throughput and the latency a frame sees. When that is above the
+target it steps down LEVELS, and after the latency has stayed well under the
+target for a while it tries the level above again. A step up that has to be
+undone right away makes it wait twice as long before the next try.
+
+AdaptiveSender sends the frame messages of camstream's protocol, skipping
+frames beyond the level's frame rate or while the link is still clearing a
+backlog, and sends an adaptation message after every change of level.
+
+write_frame sends one frame message, split in fragments so that control
+messages can go out between them; camstream uses it for every format.
+"""
+import time
+import fcntl
+import struct
+import termios
+import collections
+
+
+# (resolution, JPEG quality, frames per second), best first.
+LEVELS = [
+    ((640, 480), 85, 30),
+    ((640, 480), 60, 30),
+    ((640, 480), 40, 20),
+    ((480, 360), 40, 20),
+    ((320, 240), 40, 15),
+    ((320, 240), 20, 10),
+    ((160, 120), 20, 5),
+]
+
+# flags, timestamp, width, height, quality, fps, level, latency (ms),
+# throughput (bytes/s); see camstream.py.
+ADAPT_FORMAT = "<BdHHBBBff"
+ADAPT_FLAGS = 0x03
+
+# flags, timestamp, size; see camstream.py.
+FRAME_FORMAT = "<BdL"
+FRAME_MORE = 0x08 # more fragments of the frame follow
+
+
+def write_frame(connection, lock, flags, timestamp, data, chunk_size=0):
+    """Send `data` as a frame message with `flags` on `connection`, in
+    fragments of at most `chunk_size` bytes (in one piece if 0). `lock` is
+    only held for one fragment at a time, so other writers get in between.
+    Returns the number of bytes sent, headers included."""
+    view = memoryview(data)
+    size = len(view)
+    if not chunk_size or size <= chunk_size:
+        with lock:
+            connection.send(struct.pack(FRAME_FORMAT, flags, timestamp, size),
+                            data)
+        return struct.calcsize(FRAME_FORMAT) + size
+    for start in xrange(0, size, chunk_size):
+        chunk = view[start:start + chunk_size]
+        more = FRAME_MORE if start + chunk_size < size else 0
+        header = struct.pack(FRAME_FORMAT, flags | more, timestamp, len(chunk))
+        with lock:
+            connection.send(header, chunk)
+    nb_chunks = (size + chunk_size - 1) // chunk_size
+    return nb_chunks * struct.calcsize(FRAME_FORMAT) + size
+
+
+def socket_backlog(sock):
+    """Bytes written to `sock` that the peer has not acknowledged yet, or None
+    where the platform cannot tell."""
+    try:
+        buf = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0" * 4)
+    except (IOError, AttributeError):
+        return None
+    return struct.unpack("i", buf)[0]
+
+
+class StreamAdapter(object):
+    """Picks the level of LEVELS to stream at.
+
+    Args:
+        target_latency
+            Seconds from capture to delivery to aim for.
+        levels
+            (resolution, quality, fps) settings, best first.
+        window
+            Seconds over which throughput is measured.
+        hold
+            Seconds to wait after a change of level before another, for its
+            effect to show.
+        probe_interval
+            Seconds the latency must stay under half the target before trying
+            the level above. Doubles, up to `max_probe_interval`, every time
+            such a try fails.
+    """
+
+    def __init__(self, target_latency=0.2, levels=LEVELS, level=0, window=1.,
+                 hold=0.5, probe_interval=4., max_probe_interval=60.):
+        self.target_latency = target_latency
+        self.levels = levels
+        self.level = level
+        self.window = window
+        self.hold = hold
+        self.base_probe_interval = probe_interval
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+        self.latency = 0.
+        self.throughput = None # bytes/s delivered
+        self._written = 0
+        self._delivered = collections.deque() # (time, bytes delivered so far)
+        self._next_due = None
+        self._last_change = None
+        self._good_since = None
+        self._probing = False
+
+    @property
+    def settings(self):
+        """(resolution, quality, fps) of the current level."""
+        return self.levels[self.level]
+
+    def want_frame(self, now, backlog=None):
+        """Whether to send a frame captured at `now`, given `backlog` bytes
+        still queued: not more often than the level's fps, nor while the
+        backlog alone would take longer than the target latency to clear."""
+        if backlog and self.throughput is not None:
+            if backlog > self.target_latency * self.throughput:
+                return False
+        interval = 1. / self.settings[2]
+        if self._next_due is not None and now < self._next_due:
+            return False
+        if self._next_due is None or now - self._next_due > interval:
+            self._next_due = now
+        self._next_due += interval
+        return True
+
+    def sent(self, nbytes, start, end, backlog=None):
+        """Record that writing `nbytes` started at `start` and returned at
+        `end`, leaving `backlog` bytes queued (None if unknown)."""
+        self._written += nbytes
+        delivered = self._written - (backlog or 0)
+        samples = self._delivered
+        samples.append((end, delivered))
+        while len(samples) > 2 and samples[1][0] <= end - self.window:
+            samples.popleft()
+        first_time, first_delivered = samples[0]
+        if end > first_time:
+            self.throughput = (delivered - first_delivered) / (end - first_time)
+
+        queued = 0.
+        if backlog and self.throughput is not None:
+            queued = backlog / max(self.throughput, 1.)
+        self.latency = (end - start) + queued
+
+    def decide(self, now):
+        """Change level if the latency calls for it. Returns whether the level
+        changed."""
+        if self._last_change is not None and now - self._last_change < self.hold:
+            return False
+        if self.latency > self.target_latency:
+            self._good_since = None
+            if self.level + 1 >= len(self.levels):
+                return False
+            if self._probing:
+                self.probe_interval = min(2 * self.probe_interval,
+                                          self.max_probe_interval)
+            self._set_level(self.level + 1, now)
+            self._probing = False
+            return True
+
+        if self.latency >= self.target_latency / 2:
+            self._good_since = None
+            return False
+        if self._probing and now - self._last_change >= self.probe_interval:
+            # The last step up held.
+            self._probing = False
+            self.probe_interval = self.base_probe_interval
+        if self._good_since is None:
+            self._good_since = now
+        if self.level > 0 and now - self._good_since >= self.probe_interval:
+            self._set_level(self.level - 1, now)
+            self._probing = True
+            return True
+        return False
+
+    def _set_level(self, level, now):
+        self.level = level
+        self._last_change = now
+        self._good_since = None
+        self._next_due = None
+
+    def message(self, timestamp):
+        """Adaptation message announcing the current level."""
+        (width, height), quality, fps = self.settings
+        return struct.pack(ADAPT_FORMAT, ADAPT_FLAGS, timestamp, width, height,
+                           quality, fps, self.level, 1000. * self.latency,
+                           self.throughput or 0.)
+
+
+class AdaptiveSender(object):
+    """Sends JPEG frame messages on `connection`, a network.FramedWriter, as
+    StreamAdapter `adapter` sees fit.
+
+    Args:
+        connection
+            Where to send, with send(header, payload) and write().
+        lock
+            A threading.Lock held around every write to `connection`.
+        backlog
+            Function returning the bytes queued on the connection's socket, or
+            None; usually socket_backlog bound to the socket.
+        clock
+            Function returning the current time.
+        chunk_size
+            Largest frame fragment to send; see write_frame.
+    """
+
+    def __init__(self, connection, lock, backlog, adapter=None,
+                 clock=time.time, chunk_size=0):
+        self.connection = connection
+        self.lock = lock
+        self.backlog = backlog
+        self.adapter = adapter if adapter is not None else StreamAdapter()
+        self.clock = clock
+        self.chunk_size = chunk_size
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.changes = 0
+
+    def send_frame(self, timestamp, data):
+        """Send JPEG `data` captured at `timestamp`, unless the adapter skips
+        it. Returns whether the level changed, in which case the following
+        frames should be captured with the new adapter.settings."""
+        start = self.clock()
+        if not self.adapter.want_frame(start, self.backlog()):
+            self.frames_skipped += 1
+            return False
+        nbytes = write_frame(self.connection, self.lock, 0x00, timestamp, data,
+                             self.chunk_size)
+        end = self.clock()
+        self.frames_sent += 1
+        self.adapter.sent(nbytes, start, end, self.backlog())
+        if not self.adapter.decide(end):
+            return False
+        with self.lock:
+            self.connection.write(self.adapter.message(end))
+        self.changes += 1
+        return True
+
+    def summary(self):
+        (width, height), quality, fps = self.adapter.settings
+        return ("Skipped {} frames, changed level {} times; last at {}x{}, "
+                "quality {}, {} fps, latency {:.1f}ms".format(
+                    self.frames_skipped, self.changes, width, height, quality,
+                    fps, 1000. * self.adapter.latency))
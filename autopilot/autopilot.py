@@ -5,19 +5,25 @@ import time
 import socket
 import struct
 import argparse
+import threading
 
+import numpy as np
 import picamera
 
 sys.path.append("..")
 from motion import MotionController
-from network import read_n_strict
+from network import FramedReader, FramedWriter
 
 
-def main(server):
+def main(server, latest_frame=False, framerate=None):
     client_sock = socket.socket()
     client_sock.connect(server)
-    conn = client_sock.makefile("wb")
-    motionctl = MotionController()
+    reader = FramedReader(client_sock, bufsize=256)
+    writer = FramedWriter(client_sock)
+    motionctl = MotionController(async_output=True)
+    if latest_frame:
+        return _main_latest_frame(client_sock, reader, writer, motionctl,
+                                  framerate or 10)
     total_sent = 0
     start = time.time()
     outfmt = "<BIhh"
@@ -25,7 +31,7 @@ def main(server):
     try:
         with picamera.PiCamera() as camera:
             camera.resolution = (640, 480)
-            camera.framerate = 1
+            camera.framerate = framerate or 1
             time.sleep(2)
 
             stream = io.BytesIO()
@@ -37,37 +43,146 @@ def main(server):
                                      img_size,
                                      motionctl.left_speed,
                                      motionctl.right_speed)
-                conn.write(header)
-                conn.flush()
+                writer.send(header, stream.getvalue())
                 stream.seek(0)
-                conn.write(stream.read())
-                stream.seek(0)
-                conn.flush()
                 stream.truncate()
                 
-                speed_bytes = read_n_strict(client_sock, struct.calcsize(infmt))
-                flags, lspeed, rspeed = struct.unpack(infmt, speed_bytes)
+                flags, lspeed, rspeed = reader.unpack(infmt)
                 print("Received: {}".format((flags, lspeed, rspeed)))
 
-                motionctl._update_speed(lspeed, rspeed)
+                if not flags & 0x4: # else the server could not decode it
+                    motionctl._update_speed(lspeed, rspeed)
 
                 total_sent += 1
     except KeyboardInterrupt:
         print("user exit")
     finally:
-        conn.write(struct.pack(outfmt, 0x01, 0, 0, 0))
-        read_n_strict(client_sock, struct.calcsize(infmt))
-        conn.close()
+        writer.send(struct.pack(outfmt, 0x01, 0, 0, 0))
+        reader.unpack(infmt)
         client_sock.close()
         motionctl.halt()
     end = time.time()
     print("{} cycles in {:.2f}s".format(total_sent, end-start))
 
 
+class _ReplyReceiver(object):
+    """Applies speed replies as they arrive, in the background.
+
+    Replies are tagged with the sequence number of the frame they were
+    computed from. A reply older than the last one applied is ignored, as
+    is one for a frame the server could not decode, and for every applied
+    reply the age of the frame it came from is recorded.
+    """
+
+    def __init__(self, reader, motionctl, max_pending=256):
+        self.reader = reader
+        self.motionctl = motionctl
+        self.max_pending = max_pending
+        self.ages = []
+        self.nb_stale = 0
+        self.nb_bad = 0
+        self._capture_times = {}
+        self._lock = threading.Lock()
+        self._last_seq = -1
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+    def sent(self, seq, capture_time):
+        with self._lock:
+            self._capture_times[seq] = capture_time
+            # Frames the server dropped never get a reply.
+            stale = seq - self.max_pending
+            self._capture_times.pop(stale, None)
+
+    def _run(self):
+        while True:
+            flags, lspeed, rspeed = self.reader.unpack("<Bhh")
+            if flags & 0x1:
+                break
+            seq, = self.reader.unpack("<I")
+            now = time.time()
+            with self._lock:
+                capture_time = self._capture_times.pop(seq, None)
+            if flags & 0x4:
+                self.nb_bad += 1
+                continue
+            if seq <= self._last_seq:
+                self.nb_stale += 1
+                continue
+            self._last_seq = seq
+            self.motionctl._update_speed(lspeed, rspeed)
+            if capture_time is not None:
+                age = now - capture_time
+                self.ages.append(age)
+                print("Applied: {} from frame {} ({:.0f}ms old)".format(
+                      (lspeed, rspeed), seq, age * 1000.))
+
+
+def _main_latest_frame(client_sock, reader, writer, motionctl, framerate):
+    """Stream frames without waiting for replies, applying each reply as
+    it arrives. See predictsrv.py for the latest-frame-wins protocol."""
+    outfmt = "<BIhhI"
+    receiver = _ReplyReceiver(reader, motionctl)
+    receiver.start()
+    seq = 0
+    start = time.time()
+    try:
+        with picamera.PiCamera() as camera:
+            camera.resolution = (640, 480)
+            camera.framerate = framerate
+            time.sleep(2)
+
+            stream = io.BytesIO()
+            for _ in camera.capture_continuous(stream, "jpeg",
+                                               use_video_port=True):
+                capture_time = time.time()
+                img_size = stream.tell()
+                header = struct.pack(outfmt,
+                                     0x02,
+                                     img_size,
+                                     motionctl.left_speed,
+                                     motionctl.right_speed,
+                                     seq)
+                receiver.sent(seq, capture_time)
+                writer.send(header, stream.getvalue())
+                stream.seek(0)
+                stream.truncate()
+                seq += 1
+    except KeyboardInterrupt:
+        print("user exit")
+    finally:
+        writer.send(struct.pack("<BIhh", 0x01, 0, 0, 0))
+        receiver.join()
+        client_sock.close()
+        motionctl.halt()
+    elapsed = time.time() - start
+    ages = np.array(receiver.ages) * 1000.
+    print("{} frames sent, {} commands applied in {:.2f}s "
+          "({:.1f} Hz, {} stale replies and {} bad frames ignored)".format(
+              seq, len(ages), elapsed, len(ages) / elapsed, receiver.nb_stale,
+              receiver.nb_bad))
+    if len(ages):
+        print("command age ms: mean={:.1f} p95={:.1f} max={:.1f}".format(
+              ages.mean(), np.percentile(ages, 95), ages.max()))
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("server_address",
                         help="Server address in host:port format.")
+    parser.add_argument("--latest_frame", action="store_true",
+                        help="Send frames without waiting for replies and "
+                             "apply each reply as it arrives. The server "
+                             "only predicts on the newest frame.")
+    parser.add_argument("--framerate", type=int, default=None,
+                        help="Camera frame rate. Defaults to 1, or 10 with "
+                             "--latest_frame.")
     args = parser.parse_args()
     return args
 
@@ -75,5 +190,5 @@ if __name__ == "__main__":
     args = parse_args()
     host, port = args.server_address.split(":")
     port = int(port)
-    sys.exit(main((host, port)))
+    sys.exit(main((host, port), args.latest_frame, args.framerate))
     main()
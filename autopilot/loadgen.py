@@ -0,0 +1,96 @@
+"""Fake robot load generator for predictsrv.py.
+
+Opens `--robots` connections to a running prediction server, and on each of
+them sends the same JPEG frame `--frames` times, waiting for the speed reply
+after every frame like autopilot.py does. Prints the achieved predictions per
+second and the per-frame round trip latency.
+
+    python loadgen.py 127.0.0.1:4000 --robots 4 --frames 200
+
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import socket
+import struct
+import argparse
+import threading
+from os.path import dirname, abspath
+
+import numpy as np
+
+AVETA_DIR = dirname(dirname(abspath(__file__)))
+
+sys.path.append(AVETA_DIR)
+from network import FramedReader, FramedWriter
+
+
+def fake_robot(server, img_bytes, nb_frames, latencies):
+    outfmt = "<BIhh"
+    infmt = "<Bhh"
+    sock = socket.socket()
+    sock.connect(server)
+    reader = FramedReader(sock, bufsize=256)
+    writer = FramedWriter(sock)
+    lspeed, rspeed = 0, 0
+    try:
+        for _ in xrange(nb_frames):
+            start = time.time()
+            writer.send(struct.pack(outfmt, 0x00, len(img_bytes),
+                                    lspeed, rspeed), img_bytes)
+            flags, new_lspeed, new_rspeed = reader.unpack(infmt)
+            if not flags & 0x4: # else the server could not decode it
+                lspeed, rspeed = new_lspeed, new_rspeed
+            latencies.append(time.time() - start)
+        writer.send(struct.pack(outfmt, 0x01, 0, 0, 0))
+        reader.unpack(infmt)
+    finally:
+        sock.close()
+
+
+def main(server, image, nb_robots, nb_frames):
+    with open(image, "rb") as fp:
+        img_bytes = fp.read()
+
+    latencies = [[] for _ in range(nb_robots)]
+    threads = [threading.Thread(target=fake_robot,
+                                args=(server, img_bytes, nb_frames, lat))
+               for lat in latencies]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    lat = np.array([x for l in latencies for x in l]) * 1000.
+    if not len(lat):
+        print("No frames completed.")
+        return 1
+    print("{} robots, {} frames in {:.2f}s: {:.1f} predictions/s".format(
+          nb_robots, len(lat), elapsed, len(lat) / elapsed))
+    print("latency ms: p50={:.1f} p95={:.1f} p99={:.1f} max={:.1f}".format(
+          np.percentile(lat, 50), np.percentile(lat, 95),
+          np.percentile(lat, 99), lat.max()))
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("server_address",
+                        help="Server address in host:port format.")
+    parser.add_argument("--robots", type=int, default=4,
+                        help="Number of simultaneous fake robots.")
+    parser.add_argument("--frames", type=int, default=100,
+                        help="Frames sent by each robot.")
+    parser.add_argument("--image",
+                        default=os.path.join(AVETA_DIR, "stream", "simple.jpeg"),
+                        help="JPEG file sent as every frame.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    host, port = args.server_address.split(":")
+    sys.exit(main((host, int(port)), args.image, args.robots, args.frames))
@@ -4,27 +4,49 @@
 
         [flags(1 byte)][image_size(4 bytes)][left_speed(2 bytes)][right_speed(2 bytes)][image_data]
 
+    or, when bit 1 of flags is set:
+
+        [flags(1 byte)][image_size(4 bytes)][left_speed(2 bytes)][right_speed(2 bytes)][seq(4 bytes)][image_data]
+
     Reply:
 
         [flags(1 byte)][left_speed(2 bytes)][right_speed(2 bytes)]
 
+    or, in reply to a frame with bit 1 of flags set:
+
+        [flags(1 byte)][left_speed(2 bytes)][right_speed(2 bytes)][seq(4 bytes)]
+
     Numbers are little endian encoded.
 
     flags:
         bit 0 is set to indicate quitting.
+        bit 1 is set for latest-frame-wins frames. The client does not wait
+        for a reply before sending the next frame, and the server only ever
+        predicts on the newest frame it has for a connection, dropping any
+        older one still waiting to be decoded. Replies carry the sequence
+        number of the frame they were computed from.
+        bit 2 is set in a reply to a frame that could not be decoded. There
+        is no prediction for it: the speeds are the ones the frame was sent
+        with, and the client should keep its current speeds.
 
 """
+import io
 import os
 import sys
+import time
 import socket
 import argparse
 import struct
+import threading
+import Queue
 import redis
+from itertools import izip
+import multiprocessing as mp
+from functools import partial
 from os.path import dirname, abspath
 
 import numpy as np
 from scipy.misc import imresize, imsave
-from StringIO import StringIO
 from PIL import Image
 from matplotlib import pyplot as plt
 from keras.models import load_model
@@ -32,88 +54,340 @@ from keras.models import load_model
 AVETA_DIR = dirname(dirname(abspath(__file__)))
 
 sys.path.append(AVETA_DIR)
-from network import read_n_strict
+from network import FramedReader
 
 
-def read_input_msg(stream):
-    fmt = "<BIhh"
-    sz = struct.calcsize(fmt)
-    header_bytes = read_n_strict(stream, sz)
-    flags, img_size, left_speed, right_speed = struct.unpack(fmt, header_bytes)
+def read_input_bytes(reader, copy=False):
+    """Read one request off a network.FramedReader.
+
+    Returns a (img_bytes, left_speed, right_speed, seq) tuple, where seq is
+    None unless the frame is a latest-frame-wins one. Raises StopIteration
+    when the client signals it is quitting.
+
+    img_bytes is a memoryview into the reader's buffer, only valid until the
+    next read. When `copy` is true it is instead a new bytearray that the
+    image was received straight into.
+    """
+    flags, img_size, left_speed, right_speed = reader.unpack("<BIhh")
 
     if flags & 0x1:
         raise StopIteration
 
-    img_bytes = read_n_strict(stream, img_size)
-    print("Read {} image bytes.".format(img_size))
-    fp = StringIO(img_bytes)
-    img = Image.open(fp)
-    imarr = np.array(img.getdata(), np.uint8).reshape(img.size[1], img.size[0], 3)
-    imarr = np.fliplr(np.flipud(imarr))
-    h, w, _ = imarr.shape
-    imarr = imarr[h/2:,:]
+    seq = None
+    if flags & 0x2:
+        seq, = reader.unpack("<I")
+
+    if copy:
+        img_bytes = bytearray(img_size)
+        reader.readinto(img_bytes)
+    else:
+        img_bytes = reader.read(img_size)
+    return img_bytes, left_speed, right_speed, seq
+
+
+def decode_frame(img_bytes):
+    """Decode a JPEG frame, rotate it by 180 degrees and keep the lower half.
+
+    The JPEG is decoded into a single array; the rotation and the crop are
+    views into it.
+    """
+    img = Image.open(io.BytesIO(img_bytes))
+    imarr = np.asarray(img)
+    h = imarr.shape[0]
+    return imarr[::-1, ::-1][h/2:]
+
+
+def read_input_msg(reader):
+    img_bytes, left_speed, right_speed, _ = read_input_bytes(reader)
+    print("Read {} image bytes.".format(len(img_bytes)))
+    imarr = decode_frame(img_bytes)
     print(imarr.shape)
     return imarr, left_speed, right_speed
 
 
-def main(addr, model_path, verbose, clip_bounds):
+def preprocess(imarr, rows, cols):
+    """Resize a decoded frame to the model input size, in (chan, row, col)."""
+    img = imresize(imarr, (rows, cols))
+    return np.rollaxis(img, 2, 0)
+
+
+def save_preview(img, preview_path):
+    """Save a preprocessed frame as a JPEG at `preview_path`. It is written
+    to a temporary file first and renamed over the old preview, so readers
+    never see a partial image."""
+    tmp_path = "{}.tmp.jpg".format(preview_path)
+    imsave(tmp_path, np.rollaxis(img, 0, 3))
+    os.rename(tmp_path, preview_path)
+
+
+def _decode_and_preprocess(img_bytes, rows, cols):
+    """Decode stage, run in the worker pool. Returns None for a bad frame."""
+    try:
+        return preprocess(decode_frame(img_bytes), rows, cols)
+    except Exception as e:
+        print("Bad frame: {}".format(e))
+        return None
+
+
+class _Job(object):
+    """A single frame making its way through the pipeline."""
+
+    __slots__ = ("client", "img", "lspeed", "rspeed", "seq", "received")
+
+    def __init__(self, client, img, lspeed, rspeed, seq, received):
+        self.client = client
+        self.img = img
+        self.lspeed = lspeed
+        self.rspeed = rspeed
+        self.seq = seq
+        self.received = received
+
+
+class _Client(object):
+    """Per connection state: the socket, its reply queue, the number of
+    frames still in the pipeline and, for latest-frame-wins frames, the
+    newest frame waiting for the pipeline to free up."""
+
+    def __init__(self, conn, conn_id):
+        self.conn = conn
+        self.conn_id = conn_id
+        self.redis_queue_name = "{}:q".format(conn_id)
+        self.replies = Queue.Queue()
+        self.nb_dropped = 0
+        self._in_flight = 0
+        self._latest = None
+        self._cond = threading.Condition()
+
+    def submitted(self):
+        with self._cond:
+            self._in_flight += 1
+
+    def offer_latest(self, frame):
+        """Returns True if `frame` should be submitted right away. Otherwise
+        it is held back, replacing (and dropping) any frame held before."""
+        with self._cond:
+            if not self._in_flight:
+                self._in_flight += 1
+                return True
+            if self._latest is not None:
+                self.nb_dropped += 1
+            self._latest = frame
+            return False
+
+    def reply(self, flags, lspeed, rspeed, seq=None):
+        """Queue a reply. Returns the held back latest frame, if any, which
+        the caller must submit next; it counts as already in flight."""
+        self.replies.put((flags, lspeed, rspeed, seq))
+        with self._cond:
+            frame, self._latest = self._latest, None
+            if frame is None:
+                self._in_flight -= 1
+                self._cond.notify_all()
+            return frame
+
+    def wait_idle(self):
+        with self._cond:
+            while self._in_flight:
+                self._cond.wait()
+
+    def reply_loop(self):
+        """Reply stage: write `<Bhh` responses until the final one is sent."""
+        while True:
+            flags, lspeed, rspeed, seq = self.replies.get()
+            if seq is None:
+                msg = struct.pack("<Bhh", flags, lspeed, rspeed)
+            else:
+                msg = struct.pack("<BhhI", flags | 0x2, lspeed, rspeed, seq)
+            try:
+                self.conn.sendall(msg)
+            except socket.error as e:
+                print("Connection {}: reply failed: {}".format(self.conn_id, e))
+                break
+            if flags & 0x1:
+                break
+        self.conn.close()
+
+
+class PredictionServer(object):
+    """Serve speed predictions to any number of robots at once.
+
+    Frames go through three stages:
+
+        - decode: each connection thread reads requests and hands the JPEG
+          bytes to a pool of `workers` processes, which decode and resize
+          them.
+        - batch: `serve_forever` collects every preprocessed frame that is
+          ready (up to `max_batch`, waiting at most `max_wait` seconds for
+          more once it has one) and runs a single `model.predict` on them.
+        - reply: each connection has a thread writing its `<Bhh` replies.
+
+    The model is only ever touched from the thread calling `serve_forever`.
+    """
+
+    def __init__(self, model, r, clip_bounds=None, workers=4, max_batch=16,
+                 max_wait=0.005, preview_path=None, verbose=False):
+        self.model = model
+        self.redis = r
+        if clip_bounds is not None:
+            self.clip_lo, self.clip_hi = clip_bounds
+        else:
+            self.clip_lo, self.clip_hi = -255, 255
+        _, _, self.rows, self.cols = model.layers[0].input_shape
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.preview_path = preview_path
+        self.verbose = verbose
+        self._ready = Queue.Queue()
+        self._pool = mp.Pool(workers)
+
+        self._stats_start = time.time()
+        self._nb_predicted = 0
+        self._nb_batches = 0
+        self._latencies = []
+
+    def start_accepting(self, sock):
+        t = threading.Thread(target=self._accept_loop, args=(sock,))
+        t.daemon = True
+        t.start()
+
+    def _accept_loop(self, sock):
+        conn_id = 0
+        while True:
+            conn, cli = sock.accept()
+            if self.verbose:
+                print("Connection accepted ({}, id={})".format(cli, conn_id))
+            t = threading.Thread(target=self.handle_conn, args=(conn, conn_id))
+            t.daemon = True
+            t.start()
+            conn_id += 1
+
+    def handle_conn(self, conn, conn_id):
+        client = _Client(conn, conn_id)
+        writer = threading.Thread(target=client.reply_loop)
+        writer.daemon = True
+        writer.start()
+        reader = FramedReader(conn)
+        lspeed = rspeed = 0
+        while True:
+            try:
+                img_bytes, lspeed, rspeed, seq = read_input_bytes(reader,
+                                                                  copy=True)
+            except StopIteration:
+                break
+            except Exception as e:
+                print("Connection {}: read failed: {}".format(conn_id, e))
+                break
+            frame = (img_bytes, lspeed, rspeed, seq, time.time())
+            if seq is None:
+                client.submitted()
+            elif not client.offer_latest(frame):
+                continue
+            self._submit(client, frame)
+        client.wait_idle()
+        client.replies.put((0x01, lspeed, rspeed, None))
+        if self.verbose:
+            print("Connection {} done, {} stale frames dropped".format(
+                  conn_id, client.nb_dropped))
+
+    def _submit(self, client, frame):
+        img_bytes, lspeed, rspeed, seq, received = frame
+        callback = partial(self._on_decoded, client, lspeed, rspeed, seq,
+                           received)
+        self._pool.apply_async(_decode_and_preprocess,
+                               (img_bytes, self.rows, self.cols),
+                               callback=callback)
+
+    def _reply(self, client, flags, lspeed, rspeed, seq):
+        frame = client.reply(flags, lspeed, rspeed, seq)
+        if frame is not None:
+            self._submit(client, frame)
+
+    def _on_decoded(self, client, lspeed, rspeed, seq, received, img):
+        if img is None:
+            # The client still gets a reply, as a lockstep one waits for it.
+            self._reply(client, 0x04, lspeed, rspeed, seq)
+            return
+        self._ready.put(_Job(client, img, lspeed, rspeed, seq, received))
+
+    def _next_batch(self):
+        batch = [self._ready.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self._ready.get(timeout=timeout))
+                else:
+                    batch.append(self._ready.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def serve_forever(self):
+        while True:
+            self.predict_batch(self._next_batch())
+
+    def predict_batch(self, batch):
+        X = [np.array([job.img for job in batch]),
+             np.array([[job.lspeed, job.rspeed] for job in batch])]
+        outputs = self.model.predict(X, batch_size=len(batch))
+        outputs = outputs.reshape(len(batch), 2)
+        now = time.time()
+        for job, output in izip(batch, outputs):
+            user_input = self.redis.rpop(job.client.redis_queue_name)
+            if user_input is not None:
+                assist = np.array([
+                    int(x) for x in user_input.split(",")[:2]
+                ])
+                if self.verbose:
+                    print("** User assist! {}".format(assist))
+                output = output + assist
+
+            lout, rout = np.clip(output, self.clip_lo, self.clip_hi)
+            self._reply(job.client, 0x00, round(lout), round(rout), job.seq)
+            self._latencies.append(now - job.received)
+        if self.preview_path:
+            save_preview(batch[-1].img, self.preview_path)
+        self._nb_predicted += len(batch)
+        self._nb_batches += 1
+        if self.verbose and now - self._stats_start >= 5.0:
+            self._print_stats(now)
+
+    def _print_stats(self, now):
+        elapsed = now - self._stats_start
+        lat = np.array(self._latencies) * 1000.
+        print("** {:.1f} predictions/s, mean batch {:.1f}, latency "
+              "p50={:.1f}ms p95={:.1f}ms max={:.1f}ms".format(
+                  self._nb_predicted / elapsed,
+                  self._nb_predicted / float(self._nb_batches),
+                  np.percentile(lat, 50), np.percentile(lat, 95), lat.max()))
+        self._stats_start = now
+        self._nb_predicted = 0
+        self._nb_batches = 0
+        self._latencies = []
+
+
+def main(addr, model_path, verbose, clip_bounds, workers=4, max_batch=16,
+         max_wait=0.005, preview_path=None):
     if verbose:
         print("Loading model from {}".format(model_path))
     model = load_model(model_path)
     r = redis.Redis()
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind(addr)
-    sock.listen(1)
+    sock.listen(16)
 
     if verbose:
         print("Clip bounds: {}".format(clip_bounds))
         print("Listening on {}:{}".format(*addr))
-        
-    conn_id = 0
-    while True:
-        conn, cli = sock.accept()
-        if verbose:
-            print("Connection accepted ({}, id={})".format(conn, conn_id))
-        handle_conn(conn, model, conn_id, r, clip_bounds)
-        conn_id += 1
-
-
-def handle_conn(conn, model, conn_id, r, clip_bounds=None):
-    redis_queue_name = "{}:q".format(conn_id)
-    fmt = "<Bhh"
-    _, chans, rows, cols = model.layers[0].input_shape
-    if clip_bounds is not None:
-        clip_lo, clip_hi = clip_bounds
-    else:
-        clip_lo, clip_hi = -255, 255
-    while True:
-        try:
-            img_, lspeed, rspeed = read_input_msg(conn)
-            img = np.flipud(img_)
-            img = img[len(img)/2:,:]
-            img = imresize(img_, (rows, cols))
-            imsave("/home/ys/aveta-stream.jpg", img)
-            img = np.rollaxis(img, 2, 0)
-            X = [np.array([img]), np.array([[lspeed, rspeed]])]
-
-            user_input = r.rpop(redis_queue_name)
-            output = model.predict(X).reshape(2,)
-            print("** Raw predicted speeds: {}".format(output))
-            if user_input is not None:
-                assist = np.array([
-                    int(x) for x in user_input.split(",")[:2]
-                ])
-                print("** User assist! {}".format(output))
-                output += assist
-                print("** Assisted speeds: {}".format(output))
 
-            lout, rout = np.clip(output, clip_lo, clip_hi)
-            print("** Final speeds: {}".format((lout, rout)))
-            conn.sendall(struct.pack(fmt, 0x00, round(lout), round(rout)))
-        except StopIteration:
-            break
-    conn.sendall(struct.pack(fmt, 0x01, lspeed, rspeed))
+    server = PredictionServer(model, r, clip_bounds, workers=workers,
+                              max_batch=max_batch, max_wait=max_wait,
+                              preview_path=preview_path, verbose=verbose)
+    server.start_accepting(sock)
+    server.serve_forever()
 
 
 def parse_args():
@@ -136,6 +410,21 @@ def parse_args():
                         help="A --clip_bounds A,B will clip speeds to "
                              "that range, including both endpoints.")
 
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of frame decoding processes.")
+
+    parser.add_argument("--max_batch", type=int, default=16,
+                        help="Most frames to predict on in one model call.")
+
+    parser.add_argument("--max_wait", type=float, default=0.005,
+                        help="Seconds to wait for more frames to fill a "
+                             "batch once one frame is ready.")
+
+    parser.add_argument("--preview_path", default=None,
+                        help="Where to save the latest model input, e.g. "
+                             "/home/ys/aveta-stream.jpg. Off by default, as "
+                             "it costs a JPEG encode and a write per batch.")
+
     return parser.parse_args()
 
 
@@ -157,4 +446,6 @@ if __name__ == "__main__":
         print("Error: speed bounds can only be within [-255,255]")
         sys.exit(1)
 
-    sys.exit(main((host, port), model_path, verbose, (clip_lo, clip_hi)))
+    sys.exit(main((host, port), model_path, verbose, (clip_lo, clip_hi),
+                  workers=args.workers, max_batch=args.max_batch,
+                  max_wait=args.max_wait, preview_path=args.preview_path))
@@ -1,5 +1,5 @@
-"""Module to stream JPEG encoded camera frames to a suitable server that
-understands the simple protocol.
+"""Module to stream JPEG (or H.264/MJPEG) encoded camera frames to a suitable
+server that understands the simple protocol.
 
 
 Message format
@@ -19,8 +19,24 @@ Video frame message:
         timestamp is encoded as a 64 bit (IEEE 754) representation of the fine
         timestamp given by time.time()
 
+        In the h264 and mjpeg stream formats, frame bytes are the GPU
+        encoder's output for one frame, and timestamp is the encoder's
+        presentation timestamp for it, converted to time.time() scale.
+
     flags:
         bit 0 (LSB): Always 0 to indicate this is a frame message.
+        bit 1: When set, frame bytes are H.264 (Annex B) data rather than a
+               JPEG image.
+        bit 2: When set along with bit 1, the frame is a key frame or the
+               SPS/PPS headers, i.e. a point where decoding can start.
+        bit 3: When set, this message holds a fragment of the frame, and
+               more follow: the frame bytes are the concatenated payloads
+               of the fragment messages up to the first one with bit 3
+               clear. All fragments carry the same flags (but bit 3) and
+               timestamp, and img size is the size of the fragment. Control
+               and adaptation messages may come between fragments. Only
+               sent when the server is known to reassemble fragments; see
+               `chunk_size` below.
         bit 7 (MSB): When set, signifies end of stream.
 
 
@@ -39,9 +55,30 @@ Control message:
 
     flags:
         bit 0 (LSB): Always 1 to indicate this is a control message.
+        bit 1: Always 0 in control messages; see adaptation messages.
         bit 7 (MSB): When set, signifies end of stream.
 
 
+Adaptation message (adaptive streaming only):
+
+                   |-----|---------|-----|------|-------|---|-----|-------|----------|
+
+    Represents:    |flags|timestamp|width|height|quality|fps|level|latency|throughput|
+
+    Size(bytes):      1      8        2     2       1     1    1      4        4      =24
+
+
+    Notes:
+        Sent whenever the stream changes to the given resolution, JPEG quality
+        and frame rate, i.e. `level` of adaptive.LEVELS. The frames that follow
+        use them. latency is the estimated end to end latency in ms, and
+        throughput the measured link throughput in bytes per second, that led
+        to the change, both as 32 bit floats.
+
+    flags:
+        bit 0 (LSB), bit 1: Always 1.
+
+
 Most of this was copied from 
 
     https://picamera.readthedocs.io/en/release-1.10/recipes2.html
@@ -57,6 +94,14 @@ Usage:
     # does not block -- streaming is done by a separate process.
     stream.stop()
 
+With adaptive=True, the JPEG quality, resolution and frame rate follow what
+the link can carry, to hold `target_latency`; see adaptive.py.
+
+Frames are sent whole by default. For a server that reassembles fragments
+(bit 3 of frame flags), a `chunk_size` above 0 sends them in fragments of at
+most that many bytes, so that a control message only waits for the fragment
+being written.
+
 """
 import time
 import socket
@@ -67,53 +112,209 @@ import Queue
 import picamera
 
 import io
+import threading
+import contextlib
 import constants
+from network import FramedWriter
+from adaptive import (AdaptiveSender, StreamAdapter, socket_backlog,
+                      write_frame)
+
+
+class _WriteLock(object):
+    """Lock around writes to the connection, under which a control message
+    goes before the frame fragment that is waiting for the connection: with
+    a plain lock, the frame writer would mostly take it back right after
+    releasing it, and the control message would wait for the whole frame.
 
-def _send_inputstream(queue, connection, max_time=None, debug=False):
+    `with lock:` takes it as the frame writers do, `with lock.urgent():` as
+    the control sender does.
     """
-    Writes control commands from a queue to a file like object. The file
-    like object written to is *not* closed on return.
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._held = False
+        self._urgent = 0 # urgent writers waiting
+
+    def acquire(self, urgent=False):
+        with self._cond:
+            if urgent:
+                self._urgent += 1
+                while self._held:
+                    self._cond.wait()
+                self._urgent -= 1
+            else:
+                while self._held or self._urgent:
+                    self._cond.wait()
+            self._held = True
+
+    def release(self):
+        with self._cond:
+            self._held = False
+            self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @contextlib.contextmanager
+    def urgent(self):
+        self.acquire(urgent=True)
+        try:
+            yield
+        finally:
+            self.release()
+
+class _ControlSender(object):
+    """Writes control messages from a queue to the connection as soon as
+    they arrive, on a thread of its own, so that they never wait for the
+    frame loop.
+
+    Frame writes and control writes share `lock`, and control messages take
+    it ahead of frame writers, so a control message waits at most for the
+    one frame fragment being written at that moment. The time each message
+    spent between CamStream.send_input() and the socket is recorded in
+    `delays`.
 
     Args:
         queue
             A multiprocessing.Queue object which yields (timestamp, command,
-            left_speed, right_speed) tuples.
+            left_speed, right_speed, enqueue_time) tuples, and None to stop.
         connection
-            A file like object with .write() and .flush()
-        max_time
-            A time in seconds, after which the function returns even if the
-            queue has not been emptied.
+            A file like object with .write()
+        lock
+            A _WriteLock held around every write to `connection`.
 
-    Returns:
-        If the function quit because of exceeding `max_time` in elapsed runtime.
+    """
+
+    def __init__(self, queue, connection, lock, debug=False):
+        self.queue = queue
+        self.connection = connection
+        self.lock = lock
+        self.debug = debug
+        self.delays = []
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
 
+    def stop(self):
+        """Send whatever is still queued, then stop."""
+        self.queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamp, command, left_speed, right_speed, enqueued = item
+            msg = struct.pack("<BdBhh", 0x01,
+                              timestamp,
+                              ord(command),
+                              left_speed,
+                              right_speed)
+            with self.lock.urgent():
+                self.connection.write(msg)
+            delay = time.time() - enqueued
+            self.delays.append(delay)
+            if self.debug:
+                print("Control message {} queued for {:.2f}ms.".format(
+                      command, delay * 1000.))
+
+    def summary(self):
+        if not self.delays:
+            return "Sent 0 control messages."
+        delays = sorted(self.delays)
+        n = len(delays)
+        return ("Sent {} control messages, queueing delay ms: mean={:.2f} "
+                "p95={:.2f} max={:.2f}".format(
+                    n, 1000. * sum(delays) / n,
+                    1000. * delays[min(n - 1, int(0.95 * n))],
+                    1000. * delays[-1]))
+
+class _EncoderOutput(object):
+    """picamera custom output that forwards each encoded frame to the
+    connection as a frame message.
+
+    picamera calls write() from its encoder thread with one or more buffers
+    per frame; they are collected until camera.frame says the frame is
+    complete, and then sent with the encoder's timestamp for the frame, in
+    fragments of at most `chunk_size` bytes.
     """
-    start_time = time.time()
-    while True:
-        if max_time is not None and (time.time() - start_time) > max_time:
-            if debug:
-                print("Spent more than {}s in _send_inputstream.".format(max_time))
-            return True
-        try:
-            timestamp, command, left_speed, right_speed = queue.get_nowait()
-            connection.write(
-                struct.pack("<BdBhh", 0x01,
-                            timestamp,
-                            ord(command),
-                            left_speed,
-                            right_speed)
-            )
-            connection.flush()
-        except Queue.Empty:
-            break
-
-    if debug:
-        print("Spent {} seconds in _send_inputstream.".format(time.time() - start_time))
-
-    return False
+
+    def __init__(self, camera, connection, lock, h264, chunk_size=0):
+        self.camera = camera
+        self.connection = connection
+        self.lock = lock
+        self.h264 = h264
+        self.chunk_size = chunk_size
+        self.frames_sent = 0
+        self._parts = []
+        # Encoder timestamps are microseconds on the camera's clock, which
+        # must be in "raw" mode: in the default "reset" mode, frame
+        # timestamps count from the start of recording, and camera.timestamp
+        # from the GPU's boot.
+        self._clock_offset = time.time() - camera.timestamp / 1e6
+
+    def write(self, buf):
+        self._parts.append(buf)
+        frame = self.camera.frame
+        if frame is None or not frame.complete:
+            return len(buf)
+
+        data = b"".join(self._parts)
+        self._parts = []
+        if frame.timestamp is None:
+            ts = time.time()
+        else:
+            ts = self._clock_offset + frame.timestamp / 1e6
+        flags = 0x00
+        if self.h264:
+            flags |= 0x02
+            if frame.frame_type in (picamera.PiVideoFrameType.key_frame,
+                                    picamera.PiVideoFrameType.sps_header):
+                flags |= 0x04
+        write_frame(self.connection, self.lock, flags, ts, data,
+                    self.chunk_size)
+        self.frames_sent += 1
+        return len(buf)
+
+
+def _record_encoded(camera, connection, lock, quit, stream_format, bitrate,
+                    quality, chunk_size=0):
+    """Record from the GPU encoder straight into the connection until asked
+    to quit. Returns the number of frames sent."""
+    camera.clock_mode = "raw"
+    output = _EncoderOutput(camera, connection, lock,
+                            h264=(stream_format == "h264"),
+                            chunk_size=chunk_size)
+    if stream_format == "h264":
+        camera.start_recording(output, format="h264", bitrate=bitrate,
+                               intra_period=camera.framerate,
+                               inline_headers=True)
+    else:
+        camera.start_recording(output, format="mjpeg", bitrate=bitrate,
+                               quality=quality)
+    try:
+        while True:
+            camera.wait_recording(0.1)
+            try:
+                quit.get_nowait()
+                break
+            except Queue.Empty:
+                pass
+    finally:
+        camera.stop_recording()
+    return output.frames_sent
+
 
 def _streamimages(host, port, quit, input_queue, resolution=(640, 480),
-                  framerate=30):
+                  framerate=30, stream_format="jpeg", bitrate=2000000,
+                  quality=20, adaptive=False, target_latency=0.2,
+                  chunk_size=0):
     """Stream the pi camera as fast as we can over a TCP connection using the
     simple protocol documented above.
     
@@ -126,56 +327,113 @@ def _streamimages(host, port, quit, input_queue, resolution=(640, 480),
             A multiprocessing.Queue object used to send user input.
         resolution, framerate
             picamera parameters.
+        stream_format
+            "jpeg" to capture a standalone JPEG per frame, or "h264" or
+            "mjpeg" to send the GPU encoder's output as it is produced.
+        bitrate, quality
+            Encoder parameters for the h264 and mjpeg formats.
+        adaptive, target_latency
+            With adaptive, the jpeg format is sent at the quality, resolution
+            and frame rate an adaptive.StreamAdapter picks to hold
+            `target_latency` seconds.
+        chunk_size
+            Largest frame fragment to send, in bytes, or 0 to send frames
+            whole. Only for servers that reassemble fragments.
 
     """
     client_socket = socket.socket()
     client_socket.connect((host, port))
-    connection = client_socket.makefile('wb')
+    # Control messages are tiny; don't let Nagle hold them back behind
+    # unacknowledged frame data.
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    connection = FramedWriter(client_socket)
+    lock = _WriteLock()
+    controls = _ControlSender(input_queue, connection, lock)
+    controls.start()
     to_send_before_quit = 30 # only check the quit queue every so frames.
     frames_sent = 0
+    sender = None
     try:
         with picamera.PiCamera() as camera:
             camera.resolution = resolution
             camera.framerate = framerate
             time.sleep(2)
+            if stream_format != "jpeg":
+                frames_sent = _record_encoded(camera, connection, lock, quit,
+                                              stream_format, bitrate, quality,
+                                              chunk_size)
+                controls.stop()
+                connection.write(struct.pack('<BdL', 0x80, 0x00, 0x00)) # End
+                return
             stream = io.BytesIO()
-            # Use the video-port for captures...
-            for _ in camera.capture_continuous(stream, 'jpeg',
-                                               use_video_port=True):
-                ts = time.time()
-                if frames_sent and not frames_sent % to_send_before_quit:
-                    try:
-                        quit.get_nowait()
-                        break
-                    except Queue.Empty:
-                        pass
-
-                # Trusting that user input is relatively rare, empty the input
-                # queue. The impact from this needs to be measured
-                _send_inputstream(input_queue, connection)
-
-                sz = stream.tell()
-                header = struct.pack("<BdL", 0x00, ts, sz)
-                connection.write(header)
-                connection.flush()
-                stream.seek(0)
-                connection.write(stream.read())
-                stream.seek(0)
-                stream.truncate()
-
-                frames_sent += 1
-
+            if adaptive:
+                sender = AdaptiveSender(
+                    connection, lock, lambda: socket_backlog(client_socket),
+                    StreamAdapter(target_latency), chunk_size=chunk_size)
+            captured = 0
+            done = False
+            while not done:
+                capture_args = {}
+                if sender is not None:
+                    size, jpeg_quality, _ = sender.adapter.settings
+                    capture_args = dict(quality=jpeg_quality)
+                    if size != tuple(resolution):
+                        capture_args["resize"] = size
+                # Use the video-port for captures...
+                for _ in camera.capture_continuous(stream, 'jpeg',
+                                                   use_video_port=True,
+                                                   **capture_args):
+                    ts = time.time()
+                    if captured and not captured % to_send_before_quit:
+                        try:
+                            quit.get_nowait()
+                            done = True
+                            break
+                        except Queue.Empty:
+                            pass
+                    captured += 1
+
+                    changed = False
+                    if sender is None:
+                        write_frame(connection, lock, 0x00, ts,
+                                    stream.getvalue(), chunk_size)
+                        frames_sent += 1
+                    else:
+                        changed = sender.send_frame(ts, stream.getvalue())
+                        frames_sent = sender.frames_sent
+                    stream.seek(0)
+                    stream.truncate()
+                    if changed:
+                        break # capture again with the new settings
+
+        controls.stop()
         connection.write(struct.pack('<BdL', 0x80, 0x00, 0x00)) # End
     finally:
-        connection.close()
         client_socket.close()
         print("Sent {} frames.".format(frames_sent))
+        if sender is not None:
+            print(sender.summary())
+        print(controls.summary())
 
 
 class CamStream(object):
-    def __init__(self, host=constants.BASTION_HOST, port=constants.BASTION_PORT):
+    STREAM_FORMATS = ("jpeg", "h264", "mjpeg")
+
+    def __init__(self, host=constants.BASTION_HOST, port=constants.BASTION_PORT,
+                 stream_format="jpeg", bitrate=2000000, quality=20,
+                 adaptive=False, target_latency=0.2, chunk_size=0):
+        if stream_format not in self.STREAM_FORMATS:
+            raise ValueError("Unknown stream format {}.".format(stream_format))
+        if adaptive and stream_format != "jpeg":
+            raise ValueError("Adaptive streaming needs the jpeg format.")
         self.host = host
         self.port = port
+        self.stream_format = stream_format
+        self.bitrate = bitrate
+        self.quality = quality
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.chunk_size = chunk_size
         self._proc = None
         self._quit = None
 
@@ -185,7 +443,13 @@ class CamStream(object):
         if self._proc is not None:
             raise ValueError("start() called on already started stream.")
         self._proc = mp.Process(target=_streamimages,
-                                args=(self.host, self.port, self._quit, self._input))
+                                args=(self.host, self.port, self._quit, self._input),
+                                kwargs=dict(stream_format=self.stream_format,
+                                            bitrate=self.bitrate,
+                                            quality=self.quality,
+                                            adaptive=self.adaptive,
+                                            target_latency=self.target_latency,
+                                            chunk_size=self.chunk_size))
         self._proc.start()
 
     def stop(self):
@@ -194,7 +458,8 @@ class CamStream(object):
         self._proc = None
 
     def send_input(self, timestamp, command, left_speed, right_speed):
-        self._input.put((timestamp, command, left_speed, right_speed))
+        self._input.put((timestamp, command, left_speed, right_speed,
+                         time.time()))
 
 
 if __name__ == '__main__':
@@ -26,10 +26,29 @@ def parse_args():
     parser.add_argument("--nostream",
                         action="store_true",
                         help="Turn off image streaming")
+    parser.add_argument("--stream_format",
+                        choices=camstream.CamStream.STREAM_FORMATS,
+                        default="jpeg",
+                        help="jpeg captures a JPEG per frame; h264 and mjpeg "
+                             "stream the camera's hardware encoder output.")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="adapt JPEG quality, resolution and frame rate "
+                             "to the link, to hold --target_latency. Needs "
+                             "the jpeg format.")
+    parser.add_argument("--target_latency", type=float, default=0.2,
+                        help="end to end latency in seconds that --adaptive "
+                             "aims for.")
+    parser.add_argument("--chunk_size", type=int, default=0,
+                        help="send frames in fragments of at most this many "
+                             "bytes, so that control messages can go out "
+                             "between them. Only for a server that "
+                             "reassembles fragments; 0 (the default) sends "
+                             "frames whole.")
 
     return parser.parse_args()
 
-def init(nostream):
+def init(nostream, stream_format="jpeg", adaptive=False, target_latency=0.2,
+         chunk_size=0):
     scr = curses.initscr()
 
     curses.noecho()
@@ -38,7 +57,10 @@ def init(nostream):
 
     stream = None
     if not nostream:
-        stream = camstream.CamStream()
+        stream = camstream.CamStream(stream_format=stream_format,
+                                     adaptive=adaptive,
+                                     target_latency=target_latency,
+                                     chunk_size=chunk_size)
 
     logging.debug("Initialized camstream object")
     def cleanup():
@@ -67,7 +89,8 @@ KEY_MAP = {
 }
 
 
-def main(nostream):
+def main(nostream, stream_format="jpeg", adaptive=False, target_latency=0.2,
+         chunk_size=0):
     drv = Driver()
 
     handlers = {
@@ -82,7 +105,8 @@ def main(nostream):
     drv.start_drive_mode()
     logging.debug("Put controller in drive mode.")
 
-    scr, stream = init(nostream)
+    scr, stream = init(nostream, stream_format, adaptive, target_latency,
+                       chunk_size)
     if stream is not None:
         logging.debug("Initialized streamer")
     else:
@@ -141,7 +165,9 @@ h       : Halt"""
 if __name__ == "__main__":
     args = parse_args()
     try:
-        main(nostream=args.nostream)
+        main(nostream=args.nostream, stream_format=args.stream_format,
+             adaptive=args.adaptive, target_latency=args.target_latency,
+             chunk_size=args.chunk_size)
     except Exception as e:
         logging.exception("Uncaught error")
         raise e
@@ -3,6 +3,7 @@ from __future__ import print_function
 import sys
 import os
 import Queue
+import resource
 import multiprocessing as mp
 
 AVETA_DIR = os.path.dirname(os.path.dirname(__file__))
@@ -11,93 +12,171 @@ sys.path.append(AVETA_DIR)
 import getch
 import time
 from motion import MotionController
+from shmipc import CommandRing, SeqlockSpeeds
 
 import logging
 
-def control_main(cmd_queue, speeds, damping=False):
+DAMPING_INTERVAL = 0.1 # seconds without a command before damping starts
+DAMPING_ACCEL = MotionController.STEP_SIZE / DAMPING_INTERVAL
+RAMP_REFRESH = 0.05 # how often to publish speeds while a ramp is running
+
+
+def _apply_command(ctrl, cmd):
+    """Apply a single character command. Returns a (recognized, quit) tuple."""
+    if cmd == "u":
+        ctrl.speed_ahead()
+    elif cmd == "d":
+        ctrl.speed_back()
+    elif cmd == "l":
+        ctrl.turn_left()
+    elif cmd == "r":
+        ctrl.turn_right()
+    elif cmd == "s":
+        ctrl.straighten_course()
+    elif cmd == "h":
+        ctrl.stop(wait=False)
+    elif cmd == "q":
+        ctrl.stop()
+        return True, True
+    else:
+        return False, False
+    return True, False
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _log_stats(start, cpu_start, latencies):
+    wall = time.time() - start
+    cpu = _cpu_time() - cpu_start
+    logging.info("controller: {:.1f}s CPU in {:.1f}s ({:.1f}%)".format(
+                 cpu, wall, 100. * cpu / wall if wall else 0.))
+    if latencies:
+        latencies = sorted(latencies)
+        n = len(latencies)
+        logging.info("controller: {} commands, command to motor latency ms: "
+                     "mean={:.2f} p95={:.2f} max={:.2f}".format(
+                         n, 1000. * sum(latencies) / n,
+                         1000. * latencies[min(n - 1, int(0.95 * n))],
+                         1000. * latencies[-1]))
+
+
+def control_main(cmd_ring, speeds, damping=False, acks=None):
     """The main controller process.
 
+    Sleeps on the command ring, waking up for a command, when damping is
+    due to start, or to publish speeds while a ramp runs in the background.
+    Commands pre-empt ramps in progress.
+
     Args:
-        cmd_queue: A multiprocessing.Queue that yields single character
-        commands.
+        cmd_ring: A shmipc.CommandRing that yields (command, timestamp, seq)
+        records, with single character commands and the time.time() at which
+        they were sent.
 
-        speeds: A multiprocessing.Array of two signed integers, used to fill
-        speeds.
+        speeds: A shmipc.SeqlockSpeeds, updated after every change.
 
         damping: When true, try to simulate deceleration when there is no
-        command.
+        command, by ramping speeds towards zero at DAMPING_ACCEL once
+        DAMPING_INTERVAL seconds pass without a command.
+
+        acks: An optional shmipc.CommandRing on which every command is put
+        back once applied, with the time it was applied. Its records are in
+        the order and have the seq of the commands on `cmd_ring`. Acks are
+        dropped while the ring is full, so that a reader that stopped
+        draining it cannot hold up the motors.
     """
     ctrl = MotionController(verbose=False)
     logging.debug('Done initializing motion controller')
+    start, cpu_start = time.time(), _cpu_time()
+    latencies = []
+    nb_dropped_acks = 0
     last_change = time.time()
-    speeds[:] = [ctrl.left_speed, ctrl.right_speed]
+    speeds.write(ctrl.left_speed, ctrl.right_speed)
     done = False
     while not done:
+        timeout = None
+        if ctrl.ramping():
+            timeout = RAMP_REFRESH
+        elif damping and ctrl.in_motion():
+            timeout = max(0., last_change + DAMPING_INTERVAL - time.time())
         try:
-            cmd = cmd_queue.get_nowait()
-            if cmd == "u":
-                ctrl.speed_ahead()
-            elif cmd == "d":
-                ctrl.speed_back()
-            elif cmd == "l":
-                ctrl.turn_left()
-            elif cmd == "r":
-                ctrl.turn_right()
-            elif cmd == "s":
-                ctrl.straighten_course()
-            elif cmd == "h":
-                ctrl.stop()
-            elif cmd == "q":
-                ctrl.stop()
-                done = True
-            elif damping and ctrl.in_motion():
-                logging.debug('no recognized command received, decelerating since damping is active')
-                t = time.time()
-                if t-last_change > 0.1 and ctr.in_motion():
-                    last_change = t
-                    ctrl.step_towards_zero()
-            speeds[:] = [ctrl.left_speed, ctrl.right_speed]
+            cmd, sent_at, seq = cmd_ring.get(timeout=timeout)
         except Queue.Empty:
+            cmd = None
+
+        recognized = False
+        if cmd is not None:
+            recognized, done = _apply_command(ctrl, cmd)
             t = time.time()
-            if damping and t-last_change > 0.1 and ctrl.in_motion():
+            if acks is not None:
+                try:
+                    acks.put(cmd, t, seq=seq, block=False)
+                except Queue.Full:
+                    nb_dropped_acks += 1
+            if recognized:
+                latencies.append(t - sent_at)
                 last_change = t
-                ctrl.step_towards_zero()
+            else:
+                logging.debug('unrecognized command {!r}'.format(cmd))
+
+        t = time.time()
+        if (not recognized and damping and ctrl.in_motion() and
+                not ctrl.ramping() and t - last_change >= DAMPING_INTERVAL):
+            ctrl.ramp_to(0, 0, DAMPING_ACCEL)
+        speeds.write(ctrl.left_speed, ctrl.right_speed)
+    if nb_dropped_acks:
+        logging.debug('{} acks dropped on a full ring'.format(nb_dropped_acks))
+    _log_stats(start, cpu_start, latencies)
 
 class Driver(object):
 
     def __init__(self):
         self._init = False
     
-    def start_drive_mode(self):
-        self.q = mp.Queue()
-        self.speeds = mp.Array("i", 2)
-        self.proc = mp.Process(target=control_main, args=(self.q,self.speeds))
+    def start_drive_mode(self, acks=False):
+        """With `acks`, self.acks is a CommandRing of the applied commands;
+        see control_main."""
+        self.q = CommandRing()
+        self.speeds = SeqlockSpeeds()
+        self.acks = CommandRing() if acks else None
+        self.proc = mp.Process(target=control_main,
+                               args=(self.q, self.speeds, False, self.acks))
         self.proc.start()
 
+    def _send(self, cmd):
+        self.send(cmd, time.time())
+
+    def send(self, cmd, timestamp=None):
+        """Send a single character command, as understood by control_main.
+        Returns its seq."""
+        return self.q.put(cmd, timestamp)
+
     def speed_ahead(self):
-        self.q.put("u")
+        self._send("u")
 
     def speed_back(self):
-        self.q.put("d")
+        self._send("d")
 
     def turn_left(self):
-        self.q.put("l")
+        self._send("l")
 
     def turn_right(self):
-        self.q.put("r")
+        self._send("r")
 
     def straighten_course(self):
-        self.q.put("s")
+        self._send("s")
 
     def quit(self):
-        self.q.put("q")
+        self._send("q")
         self.proc.join()
 
     def stop(self):
-        self.q.put("h")
+        self._send("h")
 
     def get_speeds(self):
-        return self.speeds[:]
+        return self.speeds.read()
 
 if __name__ == "__main__":
     drv = Driver()
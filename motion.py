@@ -1,5 +1,7 @@
+import math
+import time
 import atexit
-from itertools import izip_longest
+import threading
 from util import clamp_speed, equalize_speeds
 
 from Adafruit_MotorHAT import Adafruit_MotorHAT as MotorHAT
@@ -23,6 +25,183 @@ def turn_off_motors():
 atexit.register(turn_off_motors)
 
 
+class MotorWriter(object):
+    """Writes wheel speeds to the motors from a dedicated thread.
+
+    set_target() only records the latest (left, right) target and returns
+    immediately. The writer thread wakes up at most `max_rate` times a
+    second and writes whatever the latest target is then, so a burst of
+    targets costs a single set of I2C transactions. Writes that would not
+    change anything (same direction, same speed) are skipped.
+    """
+
+    def __init__(self, left_motor, right_motor, max_rate=50.):
+        self.left_motor = left_motor
+        self.right_motor = right_motor
+        self.period = 1. / max_rate
+        # Both motors are put in FORWARD by MotionController.__init__.
+        self._directions = [MotorHAT.FORWARD, MotorHAT.FORWARD]
+        self._speeds = [0, 0]
+        self._target = None
+        self._generation = 0
+        self._written_generation = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def set_target(self, left_speed, right_speed):
+        with self._cond:
+            self._target = (left_speed, right_speed)
+            self._generation += 1
+            self._cond.notify_all()
+
+    def flush(self):
+        """Block until the latest target has been written."""
+        with self._cond:
+            generation = self._generation
+            while self._written_generation < generation:
+                self._cond.wait()
+
+    def close(self):
+        """Write any pending target, then stop the writer thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        next_write = 0
+        while True:
+            with self._cond:
+                while self._target is None and not self._closed:
+                    self._cond.wait()
+                if self._target is None:
+                    break
+            delay = next_write - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with self._cond:
+                left_speed, right_speed = self._target
+                self._target = None
+                generation = self._generation
+            self._write(0, self.left_motor, left_speed)
+            self._write(1, self.right_motor, right_speed)
+            next_write = time.time() + self.period
+            with self._cond:
+                self._written_generation = generation
+                self._cond.notify_all()
+
+    def _write(self, idx, motor, speed):
+        if speed > 0:
+            direction = MotorHAT.FORWARD
+        elif speed < 0:
+            direction = MotorHAT.BACKWARD
+        else:
+            direction = self._directions[idx]
+        if direction != self._directions[idx]:
+            motor.setSpeed(0)
+            motor.run(direction)
+            self._directions[idx] = direction
+            self._speeds[idx] = 0
+        if abs(speed) != self._speeds[idx]:
+            motor.setSpeed(abs(speed))
+            self._speeds[idx] = abs(speed)
+
+
+def ramp_trajectory(left_speed, right_speed, target_left, target_right,
+                    max_accel, period):
+    """Plan a ramp from the current speeds to the target speeds.
+
+    Returns a list of (offset, left_speed, right_speed) points, `period`
+    seconds apart with the first one at offset 0, along which neither wheel
+    changes speed faster than `max_accel` speed units per second. Both
+    wheels reach their targets at the last point.
+    """
+    dl = target_left - left_speed
+    dr = target_right - right_speed
+    max_step = max_accel * period
+    nb_points = max(1, int(math.ceil(max(abs(dl), abs(dr)) / max_step)))
+    points = []
+    for i in range(1, nb_points + 1):
+        frac = float(i) / nb_points
+        points.append(((i - 1) * period,
+                       int(round(left_speed + dl * frac)),
+                       int(round(right_speed + dr * frac))))
+    return points
+
+
+class SpeedRamp(object):
+    """Moves a MotionController to target speeds at a bounded acceleration,
+    from a timer thread.
+
+    ramp_to() plans the whole trajectory up front and returns immediately;
+    the thread applies each point at its deadline. If the thread falls
+    behind, overdue points are skipped (and counted in `missed_deadlines`)
+    so that a ramp takes as long as the acceleration says, whatever the bus
+    speed. A new ramp_to() or cancel() pre-empts the ramp in progress.
+    """
+
+    def __init__(self, ctrl, period=0.02):
+        self.ctrl = ctrl
+        self.period = period
+        self.missed_deadlines = 0
+        self._points = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def ramp_to(self, left_speed, right_speed, max_accel):
+        with self._cond:
+            start = time.time()
+            trajectory = ramp_trajectory(self.ctrl.left_speed,
+                                         self.ctrl.right_speed,
+                                         left_speed, right_speed,
+                                         max_accel, self.period)
+            self._points = [(start + offset, l, r)
+                            for offset, l, r in trajectory]
+            self._cond.notify_all()
+
+    def cancel(self):
+        """Stop the ramp in progress. Once this returns, the ramp thread
+        will not touch the controller until the next ramp_to()."""
+        with self._cond:
+            self._points = []
+            self._cond.notify_all()
+
+    def ramping(self):
+        return bool(self._points)
+
+    def wait(self):
+        """Block until the ramp in progress is done or pre-empted."""
+        with self._cond:
+            while self._points:
+                self._cond.wait()
+
+    def _run(self):
+        with self._cond:
+            while True:
+                if not self._points:
+                    self._cond.wait()
+                    continue
+                now = time.time()
+                deadline = self._points[0][0]
+                if now < deadline:
+                    # Woken up early by ramp_to() or cancel() too.
+                    self._cond.wait(deadline - now)
+                    continue
+                due = 1
+                while due < len(self._points) and self._points[due][0] <= now:
+                    due += 1
+                self.missed_deadlines += due - 1
+                _, left_speed, right_speed = self._points[due - 1]
+                del self._points[:due]
+                self.ctrl._set_speed(left_speed, right_speed)
+                if not self._points:
+                    self._cond.notify_all()
+
 
 class MotionController(object):
 
@@ -31,7 +210,13 @@ class MotionController(object):
 
     STEP_SIZE = 3
 
-    def __init__(self, motor_hat=None, verbose=True):
+    STOP_ACCEL = 500. # speed units per second when ramping down in stop()
+
+    def __init__(self, motor_hat=None, verbose=True, async_output=False,
+                 max_write_rate=50.):
+        """When `async_output` is true, speed changes are handed to a
+        MotorWriter and written in the background at most `max_write_rate`
+        times a second, instead of synchronously on every call."""
         if motor_hat is None:
             motor_hat = MotorHAT(addr=0x60)
         self.left_motor = motor_hat.getMotor(self.LEFT_MOTOR)
@@ -44,6 +229,12 @@ class MotionController(object):
         self.left_motor.run(MotorHAT.FORWARD)
         self.right_motor.run(MotorHAT.FORWARD)
 
+        self._ramp = None
+        self._writer = None
+        if async_output:
+            self._writer = MotorWriter(self.left_motor, self.right_motor,
+                                       max_write_rate)
+
         self.verbose = verbose
 
     def speed_ahead(self, steps=1):
@@ -57,6 +248,7 @@ class MotionController(object):
 
     def step_towards_zero(self):
         """Update the speeds one step towards 0."""
+        self._cancel_ramp()
         left_step = 0 if self.left_speed == 0\
                     else -sgn(self.left_speed)
         right_step = 0 if self.right_speed == 0\
@@ -69,6 +261,7 @@ class MotionController(object):
 
 
     def _speed(self, steps):
+        self._cancel_ramp()
         new_left_speed = clamp_speed(steps * self.STEP_SIZE +
                                      self.left_speed)
         new_right_speed = clamp_speed(steps * self.STEP_SIZE +
@@ -76,33 +269,57 @@ class MotionController(object):
         self._update_speed(new_left_speed, new_right_speed)
 
     def turn_left(self):
+        self._cancel_ramp()
         new_left_speed = clamp_speed(self.left_speed - self.STEP_SIZE)
         new_right_speed = clamp_speed(self.right_speed + self.STEP_SIZE)
 
         self._update_speed(new_left_speed, new_right_speed)
 
     def turn_right(self):
+        self._cancel_ramp()
         new_left_speed = clamp_speed(self.left_speed + self.STEP_SIZE)
         new_right_speed = clamp_speed(self.right_speed - self.STEP_SIZE)
         self._update_speed(new_left_speed, new_right_speed)
 
     def straighten_course(self):
+        self._cancel_ramp()
         new_left_speed, new_right_speed = equalize_speeds(
             self.left_speed, self.right_speed
         )
         self._update_speed(new_left_speed, new_right_speed)
 
-    def stop(self):
-        speeds = izip_longest(range_incl(self.left_speed, 0, self.STEP_SIZE),
-                              range_incl(self.right_speed, 0, self.STEP_SIZE),
-                              fillvalue=0)
-        for left_speed, right_speed in speeds:
-            self._update_speed(left_speed, right_speed)
+    def stop(self, wait=True):
+        """Ramp down to a standstill at STOP_ACCEL. With wait=False, return
+        right away; any other speed change pre-empts the ramp."""
+        self.ramp_to(0, 0, self.STOP_ACCEL, wait=wait)
+
+    def ramp_to(self, left_speed, right_speed, max_accel, wait=False):
+        """Ramp to the given speeds at no more than `max_accel` speed units
+        per second, in the background unless `wait` is true."""
+        if self._ramp is None:
+            self._ramp = SpeedRamp(self)
+        self._ramp.ramp_to(left_speed, right_speed, max_accel)
+        if wait:
+            self._ramp.wait()
+
+    def ramping(self):
+        return self._ramp is not None and self._ramp.ramping()
 
     def halt(self):
         self._update_speed(0, 0)
 
+    def _cancel_ramp(self):
+        """Stop the ramp in progress, if any. Steps relative to the current
+        speeds call this before reading them, so that the ramp cannot move
+        them in between."""
+        if self._ramp is not None:
+            self._ramp.cancel()
+
     def _update_speed(self, left_speed, right_speed):
+        self._cancel_ramp()
+        self._set_speed(left_speed, right_speed)
+
+    def _set_speed(self, left_speed, right_speed):
 
         if self.verbose:
             print("updating ({}, {}). Current: ({}, {})".format(left_speed, right_speed, self.left_speed, self.right_speed))
@@ -113,6 +330,12 @@ class MotionController(object):
         if right_speed is None:
             right_speed = self.right_speed
 
+        if self._writer is not None:
+            self._writer.set_target(left_speed, right_speed)
+            self.left_speed = left_speed
+            self.right_speed = right_speed
+            return
+
         if left_speed < 0 and self.left_speed >= 0:
             self.left_motor.setSpeed(0)
             self.left_motor.run(MotorHAT.BACKWARD)
@@ -0,0 +1,101 @@
+"""Microbenchmark for the message framing in network.py.
+
+Sends `--count` header + payload messages over a loopback TCP connection for
+a few payload sizes, once with the old path (socket file writes, and
+read_n_strict for the header and the payload) and once with FramedWriter
+and FramedReader, and prints the message rate of each.
+
+    python netbench.py --count 2000
+"""
+from __future__ import print_function
+import sys
+import time
+import socket
+import struct
+import argparse
+import threading
+
+from network import read_n_strict, FramedReader, FramedWriter
+
+HEADER_FMT = "<BdL"
+
+
+def _connected_pair():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    client = socket.socket()
+    client.connect(server.getsockname())
+    conn, _ = server.accept()
+    server.close()
+    return client, conn
+
+
+def _send_old(sock, payload, count):
+    out = sock.makefile("wb")
+    for _ in xrange(count):
+        out.write(struct.pack(HEADER_FMT, 0x00, time.time(), len(payload)))
+        out.flush()
+        out.write(payload)
+        out.flush()
+    out.close()
+
+
+def _recv_old(sock, count):
+    sz = struct.calcsize(HEADER_FMT)
+    for _ in xrange(count):
+        _, _, n = struct.unpack(HEADER_FMT, read_n_strict(sock, sz))
+        read_n_strict(sock, n)
+
+
+def _send_framed(sock, payload, count):
+    writer = FramedWriter(sock)
+    for _ in xrange(count):
+        writer.send(struct.pack(HEADER_FMT, 0x00, time.time(), len(payload)),
+                    payload)
+
+
+def _recv_framed(sock, count):
+    reader = FramedReader(sock)
+    for _ in xrange(count):
+        _, _, n = reader.unpack(HEADER_FMT)
+        reader.read(n)
+
+
+def bench(sender, receiver, size, count):
+    tx, rx = _connected_pair()
+    payload = b"\xab" * size
+    t = threading.Thread(target=sender, args=(tx, payload, count))
+    start = time.time()
+    t.start()
+    receiver(rx, count)
+    elapsed = time.time() - start
+    t.join()
+    tx.close()
+    rx.close()
+    return count / elapsed
+
+
+def main(sizes, count):
+    print("{:>10} {:>14} {:>14} {:>8}".format("size", "old msg/s",
+                                              "framed msg/s", "speedup"))
+    for size in sizes:
+        old = bench(_send_old, _recv_old, size, count)
+        new = bench(_send_framed, _recv_framed, size, count)
+        print("{:>10} {:>14.0f} {:>14.0f} {:>7.2f}x".format(size, old, new,
+                                                           new / old))
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=2000,
+                        help="Messages sent per size and method.")
+    parser.add_argument("--sizes", default="64,1024,16384,65536,262144",
+                        help="Comma separated payload sizes in bytes.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(main([int(x) for x in args.sizes.split(",")], args.count))
@@ -1,3 +1,13 @@
+import sys
+import socket
+import struct
+
+
+# Linux value of MSG_MORE, which Python 2's socket module does not export.
+MSG_MORE = getattr(socket, "MSG_MORE",
+                   0x8000 if sys.platform.startswith("linux") else 0)
+
+
 def read_n_strict(stream, n):
     remaining = n
     data = []
@@ -13,3 +23,124 @@ def read_n_strict(stream, n):
 
     return ''.join(data)
 
+
+def read_into_strict(stream, buf):
+    """Fill the writable buffer `buf` from `stream` using recv_into, without
+    allocating intermediate strings."""
+    view = memoryview(buf)
+    pos = 0
+    n = len(view)
+    while pos < n:
+        nread = stream.recv_into(view[pos:])
+        if not nread:
+            raise Exception("recv returned 0 bytes")
+        pos += nread
+
+
+class FramedReader(object):
+    """Buffered reader for header + payload messages on a socket.
+
+    Data is received with recv_into, in chunks as large as the free space in
+    an internal buffer, so several small messages usually cost a single
+    syscall. `read()` hands out memoryviews into that buffer without
+    copying; a view is only valid until the next call to `read()`,
+    `unpack()` or `readinto()`. The buffer grows to fit the largest message
+    seen.
+    """
+
+    def __init__(self, sock, bufsize=1 << 16):
+        self.sock = sock
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0 # first unread byte
+        self._end = 0   # one past the last received byte
+
+    def buffered(self):
+        return self._end - self._start
+
+    def read(self, n):
+        """Return a memoryview of the next `n` bytes."""
+        if self._end - self._start < n:
+            self._fill(n)
+        view = self._view[self._start:self._start + n]
+        self._start += n
+        return view
+
+    def unpack(self, fmt):
+        """Read and unpack a struct with format `fmt`."""
+        sz = struct.calcsize(fmt)
+        if self._end - self._start < sz:
+            self._fill(sz)
+        ret = struct.unpack_from(fmt, self._buf, self._start)
+        self._start += sz
+        return ret
+
+    def readinto(self, buf):
+        """Fill `buf` with the next len(buf) bytes. Whatever is already
+        buffered is copied, and the rest is received straight into `buf`."""
+        view = memoryview(buf)
+        n = min(len(view), self._end - self._start)
+        view[:n] = self._view[self._start:self._start + n]
+        self._start += n
+        if n < len(view):
+            read_into_strict(self.sock, view[n:])
+
+    def _fill(self, n):
+        avail = self._end - self._start
+        if len(self._buf) < n:
+            # Grow to fit two messages of this size, so that compaction below
+            # happens at most once every other message. Views handed out
+            # earlier keep the old buffer alive.
+            buf = bytearray(max(2 * n, 2 * len(self._buf)))
+            buf[:avail] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+            self._start, self._end = 0, avail
+        elif self._start + n > len(self._buf):
+            # Compact what is left to the front of the buffer.
+            # memoryview assignment is a memmove.
+            self._view[:avail] = self._view[self._start:self._end]
+            self._start, self._end = 0, avail
+        elif not avail:
+            self._start = self._end = 0
+
+        while self._end - self._start < n:
+            nread = self.sock.recv_into(self._view[self._end:])
+            if not nread:
+                raise Exception("recv returned 0 bytes")
+            self._end += nread
+
+
+class FramedWriter(object):
+    """Writes header + payload messages on a socket with as few syscalls as
+    possible, and without joining the two into a new string.
+
+    Uses sendmsg where the socket has it (Python 3); otherwise the header is
+    sent with MSG_MORE so the kernel coalesces it with the payload. Also has
+    write() and flush() so it can stand in for a socket file object.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._sendmsg = getattr(sock, "sendmsg", None)
+
+    def send(self, header, payload=None):
+        if payload is None or not len(payload):
+            self.sock.sendall(header)
+            return
+        if self._sendmsg is not None:
+            sent = self._sendmsg([header, payload])
+            if sent < len(header):
+                self.sock.sendall(memoryview(header)[sent:])
+                self.sock.sendall(payload)
+            else:
+                self.sock.sendall(memoryview(payload)[sent - len(header):])
+            return
+        self.sock.sendall(header, MSG_MORE)
+        self.sock.sendall(payload)
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def flush(self):
+        pass
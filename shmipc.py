@@ -0,0 +1,116 @@
+"""Shared memory IPC between the driving front end and the controller
+process, without locks, pickling or feeder threads.
+
+CommandRing is a single-producer/single-consumer ring buffer of fixed size
+command records, and SeqlockSpeeds holds the current wheel speeds for one
+writer and any number of readers. Both must be created before forking the
+processes that use them.
+"""
+import time
+import ctypes
+import Queue
+import multiprocessing as mp
+
+
+class CommandRecord(ctypes.Structure):
+    _fields_ = [
+        ("seq", ctypes.c_uint64),
+        ("timestamp", ctypes.c_double),
+        ("code", ctypes.c_char),
+    ]
+
+
+class CommandRing(object):
+    """Single-producer/single-consumer ring of CommandRecords.
+
+    The producer owns the head index and the consumer the tail index, so
+    neither ever takes a lock. A semaphore is released once per record, so
+    that the consumer can sleep in get() until a record arrives or a timeout
+    expires; releasing and acquiring it also orders the record's stores
+    before the consumer's loads.
+    """
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self._records = mp.RawArray(CommandRecord, capacity)
+        self._head = mp.RawValue(ctypes.c_uint64, 0) # next slot to write
+        self._tail = mp.RawValue(ctypes.c_uint64, 0) # next slot to read
+        self._doorbell = mp.Semaphore(0)
+
+    def put(self, code, timestamp=None, seq=None, block=True):
+        """Append a command, with sequence number `seq` (by default its
+        position on the ring, counting from 1), and return that. Only ever
+        call this from one process. If the consumer has fallen `capacity`
+        records behind, waits for it, or raises Queue.Full unless `block`."""
+        if timestamp is None:
+            timestamp = time.time()
+        head = self._head.value
+        while head - self._tail.value >= self.capacity:
+            if not block:
+                raise Queue.Full
+            time.sleep(0.0005)
+        if seq is None:
+            seq = head + 1
+        record = self._records[head % self.capacity]
+        record.seq = seq
+        record.timestamp = timestamp
+        record.code = code
+        self._head.value = head + 1
+        self._doorbell.release()
+        return seq
+
+    def get(self, timeout=None):
+        """Return the oldest (code, timestamp, seq) record. Only ever call
+        this from one process. Blocks for at most `timeout` seconds (forever
+        if None), raising Queue.Empty if nothing arrives."""
+        if not self._doorbell.acquire(True, timeout):
+            raise Queue.Empty
+        tail = self._tail.value
+        record = self._records[tail % self.capacity]
+        ret = (record.code, record.timestamp, record.seq)
+        self._tail.value = tail + 1
+        return ret
+
+
+class _SpeedRecord(ctypes.Structure):
+    _fields_ = [
+        ("seq", ctypes.c_uint64),
+        ("left", ctypes.c_int),
+        ("right", ctypes.c_int),
+    ]
+
+
+class SeqlockSpeeds(object):
+    """A (left, right) speed pair guarded by a sequence lock.
+
+    The single writer makes the sequence number odd while it updates the
+    speeds. Readers copy the whole record with a single memmove and check
+    its sequence number against the one in shared memory afterwards: a copy
+    with an odd number, or taken while the number moved on, is retried, so
+    readers never block the writer or see a torn pair. Like CommandRing and
+    streaming.framebus, this counts on each store, a separate C call, being
+    visible to other processes in program order; the re-check is what makes
+    a copy that raced with an update harmless. Readers yield the CPU before
+    retrying, so they do not starve a writer on the same core.
+    """
+
+    def __init__(self, left=0, right=0):
+        self._data = mp.RawValue(_SpeedRecord, 0, left, right)
+
+    def write(self, left, right):
+        data = self._data
+        seq = data.seq
+        data.seq = seq + 1
+        data.left = left
+        data.right = right
+        data.seq = seq + 2
+
+    def read(self):
+        data = self._data
+        snapshot = _SpeedRecord()
+        while True:
+            ctypes.memmove(ctypes.addressof(snapshot), ctypes.addressof(data),
+                           ctypes.sizeof(snapshot))
+            if not snapshot.seq & 1 and data.seq == snapshot.seq:
+                return [snapshot.left, snapshot.right]
+            time.sleep(0)
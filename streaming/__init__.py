@@ -1,2 +1,2 @@
 from core import *
-
+from mjpeg import MJPEGHub, MIMETYPE as MJPEG_MIMETYPE
@@ -1,56 +1,189 @@
-"""Provides a simple way of accessing camera frames on the Raspberry Pi off
-a file. This is useful when multiple processes need to access the camera.
+"""Provides a simple way of accessing camera frames on the Raspberry Pi from
+any number of processes.
 
-When run as a program, this program loads plugins defined in
-streaming_plugins.py, and puts the generated images in ./stream
+When run as a program, this program publishes the camera frames on the
+"camera" frame bus (see framebus.py), which other processes read with
+FrameSubscriber("camera").next_frame(). It also runs the plugins defined in
+streaming_plugins.py.
 
 A plugin is simply an object with a `process()` method that takes an image and
-returns an image. Images are represented as numpy arrays. The output directory
-contains an image per plugin, named after the `name` property of the
-corresponding plugin object.
+returns an image. Images are represented as numpy arrays. Each plugin runs in
+a worker process of its own, on the newest camera frame whenever it is ready
+for one, at most `fps` times a second if the plugin sets it. Its output is
+published on the frame bus named after the `name` property of the plugin, and
+when given an output directory, also written there as <name>.jpeg. Capture
+never waits for plugins: a plugin that falls behind skips frames.
 
 For more control on where the images go, use the Streamer class directly.
-
 """
 from __future__ import print_function
 import os
 import sys
 import cv2
+import time
+import signal
 import tempfile
 import atexit
-import sys
+import multiprocessing as mp
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import cam
 import plugins as streaming_plugins
 import locking
+from framebus import FramePublisher, FrameSubscriber
+
+class PluginStats(object):
+    """Running statistics of a plugin worker, in shared memory. The rates and
+    times are moving averages."""
+
+    FIELDS = ("frames", "dropped", "fps", "process_ms", "latency_ms")
+
+    def __init__(self):
+        self._values = mp.RawArray("d", len(self.FIELDS))
+
+    def update(self, dropped, interval, process_time, latency):
+        """Record a processed frame. `interval` is the time since the previous
+        one, None for the first."""
+        v = self._values
+        if interval:
+            v[2] = _average(v[2], 1. / interval)
+        v[3] = _average(v[3], 1000. * process_time)
+        v[4] = _average(v[4], 1000. * latency)
+        v[0] += 1
+        v[1] += dropped
+
+    def as_dict(self):
+        return dict(zip(self.FIELDS, self._values[:]))
+
+
+def _average(average, value):
+    return value if not average else 0.9 * average + 0.1 * value
+
+
+def _run_plugin(plugin, bus_name, output_path, stats):
+    """Worker process loop: runs `plugin` on the newest frame of bus
+    `bus_name`, no more often than its `fps`, and publishes the results."""
+    # Streamer.stop_plugins() terminates us; remove our bus on the way out.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    frames = FrameSubscriber(bus_name)
+    out = None
+    min_interval = 1. / plugin.fps if plugin.fps else 0.
+    seq, last_start = 0, None
+    try:
+        while True:
+            if last_start is not None:
+                wait = last_start + min_interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            # A copy, since a slow plugin could otherwise see its frame's slot
+            # being reused under it.
+            new_seq, timestamp, frame = frames.next_frame(seq, copy=True)
+            dropped = new_seq - seq - 1 if seq else 0
+            seq = new_seq
+
+            start = time.time()
+            result = plugin.process(frame)
+            if out is None or result.shape != out.frame_shape:
+                out = FramePublisher(plugin.name, result.shape)
+            out.publish(result, timestamp)
+            if output_path is not None:
+                _write_jpeg(result, output_path)
+            done = time.time()
+
+            stats.update(dropped, start - last_start if last_start else None,
+                         done - start, done - timestamp)
+            last_start = start
+    finally:
+        if out is not None:
+            out.close()
+
+
+def _write_jpeg(frame, path):
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                     delete=False) as out:
+        ret, img = cv2.imencode(".jpeg", frame)
+        out.write(img)
+    os.rename(out.name, path)
+
 
 class Streamer(object):
-    def __init__(self, plugins, output_root="./stream"):
+    """Publishes camera frames, flipped upright, on the frame bus `bus_name`,
+    and runs `plugins` on them in worker processes. With an `output_root`,
+    plugin outputs are also written there as JPEG files.
+
+    Plugin statistics are printed every `report_interval` seconds, if given.
+    """
+
+    def __init__(self, plugins, output_root=None, bus_name="camera",
+                 nb_slots=4, report_interval=None):
         self.output_root = output_root
         self.plugins = plugins
-        self.output_paths = {
-            plugin.name: self.filename(plugin) for plugin in self.plugins
-        }
+        self.bus_name = bus_name
+        self.nb_slots = nb_slots
+        self.report_interval = report_interval
+        self.bus = None
+        self.workers = {}
+        self.plugin_stats = {}
 
     def put(self, frame):
-        frame = cv2.flip(frame, 0)
-        for plugin in self.plugins:
-            self.run_plugin(plugin, frame)
-
-    def run_plugin(self, plugin, frame):
-        with tempfile.NamedTemporaryFile(delete=False) as out:
-            ret, img = cv2.imencode(".jpeg", frame)
-            out.write(img)
-        os.rename(out.name, self.output_paths[plugin.name])
+        # The bus is created on the first frame, once the frame size is known.
+        if self.bus is None:
+            self.bus = FramePublisher(self.bus_name, frame.shape,
+                                      self.nb_slots)
+        # Flip straight into the bus slot, saving a copy.
+        cv2.flip(frame, 0, dst=self.bus.acquire())
+        self.bus.commit()
 
     def filename(self, plugin):
         return os.path.join(self.output_root, plugin.name) + ".jpeg"
 
+    def start_plugins(self):
+        for plugin in self.plugins:
+            output_path = (self.filename(plugin) if self.output_root
+                           else None)
+            stats = PluginStats()
+            proc = mp.Process(target=_run_plugin,
+                              args=(plugin, self.bus_name, output_path, stats))
+            proc.daemon = True
+            proc.start()
+            self.workers[plugin.name] = proc
+            self.plugin_stats[plugin.name] = stats
+
+    def stop_plugins(self):
+        for proc in self.workers.values():
+            proc.terminate()
+        for proc in self.workers.values():
+            proc.join()
+        self.workers = {}
+
+    def stats(self):
+        """Per plugin name, the frames processed and dropped, and the achieved
+        fps, processing time and capture to output latency."""
+        return {name: stats.as_dict()
+                for name, stats in self.plugin_stats.items()}
+
+    def report(self):
+        for name, s in sorted(self.stats().items()):
+            print("{}: {:.1f} fps, {:.1f}ms processing, {:.1f}ms latency, "
+                  "{:d} frames, {:d} dropped".format(
+                      name, s["fps"], s["process_ms"], s["latency_ms"],
+                      int(s["frames"]), int(s["dropped"])))
+
     def run(self):
-        for frame in cam.stream_camera():
-            self.put(frame)
+        self.start_plugins()
+        last_report = time.time()
+        try:
+            for frame in cam.stream_camera():
+                self.put(frame)
+                if (self.report_interval and
+                        time.time() - last_report >= self.report_interval):
+                    self.report()
+                    last_report = time.time()
+        finally:
+            self.stop_plugins()
+            if self.bus is not None:
+                self.bus.close()
 
 def start_streamer():
     lock = locking.lock("streamer")
@@ -59,7 +192,7 @@ def start_streamer():
         return
     atexit.register(lambda: locking.release(lock))
     print("Acquired lock, starting streamer.")
-    streamer = Streamer(streaming_plugins.plugins)
+    streamer = Streamer(streaming_plugins.plugins, report_interval=10)
     streamer.run()
 
 
@@ -0,0 +1,243 @@
+"""A shared memory ring of raw camera frames, for any number of local
+processes to read without copies or disk I/O.
+
+A FramePublisher owns a bus, a file in /dev/shm named after the bus that holds
+`nb_slots` frame slots. Every published frame gets the next sequence number.
+FrameSubscribers map the same file read-only, in any process, and wait for
+frames newer than the last one they saw with next_frame(). They skip straight
+to the newest frame when they fall behind.
+
+Frames are handed to subscribers as read-only views of the slots. A slot is
+reused `nb_slots` frames later, so a subscriber that holds on to a frame for
+longer must copy it, or check valid(seq) once it is done with the view.
+
+A publisher that replaces an existing bus (e.g. after a restart, or with a
+new frame size) continues its sequence numbers and marks the old file closed;
+subscribers then switch to the new file by themselves.
+"""
+import os
+import time
+import mmap
+import tempfile
+
+import numpy as np
+
+
+MAGIC = 0x31535542464e5641 # "AVNFBUS1"
+
+# Header fields, as uint64s at the start of the file.
+_MAGIC, _NB_SLOTS, _HEIGHT, _WIDTH, _CHANNELS, _HEAD, _CLOSED = range(7)
+_HEADER_WORDS = 8
+_INTERVAL_OFFSET = _HEADER_WORDS * 8 # float64 mean time between frames
+_SLOT_META_OFFSET = 128
+_ALIGN = 64
+
+
+def bus_path(name, root=None):
+    if root is None:
+        root = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(root, "aveta-framebus-" + name)
+
+
+def _layout(nb_slots, frame_shape):
+    """Returns (file size, slot data offset, bytes per slot)."""
+    slot_bytes = int(np.prod(frame_shape))
+    slot_bytes += -slot_bytes % _ALIGN
+    meta_end = _SLOT_META_OFFSET + nb_slots * 16 # seq and timestamp per slot
+    data_offset = meta_end + -meta_end % _ALIGN
+    return data_offset + nb_slots * slot_bytes, data_offset, slot_bytes
+
+
+class _Mapping(object):
+    """Numpy views of a mapped bus file."""
+
+    def __init__(self, fp, writable):
+        prot = mmap.PROT_READ | (mmap.PROT_WRITE if writable else 0)
+        fp.seek(0, os.SEEK_END)
+        self.mm = mmap.mmap(fp.fileno(), fp.tell(), mmap.MAP_SHARED, prot)
+        self.header = np.ndarray((_HEADER_WORDS,), np.uint64, self.mm)
+        self.interval = np.ndarray((1,), np.float64, self.mm,
+                                   _INTERVAL_OFFSET)
+        nb_slots = int(self.header[_NB_SLOTS])
+        shape = tuple(int(self.header[i])
+                      for i in (_HEIGHT, _WIDTH, _CHANNELS))
+        self.frame_shape = shape if shape[2] > 1 else shape[:2]
+        _, data_offset, slot_bytes = _layout(nb_slots, shape)
+        self.nb_slots = nb_slots
+        self.seqs = np.ndarray((nb_slots,), np.uint64, self.mm,
+                               _SLOT_META_OFFSET)
+        self.timestamps = np.ndarray((nb_slots,), np.float64, self.mm,
+                                     _SLOT_META_OFFSET + nb_slots * 8)
+        self.slots = [np.ndarray(self.frame_shape, np.uint8, self.mm,
+                                 data_offset + i * slot_bytes)
+                      for i in range(nb_slots)]
+
+    def close(self):
+        self.header = self.interval = self.seqs = self.timestamps = None
+        self.slots = None
+        self.mm.close()
+
+
+class FramePublisher(object):
+    """Writer side of a bus of `frame_shape` uint8 frames. Only one process
+    should publish to a given bus."""
+
+    def __init__(self, name, frame_shape, nb_slots=4, root=None):
+        self.path = bus_path(name, root)
+        self.frame_shape = tuple(frame_shape)
+        height, width = frame_shape[:2]
+        channels = frame_shape[2] if len(frame_shape) > 2 else 1
+        size, _, _ = _layout(nb_slots, (height, width, channels))
+
+        first_seq = self._close_existing()
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(fd, "w+b") as fp:
+            fp.truncate(size)
+            header = np.zeros(_HEADER_WORDS, dtype=np.uint64)
+            header[[_MAGIC, _NB_SLOTS, _HEIGHT, _WIDTH, _CHANNELS, _HEAD]] = [
+                MAGIC, nb_slots, height, width, channels, first_seq]
+            fp.write(header.tostring())
+            fp.flush()
+            self._map = _Mapping(fp, writable=True)
+        os.chmod(tmpname, 0o644)
+        os.rename(tmpname, self.path)
+        self._ino = os.stat(self.path).st_ino
+        self._last_time = None
+
+    def _close_existing(self):
+        """Mark a bus left at our path closed. Returns its last sequence
+        number, 0 if there was none."""
+        try:
+            with open(self.path, "r+b") as fp:
+                old = _Mapping(fp, writable=True)
+        except (IOError, ValueError, mmap.error):
+            return 0
+        try:
+            if old.header[_MAGIC] != MAGIC:
+                return 0
+            old.header[_CLOSED] = 1
+            return int(old.header[_HEAD])
+        finally:
+            old.close()
+
+    @property
+    def seq(self):
+        """Sequence number of the last published frame."""
+        return int(self._map.header[_HEAD])
+
+    def acquire(self):
+        """A writable view of the slot the next frame goes in. Fill it, then
+        call commit()."""
+        m = self._map
+        idx = (self.seq + 1) % m.nb_slots
+        m.seqs[idx] = 0 # invalid while being written
+        return m.slots[idx]
+
+    def commit(self, timestamp=None):
+        """Publish the frame written to the view returned by acquire().
+        Returns its sequence number."""
+        if timestamp is None:
+            timestamp = time.time()
+        m = self._map
+        seq = self.seq + 1
+        idx = seq % m.nb_slots
+        m.timestamps[idx] = timestamp
+        m.seqs[idx] = seq
+        m.header[_HEAD] = seq
+        if self._last_time is not None:
+            m.interval[0] = (0.9 * m.interval[0] +
+                             0.1 * (timestamp - self._last_time))
+        self._last_time = timestamp
+        return seq
+
+    def publish(self, frame, timestamp=None):
+        """Copy `frame` into the bus. Returns its sequence number."""
+        self.acquire()[...] = frame
+        return self.commit(timestamp)
+
+    def close(self):
+        self._map.header[_CLOSED] = 1
+        try:
+            if os.stat(self.path).st_ino == self._ino:
+                os.unlink(self.path)
+        except OSError:
+            pass
+        self._map.close()
+
+
+class FrameSubscriber(object):
+    """Reader side of a bus. Waits up to `timeout` seconds (forever if None)
+    for the bus to be created."""
+
+    POLL_INTERVAL = 0.001
+
+    def __init__(self, name, root=None, timeout=None):
+        self.path = bus_path(name, root)
+        self._map = None
+        if not self._attach(timeout):
+            raise IOError("No frame bus at {}".format(self.path))
+
+    def _attach(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                with open(self.path, "rb") as fp:
+                    m = _Mapping(fp, writable=False)
+                if m.header[_MAGIC] == MAGIC:
+                    if self._map is not None:
+                        self._map.close()
+                    self._map = m
+                    return True
+                m.close()
+            except (IOError, ValueError, mmap.error):
+                pass
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    @property
+    def frame_shape(self):
+        return self._map.frame_shape
+
+    @property
+    def seq(self):
+        """Sequence number of the newest frame."""
+        return int(self._map.header[_HEAD])
+
+    def valid(self, seq):
+        """Whether the slot of frame `seq` still holds it."""
+        m = self._map
+        return int(m.seqs[seq % m.nb_slots]) == seq
+
+    def next_frame(self, after_seq=0, timeout=None, copy=False):
+        """Wait for a frame newer than `after_seq` and return (seq, timestamp,
+        frame) for the newest one, or None after `timeout` seconds. The frame
+        is a read-only view of its slot, unless `copy` is true."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            m = self._map
+            seq = int(m.header[_HEAD])
+            if seq > after_seq:
+                idx = seq % m.nb_slots
+                timestamp = float(m.timestamps[idx])
+                frame = m.slots[idx].copy() if copy else m.slots[idx]
+                if int(m.seqs[idx]) == seq:
+                    return seq, timestamp, frame
+                continue # overwritten meanwhile; take the newer frame
+            if m.header[_CLOSED]:
+                self._attach(None if deadline is None
+                             else max(0, deadline - time.time()))
+                continue
+
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                return None
+            # Sleep until about when the next frame is due, then poll.
+            wait = float(m.timestamps[seq % m.nb_slots] + m.interval[0]) - now
+            wait = max(wait, self.POLL_INTERVAL)
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            time.sleep(wait)
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,97 @@
+"""Broadcasts the frames of a frame bus to any number of HTTP clients as an
+MJPEG (multipart/x-mixed-replace) stream.
+
+A single producer thread waits for new frames on the bus and JPEG encodes each
+one once. Clients block until a frame newer than the last one they were sent
+is there, and then get the newest one. A client that is slower than the camera
+skips frames; nothing is buffered for it.
+"""
+import threading
+
+import cv2
+
+from framebus import FrameSubscriber
+
+BOUNDARY = "frame"
+MIMETYPE = "multipart/x-mixed-replace;boundary=" + BOUNDARY
+
+
+class MJPEGHub(object):
+    """Encode-once fan-out of frame bus `bus_name`. The producer thread starts
+    with the first client, and only encodes while there are clients."""
+
+    def __init__(self, bus_name, root=None, quality=80):
+        self.bus_name = bus_name
+        self.root = root
+        self.quality = quality
+        self.seq = 0
+        self.part = None
+        self.nb_encoded = 0
+        self.nb_clients = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._produce)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _produce(self):
+        source = FrameSubscriber(self.bus_name, self.root)
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        seq = 0
+        while True:
+            with self._cond:
+                while not self.nb_clients and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    break
+            got = source.next_frame(seq, timeout=0.5)
+            if got is None:
+                continue
+            seq, _, frame = got
+            ret, data = cv2.imencode(".jpeg", frame, params)
+            # Encoded straight off the bus; drop it if its slot was reused
+            # meanwhile.
+            if not ret or not source.valid(seq):
+                continue
+            part = b"".join([
+                "--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n"
+                "X-Sequence: {}\r\n\r\n".format(BOUNDARY, data.size, seq),
+                data.tostring(), b"\r\n"])
+            with self._cond:
+                self.seq, self.part = seq, part
+                self.nb_encoded += 1
+                self._cond.notify_all()
+        source.close()
+
+    def frames(self):
+        """Generator of the multipart parts sent to one client, for use as a
+        response body."""
+        self.start()
+        with self._cond:
+            self.nb_clients += 1
+            self._cond.notify_all()
+        try:
+            seq = 0
+            while True:
+                with self._cond:
+                    while self.seq == seq and not self._stopped:
+                        self._cond.wait()
+                    if self._stopped:
+                        return
+                    seq, part = self.seq, self.part
+                yield part
+        finally:
+            with self._cond:
+                self.nb_clients -= 1
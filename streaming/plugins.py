@@ -1,6 +1,8 @@
 class Plugin(object):
     name = None
     description = None
+    # Most frames per second to process; None for every frame it can.
+    fps = None
     def process(self, frame):
         raise NotImplemented
 
@@ -0,0 +1,137 @@
+import unittest
+import sys
+import struct
+import threading
+
+sys.path.append("..")
+
+from adaptive import (AdaptiveSender, StreamAdapter, write_frame,
+                      ADAPT_FORMAT, ADAPT_FLAGS, FRAME_FORMAT, FRAME_MORE)
+from network import FramedWriter
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class ThrottledSocket(object):
+    """Stands in for a TCP socket over a link of `rate` bytes/s, with a send
+    buffer of `bufsize` bytes, on a virtual clock: sendall() advances the
+    clock for as long as it would block."""
+
+    def __init__(self, clock, rate, bufsize=1 << 16):
+        self.clock = clock
+        self.rate = rate
+        self.bufsize = bufsize
+        self.queued = 0.
+        self.adapt_messages = []
+        self._at = clock.now
+
+    def _drain(self):
+        now = self.clock.now
+        self.queued = max(0., self.queued - (now - self._at) * self.rate)
+        self._at = now
+
+    def sendall(self, data, flags=0):
+        self._drain()
+        excess = self.queued + len(data) - self.bufsize
+        if excess > 0:
+            self.clock.now += excess / self.rate
+            self._drain()
+        self.queued += len(data)
+        if (len(data) == struct.calcsize(ADAPT_FORMAT) and
+                ord(data[0]) == ADAPT_FLAGS):
+            self.adapt_messages.append(struct.unpack(ADAPT_FORMAT, data))
+
+    def backlog(self):
+        self._drain()
+        return int(self.queued)
+
+
+def _jpeg_size(resolution, quality):
+    width, height = resolution
+    return int(width * height * quality / 85. * 0.3)
+
+
+def _stream(sender, sock, clock, duration):
+    """Capture at 30 fps for `duration` seconds, like camstream's capture loop,
+    which waits for every send. Returns the latency of each frame sent."""
+    latencies = []
+    end = clock.now + duration
+    capture = clock.now
+    while capture < end:
+        clock.now = max(clock.now, capture)
+        ts = clock.now
+        resolution, quality, _ = sender.adapter.settings
+        sent = sender.frames_sent
+        sender.send_frame(ts, b"\0" * _jpeg_size(resolution, quality))
+        if sender.frames_sent > sent:
+            latencies.append(clock.now + sock.backlog() / sock.rate - ts)
+        capture += 1. / 30
+    return latencies
+
+
+class TestAdaptiveSender(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.sock = ThrottledSocket(self.clock, rate=300e3)
+        self.sender = AdaptiveSender(FramedWriter(self.sock),
+                                     threading.Lock(), self.sock.backlog,
+                                     StreamAdapter(target_latency=0.2),
+                                     clock=self.clock)
+
+    def test_holds_latency_on_slow_link(self):
+        latencies = _stream(self.sender, self.sock, self.clock, 60.)
+        settled = sorted(latencies[-100:])
+        self.assertLess(settled[len(settled) // 2], 0.2)
+        self.assertGreater(self.sender.adapter.level, 0)
+        self.assertGreater(self.sender.frames_skipped, 0)
+
+        last = self.sock.adapt_messages[-1]
+        self.assertEqual(self.sender.changes, len(self.sock.adapt_messages))
+        (width, height), quality, fps = self.sender.adapter.settings
+        self.assertEqual(last[2:7], (width, height, quality, fps,
+                                     self.sender.adapter.level))
+
+    def test_recovers_when_link_improves(self):
+        _stream(self.sender, self.sock, self.clock, 20.)
+        self.assertGreater(self.sender.adapter.level, 0)
+        self.sock.rate = 10e6
+        _stream(self.sender, self.sock, self.clock, 200.)
+        self.assertEqual(self.sender.adapter.level, 0)
+
+
+class RecordingConnection(object):
+    def __init__(self):
+        self.messages = []
+
+    def send(self, header, payload):
+        self.messages.append((struct.unpack(FRAME_FORMAT, header),
+                              memoryview(payload).tobytes()))
+
+
+class TestWriteFrame(unittest.TestCase):
+    def test_fragments(self):
+        data = b"".join(chr(i % 256) for i in range(10000))
+        connection = RecordingConnection()
+        nbytes = write_frame(connection, threading.Lock(), 0x06, 12.5, data,
+                             chunk_size=4096)
+        headers = [header for header, _ in connection.messages]
+        self.assertEqual(headers, [(0x06 | FRAME_MORE, 12.5, 4096),
+                                   (0x06 | FRAME_MORE, 12.5, 4096),
+                                   (0x06, 12.5, 10000 - 2 * 4096)])
+        self.assertEqual(b"".join(payload for _, payload in
+                                  connection.messages), data)
+        self.assertEqual(nbytes, 3 * struct.calcsize(FRAME_FORMAT) + len(data))
+
+        connection = RecordingConnection()
+        write_frame(connection, threading.Lock(), 0x00, 1., data)
+        self.assertEqual(connection.messages, [((0x00, 1., 10000), data)])
+
+
+if __name__ == "__main__":
+    unittest.main()
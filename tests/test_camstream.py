@@ -0,0 +1,156 @@
+import unittest
+import sys
+import time
+import types
+import Queue
+import struct
+import threading
+
+sys.path.append("..")
+
+try:
+    import picamera
+except ImportError:
+    # Off the Pi: camstream only needs these names from picamera here.
+    picamera = types.ModuleType("picamera")
+    picamera.PiVideoFrameType = types.ModuleType("PiVideoFrameType")
+    picamera.PiVideoFrameType.key_frame = "key_frame"
+    picamera.PiVideoFrameType.sps_header = "sps_header"
+    picamera.PiCamera = None
+    sys.modules["picamera"] = picamera
+
+import camstream
+
+
+class FakeFrame(object):
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self.complete = True
+        self.frame_type = "frame"
+
+
+class FakeCamera(object):
+    """Keeps picamera's two clocks: camera.timestamp counts from the GPU's
+    boot, an hour ago, and so do frame timestamps in "raw" clock mode; in
+    the default "reset" mode, they count from the start of recording."""
+
+    framerate = 30
+    UPTIME = 3600.
+
+    def __init__(self):
+        self.clock_mode = "reset"
+        self.frame = None
+        self._boot = time.time() - self.UPTIME
+        self._output = None
+
+    @property
+    def timestamp(self):
+        return int((time.time() - self._boot) * 1e6)
+
+    def start_recording(self, output, **kwargs):
+        self._output = output
+        self._start = time.time()
+        start = self._boot if self.clock_mode == "raw" else self._start
+        self.frame = FakeFrame(int((time.time() - start) * 1e6))
+        output.write(b"frame data")
+
+    def wait_recording(self, timeout):
+        time.sleep(timeout)
+
+    def stop_recording(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.headers = []
+
+    def send(self, header, payload=None):
+        self.headers.append(struct.unpack("<BdL", header))
+
+
+class TestEncodedStream(unittest.TestCase):
+    def test_frame_timestamps_are_wall_clock(self):
+        connection = FakeConnection()
+        quit = Queue.Queue()
+        quit.put(1)
+        before = time.time()
+        camstream._record_encoded(FakeCamera(), connection, threading.Lock(),
+                                  quit, "h264", 2000000, 20)
+        self.assertEqual(len(connection.headers), 1)
+        _, ts, size = connection.headers[0]
+        self.assertEqual(size, len(b"frame data"))
+        self.assertAlmostEqual(ts, before, delta=1.)
+
+
+class SlowSocket(object):
+    """Blocks in sendall() for as long as `rate` bytes/s takes, and keeps
+    what was sent."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.sent = []
+
+    def sendall(self, data, flags=0):
+        time.sleep(len(data) / self.rate)
+        self.sent.append(memoryview(data).tobytes())
+
+
+def _parse(stream):
+    """Frames and control commands in `stream`, reassembling fragments."""
+    frames, commands, parts = [], [], []
+    pos = 0
+    while pos < len(stream):
+        flags = ord(stream[pos])
+        if flags & 0x01:
+            _, _, cmd, _, _ = struct.unpack_from("<BdBhh", stream, pos)
+            commands.append(chr(cmd))
+            pos += struct.calcsize("<BdBhh")
+            continue
+        _, _, size = struct.unpack_from("<BdL", stream, pos)
+        pos += struct.calcsize("<BdL")
+        parts.append(stream[pos:pos + size])
+        pos += size
+        if not flags & 0x08:
+            frames.append(b"".join(parts))
+            parts = []
+    return frames, commands
+
+
+class TestControlDelay(unittest.TestCase):
+    def _stream(self, chunk_size):
+        """Send 4 frames of 0.1s each while sending a control message every
+        15ms. Returns the control delays and what the socket got."""
+        sock = SlowSocket(rate=2e6)
+        connection = camstream.FramedWriter(sock)
+        lock = camstream._WriteLock()
+        controls = camstream._ControlSender(Queue.Queue(), connection, lock)
+        controls.start()
+        frame = b"\xab" * 200000
+
+        def send_frames():
+            for _ in range(4):
+                camstream.write_frame(connection, lock, 0x00, time.time(),
+                                      frame, chunk_size)
+
+        frames = threading.Thread(target=send_frames)
+        frames.start()
+        while frames.is_alive():
+            controls.queue.put((time.time(), "u", 1, 2, time.time()))
+            time.sleep(0.015)
+        frames.join()
+        controls.stop()
+        sent_frames, commands = _parse(b"".join(sock.sent))
+        self.assertEqual(sent_frames, [frame] * 4)
+        self.assertEqual(len(commands), len(controls.delays))
+        return controls.delays
+
+    def test_fragments_let_control_messages_through(self):
+        whole = max(self._stream(chunk_size=0))
+        chunked = max(self._stream(chunk_size=8192))
+        self.assertGreater(whole, 0.05)
+        self.assertLess(chunked, 0.03)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing as mp
+
+import numpy as np
+
+sys.path.append("../streaming")
+
+from framebus import FramePublisher, FrameSubscriber
+
+
+def _read_frames(root, n, out):
+    sub = FrameSubscriber("test", root=root, timeout=5)
+    seq = 0
+    for _ in xrange(n):
+        seq, _, frame = sub.next_frame(seq, timeout=5, copy=True)
+        out.put((seq, int(frame[0, 0, 0])))
+
+
+class TestFrameBus(unittest.TestCase):
+    shape = (6, 8, 3)
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.pub = FramePublisher("test", self.shape, nb_slots=3,
+                                  root=self.root)
+
+    def tearDown(self):
+        self.pub.close()
+        shutil.rmtree(self.root)
+
+    def frame(self, value):
+        return np.full(self.shape, value, dtype=np.uint8)
+
+    def test_newest_frame(self):
+        sub = FrameSubscriber("test", root=self.root)
+        for i in range(5):
+            self.pub.publish(self.frame(i))
+        seq, _, frame = sub.next_frame(0)
+        self.assertEqual(seq, 5)
+        self.assertTrue((frame == 4).all())
+        self.assertFalse(frame.flags.writeable)
+
+    def test_timeout(self):
+        sub = FrameSubscriber("test", root=self.root)
+        self.pub.publish(self.frame(1))
+        start = time.time()
+        self.assertIsNone(sub.next_frame(1, timeout=0.05))
+        self.assertGreaterEqual(time.time() - start, 0.04)
+
+    def test_overwritten_slot(self):
+        sub = FrameSubscriber("test", root=self.root)
+        seq = self.pub.publish(self.frame(1))
+        self.assertTrue(sub.valid(seq))
+        for i in range(3):
+            self.pub.publish(self.frame(2))
+        self.assertFalse(sub.valid(seq))
+
+    def test_across_processes(self):
+        out = mp.Queue()
+        proc = mp.Process(target=_read_frames, args=(self.root, 3, out))
+        proc.start()
+        seen = []
+        value = 0
+        while len(seen) < 3:
+            value += 1
+            self.pub.publish(self.frame(value))
+            time.sleep(0.02)
+            while not out.empty():
+                seen.append(out.get())
+        proc.join()
+        for seq, value in seen:
+            self.assertEqual(seq, value)
+        self.assertEqual(sorted(seen), seen)
+
+    def test_publisher_replaced(self):
+        sub = FrameSubscriber("test", root=self.root)
+        self.pub.publish(self.frame(1))
+        old = self.pub
+        self.pub = FramePublisher("test", (2, 2), root=self.root)
+        old.close()
+        self.pub.publish(np.ones((2, 2), dtype=np.uint8))
+        seq, _, frame = sub.next_frame(1, timeout=1)
+        self.assertEqual(seq, 2)
+        self.assertEqual(frame.shape, (2, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+sys.path.append("../streaming")
+
+from framebus import FramePublisher
+from mjpeg import MJPEGHub
+
+
+def _seq(part):
+    return int(part.split("X-Sequence: ")[1].split("\r\n")[0])
+
+
+class TestMJPEGHub(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.pub = FramePublisher("test", (24, 32, 3), root=self.root)
+        self.hub = MJPEGHub("test", root=self.root)
+
+    def tearDown(self):
+        self.hub.stop()
+        self.pub.close()
+        shutil.rmtree(self.root)
+
+    def publish(self, n):
+        for _ in range(n):
+            self.pub.publish(np.zeros((24, 32, 3), dtype=np.uint8))
+            time.sleep(0.02)
+
+    def test_encode_once_fan_out(self):
+        clients = [self.hub.frames() for _ in range(10)]
+        self.pub.publish(np.zeros((24, 32, 3), dtype=np.uint8))
+        parts = [next(client) for client in clients]
+        self.assertEqual(len(set(parts)), 1)
+        self.assertTrue(parts[0].startswith("--frame\r\n"))
+        self.assertEqual(self.hub.nb_encoded, 1)
+
+    def test_slow_client_gets_newest(self):
+        client = self.hub.frames()
+        self.pub.publish(np.zeros((24, 32, 3), dtype=np.uint8))
+        self.assertEqual(_seq(next(client)), 1)
+        self.publish(5)
+        self.assertEqual(_seq(next(client)), 6)
+        client.close()
+        self.assertEqual(self.hub.nb_clients, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
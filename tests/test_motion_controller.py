@@ -1,9 +1,31 @@
 import unittest
 import sys
+import time
 
 sys.path.append("..")
 
-from motion import clamp_speed, equalize_speeds, MotionController, range_incl
+from motion import (clamp_speed, equalize_speeds, MotionController,
+                    MotorWriter, MotorHAT, range_incl, ramp_trajectory)
+
+
+class FakeMotor(object):
+    def __init__(self):
+        self.calls = []
+
+    def setSpeed(self, speed):
+        self.calls.append(("setSpeed", speed))
+
+    def run(self, direction):
+        self.calls.append(("run", direction))
+
+
+class FakeMotorHAT(object):
+    def __init__(self):
+        self.motors = {}
+
+    def getMotor(self, num):
+        return self.motors.setdefault(num, FakeMotor())
+
 
 class TestMotionController(unittest.TestCase):
     def test_clamp_speed(self):
@@ -39,6 +61,101 @@ class TestMotionController(unittest.TestCase):
         for args, expected in cases:
             self.assertEqual(list(range_incl(*args)), expected)
 
+    def test_ramp_trajectory(self):
+        self.assertEqual(ramp_trajectory(0, 0, 0, 0, 100., 0.1),
+                         [(0, 0, 0)])
+        self.assertEqual(ramp_trajectory(30, -10, 0, 0, 100., 0.1),
+                         [(0, 20, -7), (0.1, 10, -3), (0.2, 0, 0)])
+        points = ramp_trajectory(255, 100, 0, 0, 500., 0.02)
+        self.assertEqual(len(points), 26)
+        self.assertEqual(points[-1][1:], (0, 0))
+        for (_, l0, r0), (_, l1, r1) in zip(points, points[1:]):
+            self.assertLessEqual(abs(l1 - l0), 10)
+            self.assertLessEqual(abs(r1 - r0), 10)
+
+    def test_stop_ramps_in_time(self):
+        ctrl = MotionController(motor_hat=FakeMotorHAT(), verbose=False)
+        ctrl._update_speed(90, 60)
+        start = time.time()
+        ctrl.stop()
+        elapsed = time.time() - start
+        self.assertEqual((ctrl.left_speed, ctrl.right_speed), (0, 0))
+        self.assertAlmostEqual(elapsed, 90 / ctrl.STOP_ACCEL, delta=0.05)
+
+    def test_command_preempts_ramp(self):
+        ctrl = MotionController(motor_hat=FakeMotorHAT(), verbose=False)
+        ctrl._update_speed(200, 200)
+        ctrl.stop(wait=False)
+        self.assertTrue(ctrl.ramping())
+        ctrl.halt()
+        self.assertFalse(ctrl.ramping())
+        ctrl.speed_ahead()
+        time.sleep(0.1)
+        self.assertEqual((ctrl.left_speed, ctrl.right_speed), (3, 3))
+
+    def test_steps_from_speeds_after_ramp(self):
+        ctrl = MotionController(motor_hat=FakeMotorHAT(), verbose=False)
+
+        class LastPointRamp(object):
+            """Applies one more ramp point as it is cancelled, as the ramp
+            thread may just before cancel() gets its lock."""
+            def cancel(self):
+                ctrl._set_speed(50, 50)
+                ctrl._ramp = None
+
+        steps = [
+            (ctrl.turn_left, (47, 53)),
+            (ctrl.turn_right, (53, 47)),
+            (ctrl.speed_ahead, (53, 53)),
+            (ctrl.step_towards_zero, (47, 47)),
+        ]
+        for step, expected in steps:
+            ctrl._set_speed(0, 0)
+            ctrl._ramp = LastPointRamp()
+            step()
+            self.assertEqual((ctrl.left_speed, ctrl.right_speed), expected)
+
+        ctrl._set_speed(0, 0)
+        ctrl._ramp = LastPointRamp()
+        ctrl.straighten_course()
+        self.assertEqual((ctrl.left_speed, ctrl.right_speed),
+                         equalize_speeds(50, 50))
+
+
+class TestMotorWriter(unittest.TestCase):
+    def setUp(self):
+        self.left, self.right = FakeMotor(), FakeMotor()
+        self.writer = MotorWriter(self.left, self.right, max_rate=20.)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def test_coalesces_targets(self):
+        self.writer.set_target(3, 3)
+        self.writer.flush()
+        for speed in range(6, 100, 3):
+            self.writer.set_target(speed, -speed)
+        self.writer.flush()
+        self.assertEqual(self.left.calls, [("setSpeed", 3), ("setSpeed", 99)])
+        self.assertEqual(self.right.calls, [("setSpeed", 3),
+                                            ("setSpeed", 0),
+                                            ("run", MotorHAT.BACKWARD),
+                                            ("setSpeed", 99)])
+
+    def test_skips_redundant_writes(self):
+        self.writer.set_target(10, 0)
+        self.writer.flush()
+        self.writer.set_target(10, 0)
+        self.writer.flush()
+        self.writer.set_target(0, 0)
+        self.writer.flush()
+        self.writer.set_target(5, 0)
+        self.writer.flush()
+        self.assertEqual(self.left.calls, [("setSpeed", 10),
+                                           ("setSpeed", 0),
+                                           ("setSpeed", 5)])
+        self.assertEqual(self.right.calls, [])
+
 
 if __name__ == '__main__':
     unittest.main()
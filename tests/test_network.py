@@ -0,0 +1,174 @@
+import unittest
+import sys
+import struct
+
+sys.path.append("..")
+
+import network
+from network import FramedReader, FramedWriter, read_into_strict
+
+
+class TrickleSocket(object):
+    """Hands out `data` at most `chunk` bytes per recv call, then EOF."""
+
+    def __init__(self, data, chunk=3):
+        self.data = data
+        self.chunk = chunk
+        self.pos = 0
+        self.calls = 0
+
+    def recv_into(self, view):
+        self.calls += 1
+        n = min(len(view), self.chunk, len(self.data) - self.pos)
+        view[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+class SendallSocket(object):
+    """A socket without sendmsg, as in Python 2."""
+
+    def __init__(self):
+        self.calls = [] # (data, flags)
+
+    def sendall(self, data, flags=0):
+        self.calls.append((memoryview(data).tobytes(), flags))
+
+
+class SendmsgSocket(SendallSocket):
+    """A socket whose sendmsg sends the first `nsent` bytes of its buffers."""
+
+    def __init__(self, nsent):
+        SendallSocket.__init__(self)
+        self.nsent = nsent
+        self.sendmsg_calls = []
+
+    def sendmsg(self, buffers):
+        data = b"".join(memoryview(buf).tobytes() for buf in buffers)
+        self.sendmsg_calls.append(data)
+        return min(self.nsent, len(data))
+
+
+def _messages(*payloads):
+    return b"".join(struct.pack("<BdL", 0, float(i), len(payload)) + payload
+                    for i, payload in enumerate(payloads))
+
+
+class TestReadIntoStrict(unittest.TestCase):
+    def test_short_reads(self):
+        sock = TrickleSocket(b"0123456789", chunk=4)
+        buf = bytearray(10)
+        read_into_strict(sock, buf)
+        self.assertEqual(bytes(buf), b"0123456789")
+        self.assertEqual(sock.calls, 3)
+
+    def test_eof(self):
+        self.assertRaises(Exception, read_into_strict,
+                          TrickleSocket(b"0123", chunk=4), bytearray(10))
+
+
+class TestFramedReader(unittest.TestCase):
+    def test_short_reads(self):
+        sock = TrickleSocket(_messages(b"hello", b"", b"world!"), chunk=3)
+        reader = FramedReader(sock, bufsize=64)
+        for i, payload in enumerate([b"hello", b"", b"world!"]):
+            flags, ts, size = reader.unpack("<BdL")
+            self.assertEqual((flags, ts, size), (0, float(i), len(payload)))
+            self.assertEqual(reader.read(size).tobytes(), payload)
+        self.assertEqual(reader.buffered(), 0)
+
+    def test_one_recv_for_several_messages(self):
+        sock = TrickleSocket(_messages(b"a", b"b", b"c"), chunk=1 << 16)
+        reader = FramedReader(sock)
+        for _ in range(3):
+            _, _, size = reader.unpack("<BdL")
+            reader.read(size)
+        self.assertEqual(sock.calls, 1)
+
+    def test_grows_for_large_messages(self):
+        big = b"".join(chr(i % 256) for i in range(1000))
+        sock = TrickleSocket(_messages(b"small", big, b"after"), chunk=100)
+        reader = FramedReader(sock, bufsize=32)
+        payloads = []
+        for _ in range(3):
+            _, _, size = reader.unpack("<BdL")
+            payloads.append(reader.read(size).tobytes())
+        self.assertEqual(payloads, [b"small", big, b"after"])
+        self.assertGreaterEqual(len(reader._buf), 2 * len(big))
+
+    def test_compacts_near_end_of_buffer(self):
+        payloads = [b"x" * 20, b"y" * 20, b"z" * 20]
+        reader = FramedReader(TrickleSocket(_messages(*payloads), chunk=7),
+                              bufsize=48)
+        for payload in payloads:
+            _, _, size = reader.unpack("<BdL")
+            self.assertEqual(reader.read(size).tobytes(), payload)
+        self.assertEqual(len(reader._buf), 48)
+
+    def test_readinto(self):
+        data = _messages(b"0123456789abcdef")
+        reader = FramedReader(TrickleSocket(data, chunk=20), bufsize=64)
+        _, _, size = reader.unpack("<BdL")
+        buf = bytearray(size)
+        reader.readinto(buf)
+        self.assertEqual(bytes(buf), b"0123456789abcdef")
+
+    def test_eof_mid_message(self):
+        data = _messages(b"complete", b"truncated")[:-4]
+        reader = FramedReader(TrickleSocket(data, chunk=5))
+        _, _, size = reader.unpack("<BdL")
+        reader.read(size)
+        _, _, size = reader.unpack("<BdL")
+        self.assertRaises(Exception, reader.read, size)
+
+        reader = FramedReader(TrickleSocket(data, chunk=5))
+        _, _, size = reader.unpack("<BdL")
+        reader.read(size)
+        _, _, size = reader.unpack("<BdL")
+        self.assertRaises(Exception, reader.readinto, bytearray(size))
+
+    def test_eof_mid_header(self):
+        reader = FramedReader(TrickleSocket(_messages(b"x")[:5]))
+        self.assertRaises(Exception, reader.unpack, "<BdL")
+
+
+class TestFramedWriter(unittest.TestCase):
+    header = struct.pack("<BdL", 0, 1., 10)
+    payload = b"0123456789"
+
+    def test_sendmsg(self):
+        sock = SendmsgSocket(nsent=1 << 20)
+        FramedWriter(sock).send(self.header, self.payload)
+        self.assertEqual(sock.sendmsg_calls, [self.header + self.payload])
+        # Everything went out: sendall only gets the empty rest.
+        self.assertEqual(b"".join(data for data, _ in sock.calls), b"")
+
+    def test_sendmsg_partial_payload(self):
+        sock = SendmsgSocket(nsent=len(self.header) + 4)
+        FramedWriter(sock).send(self.header, self.payload)
+        self.assertEqual(sock.calls, [(self.payload[4:], 0)])
+
+    def test_sendmsg_partial_header(self):
+        sock = SendmsgSocket(nsent=5)
+        FramedWriter(sock).send(self.header, self.payload)
+        self.assertEqual(sock.calls, [(self.header[5:], 0),
+                                      (self.payload, 0)])
+
+    def test_msg_more_fallback(self):
+        sock = SendallSocket()
+        FramedWriter(sock).send(self.header, self.payload)
+        self.assertEqual(sock.calls, [(self.header, network.MSG_MORE),
+                                      (self.payload, 0)])
+
+    def test_no_payload(self):
+        for sock in (SendallSocket(), SendmsgSocket(nsent=1 << 20)):
+            writer = FramedWriter(sock)
+            writer.send(self.header)
+            writer.send(self.header, b"")
+            writer.write(b"raw")
+            self.assertEqual(sock.calls, [(self.header, 0), (self.header, 0),
+                                          (b"raw", 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
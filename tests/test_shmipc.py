@@ -0,0 +1,72 @@
+import unittest
+import sys
+import time
+import Queue
+import multiprocessing as mp
+
+sys.path.append("..")
+
+from shmipc import CommandRing, SeqlockSpeeds
+
+
+def _produce(ring, n):
+    for i in xrange(n):
+        ring.put("udlr"[i % 4], float(i))
+
+
+def _write_speeds(speeds, n):
+    for i in xrange(n):
+        speeds.write(i, -i)
+
+
+class TestCommandRing(unittest.TestCase):
+    def test_put_get(self):
+        ring = CommandRing(capacity=4)
+        self.assertEqual(ring.put("u", 1.5), 1)
+        self.assertEqual(ring.put("h", 2.5), 2)
+        self.assertEqual(ring.get(), ("u", 1.5, 1))
+        self.assertEqual(ring.get(), ("h", 2.5, 2))
+
+    def test_put_nonblocking(self):
+        ring = CommandRing(capacity=2)
+        self.assertEqual(ring.put("u", 1., seq=10, block=False), 10)
+        ring.put("d", 2., block=False)
+        self.assertRaises(Queue.Full, ring.put, "h", 3., block=False)
+        self.assertEqual(ring.get(), ("u", 1., 10))
+        self.assertEqual(ring.put("h", 3., block=False), 3)
+
+    def test_get_timeout(self):
+        ring = CommandRing()
+        start = time.time()
+        self.assertRaises(Queue.Empty, ring.get, 0.05)
+        self.assertGreaterEqual(time.time() - start, 0.04)
+
+    def test_across_processes(self):
+        n = 1000
+        ring = CommandRing(capacity=8)
+        proc = mp.Process(target=_produce, args=(ring, n))
+        proc.start()
+        for i in xrange(n):
+            self.assertEqual(ring.get(timeout=5), ("udlr"[i % 4], float(i), i + 1))
+        proc.join()
+
+
+class TestSeqlockSpeeds(unittest.TestCase):
+    def test_read_write(self):
+        speeds = SeqlockSpeeds(3, 4)
+        self.assertEqual(speeds.read(), [3, 4])
+        speeds.write(-5, 6)
+        self.assertEqual(speeds.read(), [-5, 6])
+
+    def test_no_torn_reads(self):
+        speeds = SeqlockSpeeds()
+        proc = mp.Process(target=_write_speeds, args=(speeds, 20000))
+        proc.start()
+        while proc.is_alive():
+            left, right = speeds.read()
+            self.assertEqual(left, -right)
+        proc.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import sys
+import time
+import Queue
+import multiprocessing as mp
+
+sys.path.append("..")
+sys.path.append("../web")
+
+from shmipc import CommandRing
+from steering import (SteeringChannel, pack_steer, unpack_steer, unpack_ack)
+
+
+def _motor_worker(cmd_ring, acks, n):
+    """Acks commands like driving.control.control_main does."""
+    for _ in xrange(n):
+        cmd, _, seq = cmd_ring.get()
+        time.sleep(0.01) # the I2C writes
+        try:
+            acks.put(cmd, time.time(), seq=seq, block=False)
+        except Queue.Full:
+            pass
+
+
+class TestSteering(unittest.TestCase):
+    def test_message_format(self):
+        data = pack_steer("l", 7, 1234.5)
+        self.assertEqual(len(data), 13)
+        self.assertEqual(unpack_steer(data), ("l", 7, 1234.5))
+        self.assertRaises(ValueError, unpack_steer, pack_steer("x", 1, 0.))
+        self.assertRaises(ValueError, unpack_steer, data[:-1])
+
+    def test_acks_go_back_to_sender(self):
+        cmd_ring, acks = CommandRing(), CommandRing()
+        proc = mp.Process(target=_motor_worker, args=(cmd_ring, acks, 3))
+        proc.start()
+        channel = SteeringChannel(cmd_ring, acks)
+        channel.handle("a", pack_steer("u", 1, 10.))
+        channel.handle("b", pack_steer("h", 1, 20.))
+        channel.handle("a", pack_steer("r", 2, 30.))
+        got = [channel.match_ack(channel.wait_ack(timeout=1.))
+               for _ in range(3)]
+        proc.join()
+        self.assertEqual([client for client, _ in got], ["a", "b", "a"])
+        acked = [unpack_ack(data) for _, data in got]
+        self.assertEqual([(seq, ts) for seq, ts, _ in acked],
+                         [(1, 10.), (1, 20.), (2, 30.)])
+        self.assertGreaterEqual(min(ms for _, _, ms in acked), 9.)
+        self.assertIsNone(channel.wait_ack(timeout=0.01))
+
+    def test_full_ack_ring_drops_acks(self):
+        cmd_ring, acks = CommandRing(), CommandRing(capacity=2)
+        channel = SteeringChannel(cmd_ring, acks)
+        for seq in range(1, 6):
+            channel.handle("a", pack_steer("u", seq, 10. * seq))
+        # Nobody drains the acks meanwhile; the worker must not block.
+        proc = mp.Process(target=_motor_worker, args=(cmd_ring, acks, 5))
+        proc.start()
+        proc.join(5.)
+        self.assertFalse(proc.is_alive())
+
+        got = [channel.match_ack(channel.wait_ack(timeout=1.))
+               for _ in range(2)]
+        self.assertEqual([unpack_ack(data)[0] for _, data in got], [1, 2])
+        self.assertIsNone(channel.wait_ack(timeout=0.01))
+
+        channel.handle("a", pack_steer("h", 6, 60.))
+        proc = mp.Process(target=_motor_worker, args=(cmd_ring, acks, 1))
+        proc.start()
+        client, data = channel.match_ack(channel.wait_ack(timeout=1.))
+        proc.join()
+        self.assertEqual(unpack_ack(data)[:2], (6, 60.))
+        self.assertEqual(channel._pending, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import sys
+import time
+
+import numpy as np
+
+sys.path.append("../streaming")
+
+import core
+from plugins import Plugin
+
+
+class Slow(Plugin):
+    name = "test-slow"
+
+    def process(self, frame):
+        time.sleep(0.1)
+        return frame[:, :, 0]
+
+
+class Capped(Plugin):
+    name = "test-capped"
+    fps = 5
+
+    def process(self, frame):
+        return frame
+
+
+class TestStreamer(unittest.TestCase):
+    def setUp(self):
+        self.streamer = core.Streamer([Slow(), Capped()], bus_name="test-cam")
+        self.streamer.start_plugins()
+
+    def tearDown(self):
+        self.streamer.stop_plugins()
+        if self.streamer.bus is not None:
+            self.streamer.bus.close()
+
+    def test_plugins_do_not_block_capture(self):
+        frame = np.zeros((24, 32, 3), dtype=np.uint8)
+        start = time.time()
+        while time.time() - start < 1.5:
+            put_start = time.time()
+            self.streamer.put(frame)
+            self.assertLess(time.time() - put_start, 0.05)
+            time.sleep(0.02)
+
+        stats = self.streamer.stats()
+        self.assertGreater(stats["test-slow"]["frames"], 0)
+        self.assertGreater(stats["test-slow"]["dropped"], 0)
+        self.assertGreaterEqual(stats["test-slow"]["process_ms"], 90)
+        self.assertLess(stats["test-capped"]["fps"], 6)
+
+        out = core.FrameSubscriber("test-slow", timeout=1)
+        self.assertEqual(out.frame_shape, (24, 32))
+        out.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,76 +14,92 @@ import sys
 import argparse
 import tempfile
 import shutil
+import multiprocessing as mp
+
+import numpy as np
+
+
+# As in motion.MotionController.
+STEP_SIZE = 3
+MAX_SPEED = 255
+
+# (left, right) steps for the commands that step the speeds.
+_STEPS = {"u": (1, 1), "d": (-1, -1), "l": (-1, 1), "r": (1, -1)}
 
 
 def read(filename):
+    """Returns (timestamps, commands, speeds) sorted by timestamp: the
+    timestamp strings and command characters as lists, and the speeds before
+    each command as an (n, 2) array. Lines already carrying after-speeds are
+    read the same way; those are recomputed."""
     ret = {}
     with open(filename) as fp:
         for line in fp:
-            key, cmd, lspeed, rspeed = line.strip().split(",")
+            fields = line.strip().split(",")
+            if len(fields) < 4:
+                continue
+            key, cmd, lspeed, rspeed = fields[:4]
             # For command files, there *might* be multiple commands per tick, but
             # we'll just pick the last one in the file.
-            ret[key] = (cmd, lspeed, rspeed)
-    return sorted(ret.items(), key=lambda t: t[0])
-
-
-def _clamp(x):
-    if x < -255:
-        return -255
-    if x > 255:
-        return 255
-    return x
-
-
-def _update_velocities(cmd, vels):
-    step_size = 3
-    if cmd in "udlr":
-        if cmd == "u":
-            n_steps = (1, 1)
-        elif cmd == "d":
-            n_steps = (-1, -1)
-        elif cmd == "l":
-            n_steps = (-1, 1)
-        elif cmd == "r":
-            n_steps = (1, -1)
-        for i in range(len(vels)):
-            vels[i] = _clamp(vels[i] + n_steps[i] * step_size)
-    elif cmd == "h":
-        vels[0] = vels[1] = 0
-    elif cmd == "s":
-        vels[0] = vels[1] = sum(vels) / 2
+            ret[float(key)] = (key, cmd, int(lspeed), int(rspeed))
+    rows = [ret[t] for t in sorted(ret)]
+    timestamps = [row[0] for row in rows]
+    cmds = [row[1] for row in rows]
+    speeds = np.array([row[2:] for row in rows], dtype=np.int64).reshape(-1, 2)
+    return timestamps, cmds, speeds
+
+
+def after_speeds(cmds, speeds):
+    """Apply each command in `cmds` to the (left, right) speeds before it, in
+    the (n, 2) array `speeds`, following MotionController's rules: u/d/l/r
+    step by STEP_SIZE, clamped to +-MAX_SPEED, s sets both to their mean
+    (rounded down, as Python 2 integer division does), and h/q stop. Other
+    commands leave the speeds unchanged."""
+    cmds = np.asarray(cmds)
+    after = speeds.copy()
+    for cmd, steps in _STEPS.items():
+        mask = cmds == cmd
+        after[mask] = np.clip(speeds[mask] + np.multiply(steps, STEP_SIZE),
+                              -MAX_SPEED, MAX_SPEED)
+    mask = cmds == "s"
+    after[mask] = (speeds[mask].sum(axis=1) // 2)[:, np.newaxis]
+    after[(cmds == "h") | (cmds == "q")] = 0
+    return after
 
 
 def process_file(cmdfile, outfile):
     if outfile is None:
         outfile = cmdfile
-    fd, fname = tempfile.mkstemp()
-    os.close(fd)
-    cmds = read(cmdfile)
-    velocities = [0, 0] # left, right
-    with open(fname, "wb") as out:
-        first_line = True
-        for timestamp, (cmd, lspeed, rspeed) in cmds:
-            if not first_line:
-                out.write(",{},{}\n".format(lspeed, rspeed))
-            else:
-                first_line = False
-            out.write("{},{},{},{}".format(timestamp, cmd, lspeed, rspeed))
-            _update_velocities(cmd, velocities)
-        out.write(",0,0\n") # velocity is always zero after halting.
+    timestamps, cmds, speeds = read(cmdfile)
+    after = after_speeds(cmds, speeds)
+    lines = ["{},{},{},{},{},{}\n".format(t, c, l0, r0, l1, r1)
+             for t, c, (l0, r0), (l1, r1)
+             in zip(timestamps, cmds, speeds.tolist(), after.tolist())]
+    fd, fname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)))
+    with os.fdopen(fd, "wb") as out:
+        out.write("".join(lines))
     shutil.move(fname, outfile)
 
 
-def main(cmdfile, outfile, recursive):
+def _process_in_place(cmdfile):
+    process_file(cmdfile, None)
+
+
+def main(cmdfile, outfile, recursive, jobs=None):
     if recursive:
         if not os.path.isdir(cmdfile):
             raise Exception("When --recursive is given, cmdfile "
                             "must be a directory.")
 
-        for dirpath, _, filenames in os.walk(cmdfile):
-            for filename in filenames:
-                if filename == "commands.txt":
-                    process_file(os.path.join(dirpath, filename), None)
+        cmdfiles = [os.path.join(dirpath, filename)
+                    for dirpath, _, filenames in os.walk(cmdfile)
+                    for filename in filenames if filename == "commands.txt"]
+        pool = mp.Pool(jobs)
+        try:
+            pool.map(_process_in_place, cmdfiles, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
     else:
         process_file(cmdfile, outfile)
     return 0
@@ -100,5 +116,8 @@ if __name__ == "__main__":
                         "cmdfile must be a directory. Any file called "
                         "commands.txt in any of the subdirectories is processed"
                         " in place. -o is ignored here.")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of files processed in parallel with "
+                        "--recursive. Defaults to the number of CPUs.")
     args = parser.parse_args()
-    sys.exit(main(args.cmdfile, args.output, args.recursive))
+    sys.exit(main(args.cmdfile, args.output, args.recursive, args.jobs))
@@ -19,6 +19,10 @@ try:
 except ImportError:
     import pickle as pkl
 
+import os
+import json
+import hashlib
+
 def load_mapping(infile, informat="pickle"):
     if informat == "pickle":
         with open(infile) as fp:
@@ -45,3 +49,39 @@ def write_mapping(mapping, outfile, outformat="pickle"):
     else:
         raise ValueError("Cannot handle output format {}.".format(outformat))
 
+
+def file_stats(paths):
+    """[size, modification time] of each file at `paths`."""
+    return [[os.path.getsize(path), os.path.getmtime(path)] for path in paths]
+
+
+def content_key(paths, previous=None):
+    """A dict identifying the contents of the files at `paths`: a sha1 digest
+    of them, and their sizes and modification times. If the sizes and
+    times match those in `previous`, an earlier return value, it is returned
+    without reading the files again."""
+    stats = file_stats(paths)
+    if previous is not None and previous["stats"] == stats:
+        return previous
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b""):
+                digest.update(chunk)
+    return {"stats": stats, "digest": digest.hexdigest()}
+
+
+def load_manifest(filename):
+    """The JSON manifest of an incremental build, or None if there is none."""
+    try:
+        with open(filename) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def save_manifest(manifest, filename):
+    tmpname = filename + ".tmp"
+    with open(tmpname, "w") as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.rename(tmpname, filename)
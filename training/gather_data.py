@@ -62,16 +62,35 @@ form:
 The first pair of speeds is the speeds before the user control command and
 the second pair is the speeds after the command.
 
+drives.txt records where the images came from, with one line per drive:
+
+    <drive-directory>,<first-image-number>,<image-count>
+
+train_test_split.py uses it to keep each drive's images in a single split.
+
+Drives (the numbered directories) are processed in parallel, each into a
+directory of its own under OUTPUT_DIR/.parts. The results are then merged,
+in sorted tag and drive order, into OUTPUT_DIR with global file numbers.
+
+manifest.json records the processing parameters and, for each drive, a
+digest of its files and its range of image numbers. With --incremental, an
+existing output directory built with the same parameters is updated in
+place: the images of drives that were deleted or changed are removed, and
+new or changed drives are processed and appended, numbered after the
+highest number so far. Unchanged drives keep their image numbers.
+
 """
 import re
 import cv2
 import sys
 import argparse
 import os
+import json
 import shutil
 import tarfile
+import multiprocessing as mp
 from collections import defaultdict
-from itertools import izip, chain
+from itertools import izip
 try:
     import cPickle as pkl
 except ImportError:
@@ -81,30 +100,87 @@ except ImportError:
 import numpy as np
 
 from common import (command_mapping, command_rev_mapping,
-                    command_readable_mapping)
+                    command_readable_mapping, content_key, load_manifest,
+                    save_manifest)
+
+
+MANIFEST_FILE = "manifest.json"
+DRIVE_FILES = ("video.avi", "sync.txt", "commands.txt")
 
 
 def main(input_dir, output_dir, verbose, frame_size=None,
-         grayscale=False, compress=False, augment=True):
+         grayscale=False, compress=False, augment=True, jobs=None,
+         max_offset=0.5, incremental=False):
 
     if not os.path.exists(input_dir) or not os.path.isdir(input_dir):
         print("{} does not name a directory.".format(input_dir))
         return 1
 
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-    os.makedirs(output_dir)
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    # Round trip through JSON, so that it compares equal to a loaded one.
+    params = json.loads(json.dumps({
+        "frame_size": frame_size, "grayscale": grayscale, "augment": augment,
+        "max_offset": max_offset,
+    }))
+    manifest = load_manifest(manifest_path) if incremental else None
+    if manifest is None or manifest["params"] != params:
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+        manifest = {"params": params, "drives": {}, "next_num": 0}
+
+    # Drives are recorded by their path relative to input_dir.
+    drives, keys = [], {}
+    for datadir in _list_drives(input_dir):
+        name = os.path.relpath(datadir, input_dir)
+        entry = manifest["drives"].get(name)
+        keys[name] = content_key(
+            [os.path.join(datadir, fname) for fname in DRIVE_FILES],
+            entry["content"] if entry is not None else None)
+        if entry is None or entry["content"]["digest"] != keys[name]["digest"]:
+            drives.append(datadir)
+    deleted = [name for name in manifest["drives"] if name not in keys]
+    changed = [name for name in manifest["drives"]
+               if os.path.join(input_dir, name) in drives]
+    _remove_drives(output_dir, [manifest["drives"].pop(name)
+                                for name in deleted + changed])
+    if verbose and incremental:
+        print("{} new, {} changed, {} deleted, {} unchanged drives".format(
+            len(drives) - len(changed), len(changed), len(deleted),
+            len(manifest["drives"])))
+
+    parts_dir = os.path.join(output_dir, ".parts")
+    if os.path.exists(parts_dir):
+        shutil.rmtree(parts_dir)
+    part_dirs = [os.path.join(parts_dir, str(i)) for i in range(len(drives))]
+    tasks = [(datadir, part_dir, frame_size, grayscale, augment, max_offset)
+             for datadir, part_dir in izip(drives, part_dirs)]
+
+    pool = mp.Pool(jobs)
+    try:
+        counts = pool.map(_process_drive, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    if verbose:
+        for datadir, count in izip(drives, counts):
+            print("{}: {} images".format(datadir, count))
+
+    ranges = _merge_parts(part_dirs, output_dir, manifest["next_num"])
+    if os.path.exists(parts_dir):
+        shutil.rmtree(parts_dir)
+    for datadir, (first_num, count) in izip(drives, ranges):
+        name = os.path.relpath(datadir, input_dir)
+        manifest["drives"][name] = {"content": keys[name],
+                                    "first": first_num, "count": count}
+        manifest["next_num"] = first_num + count
+    _write_drives(output_dir, input_dir, manifest)
+    save_manifest(manifest, manifest_path)
+    if verbose:
+        print("{} images from {} drives".format(
+            sum(count for _, count in ranges), len(drives)))
 
-    mappings = []
-    file_num = 0 # output image files start with 0.jpg
-    for tagname in os.listdir(input_dir):
-        if tagname.startswith("."):
-            continue
-        tagdir = os.path.join(input_dir, tagname)
-        if not os.path.isdir(tagdir):
-            continue
-        file_num = _process_tagdir(tagdir, output_dir, frame_size, grayscale,
-                                   augment=augment, file_num=file_num)
     if compress:
         _compress_dir(output_dir, output_dir+".tar.gz")
 
@@ -120,33 +196,96 @@ def _compress_dir(dirname, output_path, compression="gz"):
         tar.add(dirname, arcname=os.path.basename(dirname))
 
 
-def _process_tagdir(dirname, output_dir, frame_size, grayscale, file_num=0,
-                    augment=True):
-    """Process a single tagdir."""
-    mappings = []
-    for idx in os.listdir(dirname):
-        datadir = os.path.join(dirname, idx)
-        if not idx.isdigit() or not os.path.isdir(datadir):
+def _list_drives(input_dir):
+    """Return the drive directories (<tag>/<N>) under `input_dir`, sorted by
+    tag name and then by drive number."""
+    drives = []
+    for tagname in sorted(os.listdir(input_dir)):
+        tagdir = os.path.join(input_dir, tagname)
+        if tagname.startswith(".") or not os.path.isdir(tagdir):
             continue
-        vidfile, syncfile, cmdfile = [
-            os.path.join(datadir, fname)
-            for fname in ("video.avi", "sync.txt", "commands.txt")
-        ]
-        file_num = _process_files(
-            vidfile, syncfile, cmdfile, output_dir, frame_size, grayscale,
-            augment=augment, file_num=file_num
-        )
-    return file_num
+        for idx in sorted((idx for idx in os.listdir(tagdir) if idx.isdigit()),
+                          key=int):
+            datadir = os.path.join(tagdir, idx)
+            if os.path.isdir(datadir):
+                drives.append(datadir)
+    return drives
+
+
+def _process_drive(task):
+    """Process a single drive directory into its own output directory,
+    numbering images from 0. Returns the number of images written."""
+    datadir, part_dir, frame_size, grayscale, augment, max_offset = task
+    os.makedirs(part_dir)
+    vidfile, syncfile, cmdfile = [
+        os.path.join(datadir, fname)
+        for fname in ("video.avi", "sync.txt", "commands.txt")
+    ]
+    return _process_files(vidfile, syncfile, cmdfile, part_dir, frame_size,
+                          grayscale, augment=augment, max_offset=max_offset)
+
+
+def _merge_parts(part_dirs, output_dir, file_num=0):
+    """Move the images from each per-drive directory into `output_dir`,
+    numbering them consecutively in the order given from `file_num` on, and
+    append the speeds.txt fragments accordingly. Returns the (first number,
+    image count) of each part."""
+    ranges = []
+    with open(os.path.join(output_dir, "speeds.txt"), "ab") as out:
+        for part_dir in part_dirs:
+            first_num = file_num
+            speedfile = os.path.join(part_dir, "speeds.txt")
+            if os.path.exists(speedfile):
+                with open(speedfile) as fp:
+                    for line in fp:
+                        imfile, speeds = line.split(",", 1)
+                        outfile = "{}.jpg".format(file_num)
+                        os.rename(os.path.join(part_dir, imfile),
+                                  os.path.join(output_dir, outfile))
+                        out.write("{},{}".format(outfile, speeds))
+                        file_num += 1
+            ranges.append((first_num, file_num - first_num))
+    return ranges
+
+
+def _remove_drives(output_dir, entries):
+    """Delete the images of the drives with the given manifest entries, and
+    their lines in speeds.txt."""
+    names = set("{}.jpg".format(num) for entry in entries
+                for num in xrange(entry["first"],
+                                  entry["first"] + entry["count"]))
+    if not names:
+        return
+    for name in names:
+        try:
+            os.unlink(os.path.join(output_dir, name))
+        except OSError:
+            pass
+    speedfile = os.path.join(output_dir, "speeds.txt")
+    with open(speedfile) as fp:
+        lines = [line for line in fp if line.split(",", 1)[0] not in names]
+    with open(speedfile + ".tmp", "wb") as out:
+        out.writelines(lines)
+    os.rename(speedfile + ".tmp", speedfile)
+
+
+def _write_drives(output_dir, input_dir, manifest):
+    """Write drives.txt, listing the drives in image number order."""
+    entries = sorted(manifest["drives"].items(), key=lambda t: t[1]["first"])
+    with open(os.path.join(output_dir, "drives.txt"), "wb") as out:
+        for name, entry in entries:
+            out.write("{},{},{}\n".format(os.path.join(input_dir, name),
+                                          entry["first"], entry["count"]))
 
 
 def _process_files(video_filename, sync_filename, cmd_filename, output_dir,
-                   frame_size, grayscale, augment=True, file_num=0):
+                   frame_size, grayscale, augment=True, file_num=0,
+                   max_offset=0.5):
     """Process a single set of files datafiles. `output_dir` is populated with
     actual stuff here. Return one plus the last file number written to."""
-    sync = _read_file(sync_filename, value_mapper=lambda vs: (int(vs[0]),))
-    cmds = _read_file(cmd_filename)
-    frames = izip(weighted_iter(sync), _video_frame_iter(video_filename,
-                                                         grayscale=grayscale))
+    frame_times = _read_sync(sync_filename)
+    cmds = _read_commands(cmd_filename)
+    frames = _video_frame_iter(video_filename, grayscale=grayscale)
     speedfile = os.path.join(output_dir, "speeds.txt")
 
     def _write_data(speedfile_out, frame, lspeed, rspeed, lspeed_after,
@@ -158,7 +297,8 @@ def _process_files(video_filename, sync_filename, cmd_filename, output_dir,
         cv2.imwrite(os.path.join(output_dir, imfile), frame)
 
     with open(speedfile, "a+b") as out:
-        for dataline in _cmd_frame_iter(frames, iter(cmds)):
+        for dataline in _cmd_frame_iter(frames, frame_times, cmds,
+                                        max_offset=max_offset):
             (frame, cmd, lspeed, rspeed, lspeed_after, rspeed_after) = dataline
 
             if frame_size is not None:
@@ -193,80 +333,136 @@ def _video_frame_iter(video_filename, grayscale=False):
         yield out
 
 
-def _cmd_frame_iter(frames, cmds):
-    """Match timestamped frames and commands.
+def _cmd_frame_iter(frames, frame_times, cmds, max_offset=0.5):
+    """Match video frames and commands.
 
     Args:
-        frames: An iterator yielding (str, numpy.ndarray), or timestamped
-        video frames.
+        frames: An iterator yielding video frames (numpy.ndarray) in order.
 
-        cmds: An iterator yielding timestamped commands of the form
+        frame_times: A sorted array of the frames' timestamps, as returned by
+        `_read_sync`.
 
-            (<timestamp>, <command-char>, <lspeed-before>, <rspeed-before>,
-             <lspeed-after>, <rspeed-after>)
+        cmds: (<timestamps>, <command-chars>, <speeds>) as returned by
+        `_read_commands`.
+
+        max_offset: Commands further than this many seconds from every frame
+        are dropped.
 
     Returns:
-        An iterator yielding (numpy.array, str), for a video frame and the
-        (best-effort) matching command.
+        An iterator yielding
+
+            (<frame>, <command-char>, <lspeed-before>, <rspeed-before>,
+             <lspeed-after>, <rspeed-after>)
 
-    NOTE: Command can be None when there was no command seen for a given frame.
+        for every frame, lazily, as frames are read.
+
+    NOTE: Command is None for frames no command was matched to (see
+    `align_commands`). Their before and after speeds are both the speeds in
+    effect at the time.
     """
-    # NOTE 1: This assignment of "no command" to certain frames is incorrect,
-    # strictly speaking, since frames are classified "no command" only when
-    # the command stream for a given second has been exhausted.
-    def _next_frame(it):
-        t, x = next(it)
-        return (int(float(t)), x)
-
-    def _next_cmd(it):
-        t, c, l0, r0, l1, r1 = next(it)
-        return (int(float(t)), c, float(l0), float(r0), float(l1), float(r1))
-
-    ret = []
-    read_frame, read_cmd = True, True
-    while True:
-        if read_frame:
-            frame_time, frame = _next_frame(frames)
-        if read_cmd:
-            (cmd_time, cmd, left_speed, right_speed, left_speed_after,
-             right_speed_after)  = _next_cmd(cmds)
-
-        if cmd_time < frame_time:
-            # Drop this command
-            read_cmd, read_frame = True, False
-            continue
-        elif cmd_time > frame_time:
-            read_cmd, read_frame = False, True
-            # No command; see `NOTE 1` above.
-            yield frame, None, left_speed, right_speed, left_speed, right_speed
-        else:
-            read_frame, read_cmd = True, True
-            yield (frame, cmd, left_speed, right_speed, left_speed_after,
-                   right_speed_after)
+    cmd_times, cmd_chars, cmd_speeds = cmds
+    if not len(cmd_times):
+        return
+    last, first = align_commands(frame_times, cmd_times, max_offset)
+
+    # Speeds in effect at each frame: after the latest command up to then, or
+    # before the first command.
+    prev = np.searchsorted(cmd_times, frame_times, side="right") - 1
+    held = np.where((prev >= 0)[:, np.newaxis],
+                    cmd_speeds[np.maximum(prev, 0), 2:], cmd_speeds[0, :2])
+    speeds = np.hstack([held, held])
+    matched = last >= 0
+    speeds[matched, :2] = cmd_speeds[first[matched], :2]
+    speeds[matched, 2:] = cmd_speeds[last[matched], 2:]
+
+    for i, frame in izip(xrange(len(frame_times)), frames):
+        cmd = cmd_chars[last[i]] if matched[i] else None
+        lspeed, rspeed, lspeed_after, rspeed_after = speeds[i]
+        yield frame, cmd, lspeed, rspeed, lspeed_after, rspeed_after
+
+
+def align_commands(frame_times, cmd_times, max_offset=0.5):
+    """Match commands to frames by timestamp.
+
+    Each command is matched to the frame nearest to it in time, if that is
+    at most `max_offset` seconds away; other commands are dropped. Both
+    arguments must be sorted ascending.
+
+    Returns two arrays of command indices, indexed by frame: the last and the
+    first command matched to each frame, -1 for frames without a command.
+    """
+    nb_frames = len(frame_times)
+    last = np.full(nb_frames, -1, dtype=np.intp)
+    first = np.full(nb_frames, -1, dtype=np.intp)
+    if not nb_frames or not len(cmd_times):
+        return last, first
+
+    after = np.searchsorted(frame_times, cmd_times).clip(0, nb_frames - 1)
+    before = (after - 1).clip(0, nb_frames - 1)
+    dist_before = np.abs(cmd_times - frame_times[before])
+    dist_after = np.abs(cmd_times - frame_times[after])
+    nearest = np.where(dist_before <= dist_after, before, after)
+    ok = np.minimum(dist_before, dist_after) <= max_offset
+
+    cmd_idx = np.flatnonzero(ok)
+    frame_idx = nearest[ok] # ascending, as the commands are sorted
+    if not len(frame_idx):
+        return last, first
+    new_frame = np.r_[True, frame_idx[1:] != frame_idx[:-1]]
+    first[frame_idx[new_frame]] = cmd_idx[new_frame]
+    last_of_frame = np.r_[new_frame[1:], True]
+    last[frame_idx[last_of_frame]] = cmd_idx[last_of_frame]
+    return last, first
+
+
+def frame_timestamps(secs, counts):
+    """Timestamps for `counts[i]` frames in each second `secs[i]`, spread
+    evenly over the second."""
+    counts = np.asarray(counts, dtype=np.int64)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    offsets = np.arange(counts.sum()) - starts
+    return (np.repeat(np.asarray(secs, dtype=np.float64), counts) +
+            offsets / np.repeat(counts, counts).astype(np.float64))
+
+
+def _read_sync(filename):
+    """Read a sync file, with <second>,<frame-count> lines, into a sorted
+    array of frame timestamps. If a second appears more than once, the last
+    line for it is used."""
+    counts = {}
+    with open(filename) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            sec, count = line.split(",")
+            counts[int(float(sec))] = int(count)
+    secs = sorted(counts)
+    return frame_timestamps(secs, [counts[sec] for sec in secs])
 
-    for _, frame in frames:
-        yield frame, None, left_speed, right_speed, left_speed, right_speed
 
+def _read_commands(filename):
+    """Read a commands file, with
 
-def _read_file(filename, value_mapper=lambda x: x):
-    """Read a file with comma separated <key,val1,val2...> lines.
+        <timestamp>,<command-char>,<lspeed-before>,<rspeed-before>,<lspeed-after>,<rspeed-after>
 
-    Returns a list of (key, val1, val2..) tuples sorted by the key ascending. If
-    `value_mapper` is given, it is passed a tuple of length `num_fields-1`
-    containing the `num_fields-1` values on line.
+    lines. Returns (timestamps, command chars, speeds) sorted by timestamp,
+    the speeds being an (n, 4) array. There *might* be multiple commands per
+    timestamp, but we'll just pick the last one in the file.
     """
-    retmap = {}
+    rows = {}
     with open(filename) as fp:
         for line in fp:
-            split_line = line.strip().split(",")
-            key = split_line[0]
-            vals = tuple(split_line[1:])
-            # For command files, there *might* be multiple commands per tick, but
-            # we'll just pick the last one in the file.
-            retmap[key] = value_mapper(vals)
-
-    for key, vals in sorted(retmap.items(), key=lambda t: t[0]):
-        yield tuple(chain([key], vals))
+            line = line.strip()
+            if not line:
+                continue
+            t, c, l0, r0, l1, r1 = line.split(",")
+            rows[float(t)] = (c, (float(l0), float(r0), float(l1), float(r1)))
+    times = sorted(rows)
+    chars = [rows[t][0] for t in times]
+    speeds = np.array([rows[t][1] for t in times],
+                      dtype=np.float64).reshape(-1, 4)
+    return np.array(times, dtype=np.float64), chars, speeds
 
 
 def weighted_iter(buckets):
@@ -277,6 +473,12 @@ def weighted_iter(buckets):
             yield key
 
 
+def bucket_zip(src, buckets):
+    """Pair the items of `src` with the keys of weighted_iter(buckets), as
+    (key, item) tuples, until either runs out."""
+    return izip(weighted_iter(buckets), src)
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("input_dir", help="Input directory")
@@ -292,6 +494,16 @@ def parse_args():
                              "output directory.")
     parser.add_argument("--augment", action="store_true",
                         help="Augment training data by flipping speeds and images")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Number of drives processed in parallel. "
+                             "Defaults to the number of CPUs.")
+    parser.add_argument("--max_offset", type=float, default=0.5,
+                        help="Maximum time, in seconds, between a command "
+                             "and the frame it is matched to.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only process drives that are new or changed "
+                             "since output_dir was last built with the same "
+                             "options, and drop deleted ones.")
     args = parser.parse_args()
     return args
 
@@ -307,12 +519,16 @@ if __name__ == "__main__":
                   "both integers.")
             sys.exit(1)
         sz = (frame_w, frame_h)
-    try:
-        shutil.rmtree(args.output_dir)
-    except OSError:
-        pass
+    if not args.incremental:
+        try:
+            shutil.rmtree(args.output_dir)
+        except OSError:
+            pass
     sys.exit(main(args.input_dir, args.output_dir, args.verbose,
                   frame_size=sz,
                   grayscale=args.grayscale,
                   compress=args.compress,
-                  augment=args.augment))
+                  augment=args.augment,
+                  jobs=args.jobs,
+                  max_offset=args.max_offset,
+                  incremental=args.incremental))
@@ -0,0 +1,92 @@
+"""Prefetching, multi-process batch loading for train.DataIterator."""
+import time
+import ctypes
+import multiprocessing as mp
+
+import numpy as np
+
+
+def _worker(data_iter, frames, tasks, done):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batch_no, slot, paths = task
+        try:
+            for i, imgpath in enumerate(paths):
+                frames[slot, i] = data_iter._read_raw(imgpath)
+        except Exception as e:
+            done.put((batch_no, slot, "{}: {}".format(imgpath, e)))
+            continue
+        done.put((batch_no, slot, None))
+
+
+class PrefetchingLoader(object):
+    """Keeps up to `nb_buffers` batches of a DataIterator in flight on a
+    pool of `nb_workers` processes.
+
+    Batches are sampled in this process, per label as DataIterator does,
+    with a RandomState seeded by `seed`, and handed to the workers. The
+    workers decode and resize images into preallocated shared memory batch
+    buffers (kept as uint8; the float conversion happens when a batch is
+    yielded). Batches are yielded in the order they were sampled, so a given
+    seed always gives the same batches however the workers are scheduled.
+    `wait_time` accumulates the seconds spent waiting for a batch.
+    """
+
+    def __init__(self, data_iter, nb_workers=4, nb_buffers=None, seed=None):
+        self.data_iter = data_iter
+        self.nb_buffers = nb_buffers or 2 * nb_workers
+        self.seed = seed
+        self.wait_time = 0.
+        self.batch_len = len(data_iter.batch_labels)
+        self.frame_shape = data_iter.frame_shape()
+
+        frames_shape = (self.nb_buffers, self.batch_len) + self.frame_shape
+        self._frames = np.frombuffer(
+            mp.RawArray(ctypes.c_uint8, int(np.prod(frames_shape))),
+            np.uint8).reshape(frames_shape)
+
+        self._tasks = mp.Queue()
+        self._done = mp.Queue()
+        self._workers = [
+            mp.Process(target=_worker, args=(data_iter, self._frames,
+                                             self._tasks, self._done))
+            for _ in range(nb_workers)
+        ]
+        for proc in self._workers:
+            proc.daemon = True
+            proc.start()
+
+    def close(self):
+        for _ in self._workers:
+            self._tasks.put(None)
+        for proc in self._workers:
+            proc.join()
+
+    def iter(self):
+        rng = np.random.RandomState(self.seed)
+        free = range(self.nb_buffers)
+        ready = {}
+        speeds = {}
+        next_submit = next_yield = 0
+        while True:
+            while free:
+                paths, speeds[next_submit] = self.data_iter.sample_batch(rng)
+                self._tasks.put((next_submit, free.pop(), list(paths)))
+                next_submit += 1
+
+            start = time.time()
+            while next_yield not in ready:
+                batch_no, slot, error = self._done.get()
+                if error is not None:
+                    raise RuntimeError("Could not load batch: " + error)
+                ready[batch_no] = slot
+            self.wait_time += time.time() - start
+
+            slot = ready.pop(next_yield)
+            imgs = self._frames[slot].astype(np.float32)
+            imgs /= 255.
+            free.append(slot)
+            yield ([imgs, speeds.pop(next_yield)], self.data_iter.batch_labels)
+            next_yield += 1
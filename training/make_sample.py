@@ -1,4 +1,7 @@
 """Given a data directory, create another with a fraction of the original data.
+
+Like train_test_split.py, the new directory's speeds.txt refers to the images in
+the original one, unless --link is given.
 """
 import os
 import sys
@@ -16,10 +19,14 @@ def parse_args():
     parser.add_argument("--fraction", type=float,
                         help="fraction of data(between 0 and 1)",
                         default=0.1)
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed")
+    parser.add_argument("--link", action="store_true",
+                        help="hard link the sampled images into output_dir")
     args = parser.parse_args()
     return args
 
-def main(input_dir, output_dir, frac):
+def main(input_dir, output_dir, frac, seed=None, link=False):
     if not os.path.exists(input_dir) or not os.path.isdir(input_dir):
         print("Error: {} does not name a directory")
         return 1
@@ -42,12 +49,12 @@ def main(input_dir, output_dir, frac):
     if not n:
         return 0
 
-    choice = random.sample(range(len(names)), n)
+    choice = random.Random(seed).sample(range(len(names)), n)
     with open(os.path.join(output_dir, "speeds.txt"), "wb") as fp:
         for i in choice:
-            fp.write("{}\n".format(lines[i]))
-            shutil.copy(os.path.join(input_dir, names[i]),
-                        os.path.join(output_dir, names[i]))
+            name = train_test_split.add_image(os.path.join(input_dir, names[i]),
+                                              output_dir, link)
+            fp.write("{},{}\n".format(name, lines[i].split(",", 1)[1]))
 
     return 0
 
@@ -55,7 +62,9 @@ if __name__ == "__main__":
     args = parse_args()
     sys.exit(main(args.input_dir,
                   args.output_dir,
-                  args.fraction))
+                  args.fraction,
+                  args.seed,
+                  args.link))
 
 
 
@@ -0,0 +1,211 @@
+"""Packed training datasets.
+
+Usage:
+    python packed.py INPUT_DIR OUTPUT_DIR [--frame_size 224x224]
+
+INPUT_DIR is a directory of label sub-directories, each with images and a
+speeds.txt of <filename>,<left-speed>,<right-speed> lines (what train.py
+reads), or a directory with train/, test/ and valid/ trees of that shape.
+OUTPUT_DIR gets the same data as a packed dataset (or one per split).
+
+A packed dataset is a directory holding:
+
+    meta.json   number of samples, frame shape (channels, rows, cols) and
+                a SHA-1 digest of the three files below
+    frames.u8   every frame back to back as uint8, already resized and in
+                (channel, row, col) layout
+    speeds.npy  float32 (N, 2) left and right speeds
+    labels.npy  int8 (N,) command labels
+
+frames.u8 is written a chunk at a time and read back with np.memmap, so
+reading a batch costs a memory copy instead of a JPEG decode, a resize and
+a file open per image.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+from scipy import misc
+
+META_FILE = "meta.json"
+FRAMES_FILE = "frames.u8"
+SPEEDS_FILE = "speeds.npy"
+LABELS_FILE = "labels.npy"
+DATA_FILES = (FRAMES_FILE, SPEEDS_FILE, LABELS_FILE)
+
+
+def is_packed(dirname):
+    return os.path.exists(os.path.join(dirname, META_FILE))
+
+
+def content_digest(dirname, chunk_size=1 << 20):
+    """SHA-1 hex digest of the frames, speeds and labels files of a packed
+    dataset, as PackedWriter stores it in meta.json."""
+    digest = hashlib.sha1()
+    for name in DATA_FILES:
+        with open(os.path.join(dirname, name), "rb") as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PackedWriter(object):
+    """Writes a packed dataset one sample at a time."""
+
+    def __init__(self, dirname, frame_shape, chunk_size=1024):
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.dirname = dirname
+        self.frame_shape = tuple(frame_shape)
+        self._frames_fp = open(os.path.join(dirname, FRAMES_FILE), "wb")
+        self._chunk = np.empty((chunk_size,) + self.frame_shape, np.uint8)
+        self._nb_chunk = 0
+        self._speeds = []
+        self._labels = []
+
+    def __len__(self):
+        return len(self._labels)
+
+    def add(self, frame, speeds, label):
+        """Add a (channel, row, col) uint8 frame with its (left, right)
+        speeds and its integer label."""
+        self._chunk[self._nb_chunk] = frame
+        self._nb_chunk += 1
+        self._speeds.append(speeds)
+        self._labels.append(label)
+        if self._nb_chunk == len(self._chunk):
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        self._frames_fp.write(self._chunk[:self._nb_chunk].tostring())
+        self._nb_chunk = 0
+
+    def close(self):
+        self._flush_chunk()
+        self._frames_fp.close()
+        np.save(os.path.join(self.dirname, SPEEDS_FILE),
+                np.array(self._speeds, np.float32).reshape(-1, 2))
+        np.save(os.path.join(self.dirname, LABELS_FILE),
+                np.array(self._labels, np.int8))
+        with open(os.path.join(self.dirname, META_FILE), "wb") as fp:
+            json.dump({"nb_samples": len(self._labels),
+                       "frame_shape": list(self.frame_shape),
+                       "digest": content_digest(self.dirname)}, fp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PackedDataset(object):
+    """Read side of a packed dataset. Frames and speeds are memory mapped,
+    so opening a dataset reads next to nothing."""
+
+    def __init__(self, dirname):
+        with open(os.path.join(dirname, META_FILE)) as fp:
+            meta = json.load(fp)
+        self.nb_samples = meta["nb_samples"]
+        self.frame_shape = tuple(meta["frame_shape"])
+        self.frames = np.memmap(os.path.join(dirname, FRAMES_FILE),
+                                dtype=np.uint8, mode="r",
+                                shape=(self.nb_samples,) + self.frame_shape)
+        self.speeds = np.load(os.path.join(dirname, SPEEDS_FILE),
+                              mmap_mode="r")
+        self.labels = np.load(os.path.join(dirname, LABELS_FILE))
+        # Packs written before meta.json had a digest get theirs on open.
+        self.digest = meta.get("digest") or content_digest(dirname)
+
+    def __len__(self):
+        return self.nb_samples
+
+    def view(self, start, stop):
+        """(frames, speeds, labels) for samples [start, stop), as views
+        into the mapped files."""
+        return (self.frames[start:stop], self.speeds[start:stop],
+                self.labels[start:stop])
+
+    def take(self, indices, out=None):
+        """Gather the frames at `indices` into `out` (allocated if None).
+        Sorted indices read the file sequentially."""
+        if out is None:
+            out = np.empty((len(indices),) + self.frame_shape, np.uint8)
+        np.take(self.frames, indices, axis=0, out=out)
+        return out
+
+
+def read_frame(imgpath, frame_size_hw=None):
+    """Read an image the way train.DataIterator does, as a (channel, row,
+    col) uint8 array."""
+    img = misc.imread(imgpath, mode="RGB")
+    if frame_size_hw is not None:
+        img = misc.imresize(img, frame_size_hw)
+    return np.rollaxis(img, 2, 0)
+
+
+def pack_labeldirs(input_dir, output_dir, frame_size_hw=None):
+    """Pack a directory of label sub-directories. Returns the sample count."""
+    writer = None
+    labels = sorted((entry for entry in os.listdir(input_dir)
+                     if entry.isdigit()), key=int)
+    for label in labels:
+        labeldir = os.path.join(input_dir, label)
+        with open(os.path.join(labeldir, "speeds.txt")) as fp:
+            for line in fp:
+                fname, lspeed, rspeed = line.strip().split(",")
+                frame = read_frame(os.path.join(labeldir, fname),
+                                   frame_size_hw)
+                if writer is None:
+                    writer = PackedWriter(output_dir, frame.shape)
+                writer.add(frame, (float(lspeed), float(rspeed)), int(label))
+    if writer is None:
+        return 0
+    writer.close()
+    return len(writer)
+
+
+def main(input_dir, output_dir, frame_size_hw):
+    if not os.path.isdir(input_dir):
+        print("{} does not name a directory.".format(input_dir))
+        return 1
+
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+
+    splits = [split for split in ("train", "test", "valid")
+              if os.path.isdir(os.path.join(input_dir, split))]
+    if not splits:
+        print("{}: {} samples".format(
+              output_dir, pack_labeldirs(input_dir, output_dir, frame_size_hw)))
+        return 0
+    for split in splits:
+        outdir = os.path.join(output_dir, split)
+        print("{}: {} samples".format(outdir, pack_labeldirs(
+              os.path.join(input_dir, split), outdir, frame_size_hw)))
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_dir", help="Input directory")
+    parser.add_argument("output_dir", help="Output directory")
+    parser.add_argument("--frame_size", type=str, default="224x224",
+                        help="Stored frame size, WxH.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        frame_w, frame_h = map(int, args.frame_size.split("x"))
+    except ValueError:
+        print("--frame_size must be of the form 'MxN', where M, N are "
+              "both integers.")
+        sys.exit(1)
+    sys.exit(main(args.input_dir, args.output_dir, (frame_h, frame_w)))
@@ -5,66 +5,145 @@ import os
 import sys
 import argparse
 import shutil
+import multiprocessing as mp
+
+import numpy as np
 
 from scipy.stats import mode
 from matplotlib import pyplot as plt
 
-from common import command_readable_mapping
+from common import (command_readable_mapping, content_key, load_manifest,
+                    save_manifest)
+
+MANIFEST_FILE = "manifest.json"
 
 def _imshow(name, img):
     cv2.namedWindow(name, cv2.WINDOW_NORMAL)
     cv2.imshow(name, img)
 
-def _process(im):
+class EdgeMasker(object):
+    """Blanks out everything but the neighbourhood of strong edges in an
+    image. The intermediate images are kept in scratch buffers that are
+    reused as long as the image size stays the same."""
+
     kern = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 7))
     kern_small = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
 
-    gr = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
-    bl = cv2.GaussianBlur(gr, (11, 11), 0.)
-    eq = cv2.equalizeHist(bl)
-    edges = cv2.Canny(eq, 70, 210)
-    edges = cv2.dilate(edges, kern)
-    edges = cv2.erode(edges, kern_small)
-    out = im[:]
-    out[edges==0] = 0
+    def __init__(self):
+        self._shape = None
+
+    def _allocate(self, shape):
+        gray_shape = shape[:2]
+        self.gr, self.bl, self.eq, self.canny, self.dilated, self.edges = [
+            np.empty(gray_shape, dtype=np.uint8) for _ in range(6)
+        ]
+        self.out = np.empty(shape, dtype=np.uint8)
+        self.flipped = np.empty(shape, dtype=np.uint8)
+        self._shape = shape
+
+    def process(self, im):
+        """Returns the intermediate and output images, as views of the scratch
+        buffers: they are only valid until the next call."""
+        if im.shape != self._shape:
+            self._allocate(im.shape)
+        cv2.cvtColor(im, cv2.COLOR_BGR2GRAY, dst=self.gr)
+        cv2.GaussianBlur(self.gr, (11, 11), 0., dst=self.bl)
+        cv2.equalizeHist(self.bl, dst=self.eq)
+        cv2.Canny(self.eq, 70, 210, edges=self.canny)
+        cv2.dilate(self.canny, self.kern, dst=self.dilated)
+        cv2.erode(self.dilated, self.kern_small, dst=self.edges)
+        self.out.fill(0)
+        cv2.bitwise_and(im, im, dst=self.out, mask=self.edges)
+        return dict(grayscale=self.gr, blurred=self.bl, equalized=self.eq,
+                    edges=self.edges, out=self.out)
+
+    def flip(self):
+        """The last output, flipped left <=> right."""
+        return cv2.flip(self.out, 1, dst=self.flipped)
+
 
-    return dict(grayscale=gr, blurred=bl, equalized=eq, edges=edges, out=out)
+_masker = None
 
+def _process_file(task):
+    """Edge mask one image and write it, and its mirror image if
+    `flip_path` is given. Runs in the worker processes."""
+    global _masker
+    if _masker is None:
+        _masker = EdgeMasker()
+    path, output_path, flip_path = task
+    _masker.process(cv2.imread(path))
+    cv2.imwrite(output_path, _masker.out)
+    if flip_path is not None:
+        cv2.imwrite(flip_path, _masker.flip())
 
-def main(input_dir, output_dir, interactive, augment):
+
+def main(input_dir, output_dir, interactive, augment, jobs=None,
+         incremental=False):
+    """With `incremental`, an output directory built earlier with the same
+    `augment` is updated: only images that are new or changed since, by the
+    digests in its manifest.json, are processed, and the outputs of images
+    that are gone are removed."""
     if not os.path.exists(input_dir) or not os.path.isdir(input_dir):
         print("{} does not name a directory".format(input_dir))
         return 1
 
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-    os.makedirs(output_dir)
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    params = {"augment": augment}
+    manifest = load_manifest(manifest_path) if incremental else None
+    if manifest is None or manifest["params"] != params:
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+        manifest = {"params": params, "labels": {}}
 
     labels = [entry for entry in os.listdir(input_dir)
               if os.path.isdir(os.path.join(input_dir, entry)) and
                  not entry.startswith(".")]
 
+    if interactive:
+        for label in labels:
+            _show_labeldir(os.path.join(input_dir, label))
+        return 0
+
+    # Splitting by drive needs to know where the images came from.
+    drives_file = os.path.join(input_dir, "drives.txt")
+    if os.path.exists(drives_file):
+        shutil.copy(drives_file, os.path.join(output_dir, "drives.txt"))
+
+    for label in set(manifest["labels"]) - set(labels):
+        shutil.rmtree(os.path.join(output_dir, label), ignore_errors=True)
+        del manifest["labels"][label]
+
+    augment_labels = augmented_labels() if augment else ()
+    tasks = []
     for label in labels:
-        os.makedirs(os.path.join(output_dir, label))
-        _process_labeldir(input_dir, output_dir, interactive, label)
+        tasks.extend(_labeldir_tasks(os.path.join(input_dir, label),
+                                     os.path.join(output_dir, label),
+                                     label in augment_labels,
+                                     manifest["labels"].setdefault(label, {})))
 
-    if augment:
-        augment_data(output_dir)
+    pool = mp.Pool(jobs)
+    try:
+        for _ in pool.imap_unordered(_process_file, tasks, chunksize=16):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+    save_manifest(manifest, manifest_path)
+    return 0
 
 
-def augment_data(dirname):
-    right_label = command_readable_mapping.index("RIGHT")
-    for label_readable in ("LEFT", "RIGHT"):
-        label = command_readable_mapping.index(label_readable)
-        path = os.path.join(dirname, str(label))
-        augment_dir(path)
+def augmented_labels():
+    """Labels whose images are also used flipped left <=> right."""
+    return [str(command_readable_mapping.index(label_readable))
+            for label_readable in ("LEFT", "RIGHT")]
 
 
-def next_writable_filenum(dirname, extns):
+def next_writable_filenum(filenames, extns):
+    """One more than the highest number among <number>.<extn> `filenames`."""
     regex = re.compile(r'^(\d+)\.(?:' + r'|'.join(extns) + r')$')
-    names = os.listdir(dirname)
     max_num = 0
-    for name in names:
+    for name in filenames:
         m = regex.match(name)
         if m is None:
             continue
@@ -73,49 +152,99 @@ def next_writable_filenum(dirname, extns):
     return max_num + 1
 
 
-def augment_dir(dirname):
-    n = next_writable_filenum(dirname, ["jpeg", "jpg", "png"])
-    speedfile = os.path.join(dirname, "speeds.txt")
+def _image_files(label_indir):
+    return [filename for filename in sorted(os.listdir(label_indir))
+            if not filename.startswith(".") and filename != "speeds.txt" and
+               not os.path.isdir(os.path.join(label_indir, filename))]
+
+
+def _labeldir_tasks(label_indir, label_outdir, augment, entries):
+    """Write the speeds file of `label_outdir` and return the _process_file
+    tasks for the images in `label_indir` that need processing.
+
+    With `augment`, the images are also flipped. Flipped images are numbered
+    after the existing ones, in speeds file order, and their speeds, left and
+    right swapped, are added to the speeds file.
+
+    `entries` is the manifest of the label directory, mapping image names to
+    their content key and flipped image name. It is updated in place. Images
+    whose key is unchanged and whose outputs exist are not processed again;
+    the outputs of images no longer in `label_indir` are deleted.
+    """
+    if not os.path.exists(label_outdir):
+        os.makedirs(label_outdir)
+    filenames = _image_files(label_indir)
+
+    def _remove(name):
+        try:
+            os.unlink(os.path.join(label_outdir, name))
+        except OSError:
+            pass
+
+    for filename in set(entries) - set(filenames):
+        entry = entries.pop(filename)
+        _remove(filename)
+        if entry["flip"] is not None:
+            _remove(entry["flip"])
+
+    speedfile = os.path.join(label_indir, "speeds.txt")
     speedlines = []
+    if os.path.exists(speedfile):
+        with open(speedfile, "rb") as fp:
+            speedlines = [line.strip().split(",") for line in fp
+                          if line.strip()]
 
-    with open(speedfile, "rb") as fp:
-        for line in fp:
-            filename, left_speed, right_speed = line.strip().split(",")
-            im = cv2.imread(os.path.join(dirname, filename))
-            outname = "{}.jpeg".format(n)
-            n += 1
-            outfile = os.path.join(dirname, outname)
-            cv2.imwrite(outfile, cv2.flip(im, 1))
-            speedlines.append([outname, right_speed, left_speed])
-
-    with open(speedfile, "a+b") as fp:
+    flip_names = {}
+    if augment:
+        n = next_writable_filenum(
+            filenames + [entry["flip"] for entry in entries.values()
+                         if entry["flip"] is not None],
+            ["jpeg", "jpg", "png"])
+        for filename, _, _ in speedlines:
+            entry = entries.get(filename)
+            if entry is not None and entry["flip"] is not None:
+                flip_names[filename] = entry["flip"]
+            else:
+                flip_names[filename] = "{}.jpeg".format(n)
+                n += 1
+
+    with open(os.path.join(label_outdir, "speeds.txt"), "wb") as fp:
         for line in speedlines:
             fp.write("{}\n".format(",".join(line)))
+        for filename, left_speed, right_speed in (speedlines if augment else ()):
+            fp.write("{}\n".format(",".join([flip_names[filename],
+                                             right_speed, left_speed])))
 
-
-def _process_labeldir(input_dir, output_dir, interactive, label):
-    label_outdir = os.path.join(output_dir, label)
-    label_indir = os.path.join(input_dir, label)
-
-    for filename in os.listdir(label_indir):
+    tasks = []
+    for filename in filenames:
         path = os.path.join(label_indir, filename)
-        if filename.startswith(".") or os.path.isdir(path):
-            continue
-
         output_path = os.path.join(label_outdir, filename)
-        if filename == "speeds.txt":
-            shutil.copy(path, output_path)
+        flip = flip_names.get(filename)
+        old = entries.get(filename)
+        key = content_key([path], old["content"] if old is not None else None)
+        if old is not None and old["flip"] is not None and old["flip"] != flip:
+            _remove(old["flip"])
+        entries[filename] = {"content": key, "flip": flip}
+        flip_path = os.path.join(label_outdir, flip) if flip else None
+        if (old is not None and old["content"]["digest"] == key["digest"] and
+                os.path.exists(output_path) and
+                (flip_path is None or os.path.exists(flip_path))):
             continue
+        tasks.append((path, output_path, flip_path))
+    return tasks
+
 
-        im = cv2.imread(path)
-        processed = _process(im)
-        if interactive:
-            for name, image in processed.items():
-                _imshow(name, image)
-            if cv2.waitKey(0) & 0xff == ord("q"):
-                break
-        else:
-            cv2.imwrite(output_path, processed["out"])
+def _show_labeldir(label_indir):
+    """Show the processing steps for each image in turn, until the user
+    presses q."""
+    masker = EdgeMasker()
+    for filename in _image_files(label_indir):
+        processed = masker.process(cv2.imread(os.path.join(label_indir,
+                                                           filename)))
+        for name, image in processed.items():
+            _imshow(name, image)
+        if cv2.waitKey(0) & 0xff == ord("q"):
+            break
 
 
 def parse_args():
@@ -130,6 +259,13 @@ def parse_args():
                         help="verbose output")
     parser.add_argument("--augment", action="store_true", default=False,
                         help="augment training data by flipping right and left images")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="number of images processed in parallel. "
+                             "Defaults to the number of CPUs.")
+    parser.add_argument("--incremental", action="store_true", default=False,
+                        help="only process images that are new or changed "
+                             "since output_dir was last built, and remove "
+                             "the outputs of deleted ones")
     args = parser.parse_args()
     return args
 
@@ -137,5 +273,5 @@ def parse_args():
 if __name__ == "__main__":
     args = parse_args()
     sys.exit(main(args.input_dir, args.output_dir, args.interactive,
-                  args.augment))
+                  args.augment, args.jobs, args.incremental))
 
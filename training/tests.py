@@ -1,6 +1,19 @@
+import os
+import json
+import shutil
+import tempfile
 import unittest
 from collections import Counter
-from gather_data import weighted_iter, bucket_zip
+
+import numpy as np
+
+from gather_data import (weighted_iter, bucket_zip, align_commands,
+                         frame_timestamps, _cmd_frame_iter)
+from train import StratifiedSampler, DataIterator, PackedDataIterator
+from packed import PackedWriter, PackedDataset, META_FILE
+from backfill_velocities import after_speeds
+import train_test_split
+from train_test_split import image_groups, split_groups
 
 
 class TestGatherData(unittest.TestCase):
@@ -26,6 +39,165 @@ class TestGatherData(unittest.TestCase):
             actual = list(bucket_zip(src, buckets))
             self.assertEqual(actual, expected)
 
+    def test_frame_timestamps(self):
+        times = frame_timestamps([10, 11], [4, 2])
+        self.assertEqual(list(times), [10, 10.25, 10.5, 10.75, 11, 11.5])
+
+    def test_align_commands(self):
+        frame_times = np.array([9., 9.5, 10., 10.5, 11.])
+        # Numeric, not lexicographic order: 9.6 < 10.1.
+        cmd_times = np.array([9.6, 10.1, 10.2, 13.])
+        last, first = align_commands(frame_times, cmd_times, max_offset=0.5)
+        self.assertEqual(list(last), [-1, 0, 2, -1, -1])
+        self.assertEqual(list(first), [-1, 0, 1, -1, -1])
+
+    def test_cmd_frame_iter(self):
+        frame_times = np.array([9., 9.5, 10., 10.5])
+        cmds = (np.array([9.4, 10.6]), ["u", "l"],
+                np.array([[0, 0, 3, 3], [3, 3, 0, 6]], dtype=float))
+        actual = [line[1:] for line in
+                  _cmd_frame_iter(iter("abcd"), frame_times, cmds)]
+        self.assertEqual(actual, [(None, 0, 0, 0, 0),
+                                  ("u", 0, 0, 3, 3),
+                                  (None, 3, 3, 3, 3),
+                                  ("l", 3, 3, 0, 6)])
+
+
+class TestStratifiedSampler(unittest.TestCase):
+
+    label_indices = {1: np.arange(0, 5), 4: np.arange(5, 8)}
+    counts = {1: 2, 4: 1}
+
+    def test_counts(self):
+        sampler = StratifiedSampler(self.label_indices, self.counts)
+        self.assertEqual(list(sampler.batch_labels), [1, 1, 4])
+        for _ in range(20):
+            idx = sampler.sample()
+            self.assertTrue(np.in1d(idx[:2], self.label_indices[1]).all())
+            self.assertTrue(np.in1d(idx[2:], self.label_indices[4]).all())
+
+    def test_epochs(self):
+        sampler = StratifiedSampler(self.label_indices, self.counts,
+                                    epochs=True)
+        batches = np.array([sampler.sample() for _ in range(6)])
+        ones, fours = batches[:, :2].ravel(), batches[:, 2]
+        # Each label's samples are all used before any repeats.
+        self.assertEqual(sorted(ones[:5]), range(5))
+        self.assertEqual(sorted(ones[5:10]), range(5))
+        self.assertEqual(sorted(fours[:3]), range(5, 8))
+        self.assertEqual(sorted(fours[3:6]), range(5, 8))
+
+
+class TestBackfill(unittest.TestCase):
+
+    def test_after_speeds(self):
+        cmds = ["u", "d", "l", "r", "s", "s", "h", "x"]
+        speeds = np.array([[254, 0], [-254, 0], [10, 253], [10, 20],
+                           [3, 4], [-3, 0], [30, 40], [5, 6]])
+        expected = [[255, 3], [-255, -3], [7, 255], [13, 17],
+                    [3, 3], [-2, -2], [0, 0], [5, 6]]
+        self.assertEqual(after_speeds(cmds, speeds).tolist(), expected)
+
+
+class TestTrainTestSplit(unittest.TestCase):
+
+    def test_image_groups(self):
+        names = ["0.jpg", "199.jpg", "200.jpg", "450.jpeg", "x.jpg"]
+        by_drive = image_groups(names, np.array([0, 200, 450]))
+        self.assertEqual(len(set(by_drive[:2])), 1)
+        self.assertEqual(len(set(by_drive)), 5 - 1)
+        by_run = image_groups(names, group_size=200)
+        self.assertEqual(list(by_run[:3]), ["run:0", "run:0", "run:1"])
+
+    def test_split_groups(self):
+        groups = np.repeat(["a", "b", "c", "d", "e"], 20)
+        splits = split_groups(groups, 0.2, 0.2, np.random.RandomState(0))
+        self.assertEqual(list(np.bincount(splits)), [20, 20, 60])
+        for group in "abcde":
+            self.assertEqual(len(set(splits[groups == group])), 1)
+
+    def test_augmented_flips_follow_source(self):
+        # preprocessing.py --augment output: flips numbered after the last
+        # drive, listed in manifest.json.
+        input_dir, output_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, input_dir)
+        self.addCleanup(shutil.rmtree, output_dir)
+        os.mkdir(os.path.join(input_dir, "2"))
+        entries = {}
+        with open(os.path.join(input_dir, "2", "speeds.txt"), "w") as fp:
+            for num in range(40):
+                flip = "{}.jpeg".format(100 + num)
+                entries["{}.jpg".format(num)] = {"content": {}, "flip": flip}
+                fp.write("{}.jpg,3,6\n{},6,3\n".format(num, flip))
+        with open(os.path.join(input_dir, "manifest.json"), "w") as fp:
+            json.dump({"params": {"augment": True},
+                       "labels": {"2": entries}}, fp)
+        with open(os.path.join(input_dir, "drives.txt"), "w") as fp:
+            for i in range(4):
+                fp.write("drive{},{},10\n".format(i, 10 * i))
+
+        train_test_split.main(input_dir, output_dir, 0.25, 0.25, seed=0)
+        split_of = {}
+        for split in train_test_split.SPLITS:
+            for name, _ in train_test_split.read_speedfile(
+                    os.path.join(output_dir, split, "2", "speeds.txt")):
+                split_of[os.path.basename(name)] = split
+        self.assertEqual(len(set(split_of.values())), 3)
+        for source, entry in entries.items():
+            self.assertEqual(split_of[entry["flip"]], split_of[source])
+
+
+class TestDataIterator(unittest.TestCase):
+
+    def test_fingerprint_covers_images(self):
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        os.mkdir(os.path.join(dirname, "1"))
+        with open(os.path.join(dirname, "1", "speeds.txt"), "w") as fp:
+            for num in range(4):
+                fp.write("{}.jpg,1,1\n".format(num))
+                with open(os.path.join(dirname, "1", "{}.jpg".format(num)),
+                          "wb") as img:
+                    img.write(b"jpeg")
+        before = DataIterator(dirname, batch_size=4).fingerprint()
+        self.assertEqual(DataIterator(dirname, batch_size=4).fingerprint(),
+                         before)
+
+        path = os.path.join(dirname, "1", "2.jpg")
+        with open(path, "wb") as img:
+            img.write(b"another jpeg")
+        self.assertNotEqual(DataIterator(dirname, batch_size=4).fingerprint(),
+                            before)
+
+
+class TestPacked(unittest.TestCase):
+
+    def _pack(self, frames, labels):
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        with PackedWriter(dirname, frames.shape[1:]) as writer:
+            for frame, label in zip(frames, labels):
+                writer.add(frame, (1., 1.), label)
+        return dirname
+
+    def test_fingerprint_covers_frames(self):
+        frames = np.zeros((8, 3, 4, 4), np.uint8)
+        labels = [0, 1] * 4
+        same = PackedDataIterator(self._pack(frames, labels), batch_size=4)
+        frames[5, 0, 2, 2] = 1
+        changed = self._pack(frames, labels)
+        self.assertNotEqual(PackedDataIterator(changed).fingerprint(),
+                            same.fingerprint())
+
+        # Packs without a digest in meta.json get the same one on open.
+        meta_path = os.path.join(changed, META_FILE)
+        with open(meta_path) as fp:
+            meta = json.load(fp)
+        digest = meta.pop("digest")
+        with open(meta_path, "w") as fp:
+            json.dump(meta, fp)
+        self.assertEqual(PackedDataset(changed).digest, digest)
+
 
 if __name__ == "__main__":
     unittest.main()
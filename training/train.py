@@ -2,10 +2,13 @@ import re
 import os
 import sys
 import argparse
+import hashlib
+import time
 
 import numpy as np
 from scipy import misc
 
+from keras.callbacks import Callback
 from keras.utils import np_utils
 from keras.models import Sequential
 from keras.layers import Activation, Dense
@@ -14,25 +17,64 @@ from keras.optimizers import SGD
 from sklearn.cross_validation import train_test_split
 
 from common import (command_mapping, command_rev_mapping, load_mapping,
-                    command_readable_mapping)
+                    command_readable_mapping, file_stats)
 
 import vgg16
+from loader import PrefetchingLoader
+from packed import PackedDataset, is_packed
 
-class DataIterator(object):
-    def __init__(self, dirname, batch_size=64, resize_to=None):
-        pat = re.compile(r'^\d+\..+$')
-        label_hist = {
-            label: sum(1 for f in os.listdir(os.path.join(dirname, label)) if pat.match(f))
-            for label in os.listdir(dirname) if label.isdigit()
-        }
-        total = float(sum(label_hist.values()))
+class StratifiedSampler(object):
+    """Draws batches of indices with `counts[label]` of them taken from each
+    `label_indices[label]` array.
 
-        self.approx_counts = {
-            label: int(batch_size * count / total) for label, count in label_hist.items()
-        }
+    By default samples are drawn with replacement. With `epochs=True` each
+    label is walked through in a fresh random permutation instead, so every
+    sample is used once before any is repeated.
+    """
+
+    def __init__(self, label_indices, counts, epochs=False):
+        self.label_indices = label_indices
+        self.counts = counts
+        self.epochs = epochs
+        self.labels = sorted(label for label, count in counts.items() if count)
+        self.batch_labels = np.repeat(self.labels,
+                                      [counts[label] for label in self.labels])
+        self._perms = {}
+        self._pos = {}
+
+    def _permuted(self, label, count, rng):
+        n = len(self.label_indices[label])
+        picks = []
+        while count:
+            perm = self._perms.get(label)
+            pos = self._pos.get(label, 0)
+            if perm is None or pos == n:
+                perm = self._perms[label] = rng.permutation(n)
+                pos = 0
+            take = min(count, n - pos)
+            picks.append(perm[pos:pos + take])
+            self._pos[label] = pos + take
+            count -= take
+        return np.concatenate(picks)
+
+    def sample(self, rng=np.random):
+        """Indices for one batch, grouped by label as in `batch_labels`."""
+        out = np.empty(len(self.batch_labels), dtype=np.intp)
+        start = 0
+        for label in self.labels:
+            indices = self.label_indices[label]
+            count = self.counts[label]
+            if self.epochs:
+                picks = self._permuted(label, count, rng)
+            else:
+                picks = rng.randint(len(indices), size=count)
+            out[start:start + count] = indices[picks]
+            start += count
+        return out
 
-        self.cmd_dirs = {}
-        self.speeds = {}
+
+class DataIterator(object):
+    def __init__(self, dirname, batch_size=64, resize_to=None, epochs=False):
         self.batch_size = batch_size
         self.frame_size_hw = None
 
@@ -40,88 +82,239 @@ class DataIterator(object):
             w, h = resize_to
             self.frame_size_hw = (h, w) # scipy resize takes (nrows, ncols)
 
-        self._total_samples = 0
-
-        for entry in os.listdir(dirname):
+        # Every sample, grouped by label: image path, speeds scaled to
+        # [0, 1], and the range of each label's samples.
+        paths, speeds = [], []
+        self.label_indices = {}
+        for entry in sorted(os.listdir(dirname)):
             if not entry.isdigit():
                 continue
             cmddir = os.path.join(dirname, entry)
-            self.cmd_dirs[entry] = cmddir
-            speedfile = os.path.join(cmddir, "speeds.txt")
-            self.speeds[entry] = {}
-
-            with open(speedfile) as fp:
+            start = len(paths)
+            with open(os.path.join(cmddir, "speeds.txt")) as fp:
                 for line in fp:
                     fname, lspeed, rspeed = line.strip().split(",")
-                    self.speeds[entry][fname] = (float(lspeed)/255., float(rspeed)/255.)
-                    self._total_samples += 1
+                    paths.append(os.path.join(cmddir, fname))
+                    speeds.append((lspeed, rspeed))
+            self.label_indices[int(entry)] = np.arange(start, len(paths))
+        self.paths = np.array(paths)
+        self.speeds = np.array(speeds, dtype=np.float32).reshape(-1, 2)
+        self.speeds /= 255.
+        self._total_samples = len(paths)
 
-    def _read_img(self, imgpath):
+        total = float(self._total_samples)
+        self.approx_counts = {
+            label: int(batch_size * len(indices) / total)
+            for label, indices in self.label_indices.items()
+        }
+        self.sampler = StratifiedSampler(self.label_indices,
+                                         self.approx_counts, epochs=epochs)
+        self.batch_labels = np_utils.to_categorical(self.sampler.batch_labels,
+                                                    nb_classes=7)
+
+    def _read_raw(self, imgpath):
         img = misc.imread(imgpath, mode="RGB")
         if self.frame_size_hw is not None:
             img = misc.imresize(img, self.frame_size_hw)
-        img = np.rollaxis(img, 2, 0) # make it so that theano likes it: (channel,row,col)
-        img = np.array(img, dtype=np.float32)
+        return np.rollaxis(img, 2, 0) # make it so that theano likes it: (channel,row,col)
+
+    def _read_img(self, imgpath):
+        img = np.array(self._read_raw(imgpath), dtype=np.float32)
         img /= 255.
         return img
 
-    def _read_batch(self, mapping):
-        """Takes a list of (abs_image_path, speed_tuple) tuples."""
-        imgs = []
-        speeds = []
-        for filename, speed_tup in mapping:
-            img = self._read_img(filename)
-            imgs.append(img)
-            speeds.append(np.array(speed_tup))
-        return imgs, speeds
+    def frame_shape(self):
+        """(channel, row, col) shape of the images this iterator yields."""
+        if not len(self.paths):
+            raise ValueError("No images to read.")
+        return self._read_raw(self.paths[0]).shape
+
+    def _read_batch(self, paths):
+        return np.array([self._read_img(path) for path in paths])
+
+    def frames(self, idx):
+        return self._read_batch(self.paths[idx])
+
+    def batch_speeds(self, idx):
+        return self.speeds[idx]
+
+    def fingerprint(self):
+        """Identifies the samples and their ids, for feature caches. Images
+        rewritten under the same names change it through their sizes and
+        modification times, as in common.content_key."""
+        digest = hashlib.sha1(str(self.frame_size_hw))
+        digest.update("\n".join(self.paths))
+        digest.update(str(file_stats(self.paths)))
+        return digest.hexdigest()
+
+    def sample_batch(self, rng=np.random):
+        """Image paths and speeds of the samples for one batch, labelled as
+        in `batch_labels`."""
+        idx = self.sampler.sample(rng)
+        return self.paths[idx], self.speeds[idx]
 
     def iter(self):
         while True:
-            imgs, speeds, labels = [], [], []
-            for cmdcode, count in self.approx_counts.items():
-                if not count:
-                    continue
-                cmddir = self.cmd_dirs[cmdcode]
-                cmdspeeds = self.speeds[cmdcode]
-                # List of (image_path, (left_speed, right_speed))
-                fnames = np.random.choice(cmdspeeds.keys(), size=count)
-                fname_speeds = [(os.path.join(cmddir, f), cmdspeeds[f])
-                                for f in fnames]
-                _imgs, _speeds = self._read_batch(fname_speeds)
-                imgs.extend(_imgs)
-                speeds.extend(_speeds)
-                labels.extend([cmdcode] * count)
-            out_imgs = np.array(imgs)
-            yield ([out_imgs, np.vstack(speeds)],
-                   np_utils.to_categorical(labels, nb_classes=7))
-
-def main(input_dir, nb_epoch):
+            paths, speeds = self.sample_batch()
+            yield ([self._read_batch(paths), speeds], self.batch_labels)
+
+class PackedDataIterator(object):
+    """DataIterator over a packed dataset (see packed.py), with the same
+    per-label batch composition. Frames are already at their final size."""
+
+    def __init__(self, dirname, batch_size=64, epochs=False):
+        self.dataset = PackedDataset(dirname)
+        self.batch_size = batch_size
+        labels = self.dataset.labels
+        self.label_indices = {
+            label: np.flatnonzero(labels == label) for label in np.unique(labels)
+        }
+        total = float(len(labels))
+        self.approx_counts = {
+            label: int(batch_size * len(indices) / total)
+            for label, indices in self.label_indices.items()
+        }
+        self.sampler = StratifiedSampler(self.label_indices,
+                                         self.approx_counts, epochs=epochs)
+        self._total_samples = len(self.dataset)
+
+    def frames(self, idx):
+        imgs = self.dataset.take(idx).astype(np.float32)
+        imgs /= 255.
+        return imgs
+
+    def batch_speeds(self, idx):
+        return self.dataset.speeds[idx] / 255.
+
+    def fingerprint(self):
+        """Identifies the samples and their ids, for feature caches."""
+        digest = hashlib.sha1(str(self.dataset.frames.shape))
+        digest.update(self.dataset.digest)
+        return digest.hexdigest()
+
+    def iter(self):
+        return feature_batches(self)
+
+
+def feature_batches(it, features=None):
+    """Batches sampled like `it` does. If `features` is given, its rows
+    for each sample id are yielded in place of the images."""
+    batch_labels = it.sampler.batch_labels
+    while True:
+        idx = it.sampler.sample()
+        order = np.argsort(idx)
+        idx = idx[order]
+        feats = it.frames(idx) if features is None else features[idx]
+        yield ([feats, it.batch_speeds(idx)],
+               np_utils.to_categorical(batch_labels[order], nb_classes=7))
+
+
+class ThroughputLogger(Callback):
+    """Prints training samples/s after every epoch and, given a
+    PrefetchingLoader, the share of the epoch spent waiting for batches:
+    if that is high, the loader rather than the model is the bottleneck."""
+
+    def __init__(self, loader=None):
+        super(ThroughputLogger, self).__init__()
+        self.loader = loader
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = time.time()
+        self._samples = 0
+        if self.loader is not None:
+            self._wait_start = self.loader.wait_time
+
+    def on_batch_end(self, batch, logs=None):
+        self._samples += (logs or {}).get("size", 0)
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = time.time() - self._start
+        msg = "Epoch {}: {:.1f} samples/s".format(epoch + 1,
+                                                  self._samples / elapsed)
+        if self.loader is not None:
+            waited = self.loader.wait_time - self._wait_start
+            msg += ", waited {:.1f}s ({:.0f}%) for batches".format(
+                waited, 100. * waited / elapsed)
+        print(msg)
+
+
+def make_iterator(dirname, resize_to=(224, 224), epochs=False):
+    """A PackedDataIterator if `dirname` is packed, else a DataIterator."""
+    if is_packed(dirname):
+        return PackedDataIterator(dirname, epochs=epochs)
+    return DataIterator(dirname, resize_to=resize_to, epochs=epochs)
+
+
+def make_batches(it, nb_workers, seed=None):
+    """Returns (batch generator, loader). The loader is None unless batches
+    are read by PrefetchingLoader workers."""
+    if nb_workers and isinstance(it, DataIterator):
+        loader = PrefetchingLoader(it, nb_workers=nb_workers, seed=seed)
+        return loader.iter(), loader
+    if seed is not None:
+        np.random.seed(seed)
+    return it.iter(), None
+
+
+def main(input_dir, nb_epoch, nb_workers=4, seed=None, epochs=False,
+         cache_dir=None):
     train_dir, test_dir, val_dir = [os.path.join(input_dir, split)
                                     for split in ("train", "test", "valid")]
 
-    it = DataIterator(train_dir, resize_to=(224,224))
+    it = make_iterator(train_dir, epochs=epochs)
     batch_size = it.batch_size
     tsamples = int(it._total_samples / batch_size)
-    batches = it.iter()
-    val_it = DataIterator(val_dir, resize_to=(224,224))
+    val_it = make_iterator(val_dir, epochs=epochs)
     vsamples = int(val_it._total_samples / batch_size)
-    val_batches = val_it.iter()
 
     model = vgg16.Vgg16()
     model.finetune(nb_class=7)
+
+    if cache_dir is not None:
+        # The trunk is frozen: run it once per sample, train the head only.
+        features = model.cached_features(it, os.path.join(cache_dir, "train"))
+        val_features = model.cached_features(
+            val_it, os.path.join(cache_dir, "valid"))
+        if seed is not None:
+            np.random.seed(seed)
+        model.fit_features(feature_batches(it, features),
+                           feature_batches(val_it, val_features),
+                           it._total_samples, val_it._total_samples,
+                           nb_epoch=nb_epoch, callbacks=[ThroughputLogger()])
+        return
+
+    batches, loader = make_batches(it, nb_workers, seed)
+    val_batches, _ = make_batches(val_it, nb_workers,
+                                  None if seed is None else seed + 1)
     model.fit(batches, val_batches, batch_size,
-              it._total_samples, val_it._total_samples, nb_epoch=nb_epoch)
+              it._total_samples, val_it._total_samples, nb_epoch=nb_epoch,
+              callbacks=[ThroughputLogger(loader)])
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("input_dir",
                         help="Input directory, with a structure identical to "
-                             "that of the output of gather_data.py")
+                             "that of the output of gather_data.py, or packed "
+                             "train/ test/ valid/ datasets made by packed.py")
     parser.add_argument("--epochs", type=int, default=1,
                         help="Number of training epochs")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Batch loading processes. 0 loads batches "
+                             "synchronously in the training loop.")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed for batch sampling.")
+    parser.add_argument("--sampling", choices=("replace", "epoch"),
+                        default="replace",
+                        help="Draw samples with replacement, or go through "
+                             "each label in a random permutation.")
+    parser.add_argument("--cache_features", default=None, metavar="DIR",
+                        help="Compute the frozen VGG16 layers' output once "
+                             "per sample, cache it in DIR and train only "
+                             "the top layers on it.")
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
-    sys.exit(main(args.input_dir, args.epochs))
+    sys.exit(main(args.input_dir, args.epochs, args.workers, args.seed,
+                  args.sampling == "epoch", args.cache_features))
 
@@ -1,14 +1,30 @@
 """Given a data directory, with data organized in label folders, produces
 three directory trees, each identical to the input directory tree in structure.
-The three trees are called train/, test/ and valid/"""
+The three trees are called train/, test/ and valid/
+
+The images are not copied: each label folder of the output only has a
+speeds.txt, naming its images by their path relative to the folder, which
+train.DataIterator reads directly. With --link, the images are hard linked (or,
+across filesystems, copied) into the output folders instead.
+
+Images are split in groups, so that the near identical frames of one drive do
+not end up in different splits. If the input directory has the drives.txt
+written by gather_data.py, or --drives names one, each drive is a group.
+Otherwise, groups are runs of --group_size consecutively numbered images.
+Images flipped by preprocessing.py --augment are numbered after all the
+others; the manifest.json it writes maps them back to their source image, and
+they go in its group."""
 from __future__ import print_function
 import os
+import re
 import shutil
 import sys
 import argparse
 
 import numpy as np
 
+from common import load_manifest
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("input_dir", help="input directory")
@@ -24,6 +40,21 @@ def parse_args():
                              "between 0 and 1.",
                         default=0.1)
 
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed for the split.")
+
+    parser.add_argument("--link", action="store_true",
+                        help="hard link images into the output instead of "
+                             "referring to them from speeds.txt.")
+
+    parser.add_argument("--drives", default=None,
+                        help="drives.txt written by gather_data.py. Defaults "
+                             "to input_dir/drives.txt, if there is one.")
+
+    parser.add_argument("--group_size", type=int, default=500,
+                        help="without drives.txt, images are split in runs "
+                             "of this many consecutive numbers.")
+
     args = parser.parse_args()
     return args
 
@@ -34,7 +65,8 @@ def labelnames(input_dir):
     return labelnames
 
 
-def main(input_dir, output_dir, test_fraction, valid_fraction):
+def main(input_dir, output_dir, test_fraction, valid_fraction, seed=None,
+         link=False, drives_file=None, group_size=500):
     if not os.path.exists(input_dir):
         print("Input directory {} does not exist.".format(input_dir))
         return 1
@@ -43,62 +75,144 @@ def main(input_dir, output_dir, test_fraction, valid_fraction):
         print("test_fraction and valid_fraction must sum to at most 1.0")
         return 1
 
-    prepare_output_dir(input_dir, output_dir)
-
+    # (label, image name, rest of the speeds line) for every image.
+    entries = []
     for labelname in labelnames(input_dir):
-        if _process_label(input_dir, output_dir, labelname, test_fraction,
-                          valid_fraction):
+        speedfile_path = os.path.join(input_dir, labelname, "speeds.txt")
+        if not os.path.exists(speedfile_path):
+            print("speedfile {} does not exist, quitting.".format(speedfile_path))
             return 1
+        entries.extend((labelname, imgfile, rest)
+                       for imgfile, rest in read_speedfile(speedfile_path))
+
+    if drives_file is None:
+        drives_file = os.path.join(input_dir, "drives.txt")
+        if not os.path.exists(drives_file):
+            drives_file = None
+    drive_starts = read_drives(drives_file) if drives_file else None
+
+    flip_sources = read_flip_sources(os.path.join(input_dir, "manifest.json"))
+    groups = image_groups([flip_sources.get((label, imgfile), imgfile)
+                           for label, imgfile, _ in entries],
+                          drive_starts, group_size)
+    splits = split_groups(groups, test_fraction, valid_fraction,
+                          np.random.RandomState(seed))
 
-def read_speedfile(filename):
-    def _mapper(line):
-        imgfile, lspeed, rspeed = line.strip().split(",")
-        return imgfile, lspeed, rspeed
-    with open(filename) as fp:
-        lines = [_mapper(line) for line in fp]
-    np.random.shuffle(lines)
-    return lines
+    prepare_output_dir(input_dir, output_dir)
+    for i, split in enumerate(SPLITS):
+        write_speedfiles(input_dir, os.path.join(output_dir, split),
+                         [entries[j] for j in np.flatnonzero(splits == i)],
+                         link)
 
-def _process_label(input_dir, output_dir, label, test_fraction, valid_fraction):
-    speedfile_path = os.path.join(input_dir, label, "speeds.txt")
+SPLITS = ("test", "valid", "train")
 
-    if not os.path.exists(speedfile_path):
-        print("speedfile {} does not exist, quitting.".format(speedfile_path))
-        return 1
+def read_speedfile(filename):
+    """List of (image file, rest of the line) tuples."""
+    with open(filename) as fp:
+        return [tuple(line.strip().split(",", 1)) for line in fp
+                if line.strip()]
 
-    speeds = read_speedfile(speedfile_path) # this can be used like dictionary file
-
-    nb_test = int(test_fraction * len(speeds))
-    nb_valid = int(valid_fraction * len(speeds))
-    for split, start, end in (("test", 0, nb_test),
-                              ("valid", nb_test, nb_test+nb_valid),
-                              ("train", nb_test+nb_valid, None)):
-        speedinfos = speeds[start:end]
-        split_outdir = os.path.join(output_dir, split, label)
-        out_speeds = open(os.path.join(split_outdir, "speeds.txt"), "wb")
-        try:
-            for imgfile, lspeed, rspeed in speedinfos:
-                in_imgpath = os.path.join(input_dir, label, imgfile)
-                out_imgpath = os.path.join(split_outdir, imgfile)
-                shutil.copy(in_imgpath, out_imgpath)
-                out_speeds.write("{}\n".format(",".join([imgfile, lspeed, rspeed])))
-        finally:
-            out_speeds.close()
+def read_drives(filename):
+    """Sorted array of the first image number of each drive in a drives.txt
+    file."""
+    with open(filename) as fp:
+        starts = [int(line.rsplit(",", 2)[1]) for line in fp if line.strip()]
+    return np.sort(np.array(starts, dtype=np.int64))
+
+def read_flip_sources(filename):
+    """{(label, flipped image): source image} from the manifest.json of a
+    preprocessing.py output directory; empty if there is none."""
+    manifest = load_manifest(filename)
+    if manifest is None:
+        return {}
+    return {(label, entry["flip"]): source
+            for label, entries in manifest.get("labels", {}).items()
+            for source, entry in entries.items()
+            if entry.get("flip") is not None}
+
+def image_groups(imgfiles, drive_starts=None, group_size=500):
+    """A group key for each <number>.<extension> image file name: the drive
+    its number falls in, given the drives' first numbers, or else the
+    number's run of `group_size`. Other names are groups of their own."""
+    keys = []
+    for imgfile in imgfiles:
+        m = re.match(r'^(\d+)\.', imgfile)
+        if m is None:
+            keys.append("file:" + imgfile)
+            continue
+        num = int(m.group(1))
+        if drive_starts is not None:
+            group = np.searchsorted(drive_starts, num, side="right") - 1
+            keys.append("drive:{}".format(group))
+        else:
+            keys.append("run:{}".format(num // group_size))
+    return np.array(keys)
+
+def split_groups(groups, test_fraction, valid_fraction, rng=np.random):
+    """Assign whole groups to SPLITS: returns the split index of each sample.
+
+    The groups are shuffled, then go to test until it has `test_fraction` of
+    the samples, then to valid until it has `valid_fraction`, then to train.
+    """
+    if not len(groups):
+        return np.zeros(0, dtype=np.intp)
+    uniq, inverse = np.unique(groups, return_inverse=True)
+    counts = np.bincount(inverse)
+    order = rng.permutation(len(uniq))
+    # Fraction of the samples in the groups before each one.
+    before = (np.cumsum(counts[order]) - counts[order]) / float(len(groups))
+    split_of_pos = np.where(before < test_fraction, 0,
+                            np.where(before < test_fraction + valid_fraction,
+                                     1, 2))
+    split_of_group = np.empty(len(uniq), dtype=np.intp)
+    split_of_group[order] = split_of_pos
+    return split_of_group[inverse]
+
+def add_image(in_imgpath, outdir, link):
+    """Make the image at `in_imgpath` part of directory `outdir`. Returns the
+    name to list it under in `outdir`'s speeds.txt: its path relative to
+    `outdir`, or with `link`, the name of a hard link (or copy) made there."""
+    if not link:
+        return os.path.relpath(in_imgpath, outdir)
+    imgfile = os.path.basename(in_imgpath)
+    out_imgpath = os.path.join(outdir, imgfile)
+    try:
+        os.link(in_imgpath, out_imgpath)
+    except OSError:
+        shutil.copy(in_imgpath, out_imgpath)
+    return imgfile
+
+def write_speedfiles(input_dir, split_dir, entries, link):
+    outfiles = {}
+    try:
+        for label, imgfile, rest in entries:
+            split_outdir = os.path.join(split_dir, label)
+            if label not in outfiles:
+                outfiles[label] = open(os.path.join(split_outdir, "speeds.txt"), "wb")
+            name = add_image(os.path.join(input_dir, label, imgfile),
+                             split_outdir, link)
+            outfiles[label].write("{},{}\n".format(name, rest))
+    finally:
+        for fp in outfiles.values():
+            fp.close()
 
 def prepare_output_dir(input_dir, output_dir):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     labels = labelnames(input_dir)
-    for d in ("train", "test", "valid"):
+    for d in SPLITS:
         dirname = os.path.join(output_dir, d)
         if os.path.exists(dirname):
             shutil.rmtree(dirname)
         os.makedirs(dirname)
         for labelname in labels:
             os.makedirs(os.path.join(dirname, labelname))
+            # Labels with no images in this split still get a speeds file.
+            open(os.path.join(dirname, labelname, "speeds.txt"), "wb").close()
 
 if __name__ == "__main__":
     args = parse_args()
     sys.exit(main(args.input_dir, args.output_dir, args.test_fraction,
-                  args.valid_fraction))
+                  args.valid_fraction, args.seed, args.link, args.drives,
+                  args.group_size))
@@ -1,6 +1,6 @@
 from __future__ import division, print_function
 
-import os, json
+import os, json, hashlib
 from glob import glob
 import numpy as np
 from scipy import misc, ndimage
@@ -24,6 +24,50 @@ def vgg_preprocess(x):
     return x[:, ::-1] # reverse axis rgb->bgr
 
 
+class FeatureCache(object):
+    """On-disk (nb_samples, dim) array of features, row i holding the
+    features of sample id i.
+
+    `key` identifies what the features were computed from (model weights,
+    input size, samples). An existing cache with a different key, size or
+    dim is discarded. Rows are marked done as they are stored, so an
+    interrupted run only computes what is missing.
+    """
+
+    def __init__(self, dirname, nb_samples, dim, key):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        meta_path = os.path.join(dirname, "meta.json")
+        meta = {"key": key, "nb_samples": nb_samples, "dim": dim}
+        try:
+            with open(meta_path) as f:
+                valid = json.load(f) == meta
+        except (IOError, ValueError):
+            valid = False
+
+        mode = "r+" if valid else "w+"
+        self.features = np.lib.format.open_memmap(
+            os.path.join(dirname, "features.npy"), mode=mode,
+            dtype=np.float32, shape=(nb_samples, dim))
+        self.done = np.lib.format.open_memmap(
+            os.path.join(dirname, "done.npy"), mode=mode,
+            dtype=np.bool_, shape=(nb_samples,))
+        if not valid:
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+
+    def missing(self):
+        return np.flatnonzero(~self.done)
+
+    def store(self, idx, features):
+        self.features[idx] = features
+        self.done[idx] = True
+
+    def flush(self):
+        self.features.flush()
+        self.done.flush()
+
+
 class Vgg16():
     """The VGG 16 Imagenet model"""
 
@@ -99,32 +143,83 @@ class Vgg16():
         model.pop()
         for layer in model.layers: layer.trainable=False
 
+        self.trunk = model
+        self.nb_class = nb_class
+        self.speed_branch, self.classifier, self.model = self.head(model)
+        self.compile()
+
+
+    def head(self, features):
+        """The trainable part of the fine-tuned model, on top of `features`.
+        Returns (speed branch, classifier layer, model)."""
         speed_branch = Sequential()
         speed_branch.add(Dense(3, input_dim=2, activation="relu", init="uniform"))
 
-        merged = Merge([model, speed_branch], mode="concat")
+        merged = Merge([features, speed_branch], mode="concat")
 
+        classifier = Dense(self.nb_class, activation='softmax')
         final_model = Sequential()
         final_model.add(merged)
-        final_model.add(Dense(nb_class, activation='softmax'))
+        final_model.add(classifier)
+        return speed_branch, classifier, final_model
 
-        self.model = final_model
-        self.compile()
 
-
-    def compile(self, lr=0.001):
-        self.model.compile(optimizer=Adam(lr=lr),
+    def compile(self, lr=0.001, model=None):
+        model = model or self.model
+        model.compile(optimizer=Adam(lr=lr),
                 loss='categorical_crossentropy', metrics=['accuracy'])
 
 
+    def trunk_key(self):
+        """Identifies the frozen trunk by its input shape and weights."""
+        digest = hashlib.sha1(str(self.trunk.input_shape))
+        for w in self.trunk.get_weights():
+            digest.update(np.ascontiguousarray(w).data)
+        return digest.hexdigest()
+
+
+    def cached_features(self, it, cache_dir, batch_size=64):
+        """Frozen trunk output for every sample of `it`, as an array indexed
+        by sample id. Only samples missing from the cache in `cache_dir` are
+        run through the trunk."""
+        cache = FeatureCache(cache_dir, it._total_samples,
+                             self.trunk.output_shape[1],
+                             self.trunk_key() + it.fingerprint())
+        missing = cache.missing()
+        for start in range(0, len(missing), batch_size):
+            idx = missing[start:start+batch_size]
+            cache.store(idx, self.trunk.predict(it.frames(idx), batch_size=batch_size))
+        cache.flush()
+        return cache.features
+
+
     def fit_data(self, trn, labels,  val, val_labels,  nb_epoch=1, batch_size=64):
         self.model.fit(trn, labels, nb_epoch=nb_epoch,
                 validation_data=(val, val_labels), batch_size=batch_size)
 
 
-    def fit(self, batches, val_batches, batch_size, nb_train_samples, nb_val_samples, nb_epoch=1):
+    def fit(self, batches, val_batches, batch_size, nb_train_samples, nb_val_samples, nb_epoch=1,
+            callbacks=None):
         self.model.fit_generator(batches, samples_per_epoch=nb_train_samples, nb_epoch=nb_epoch,
-                validation_data=val_batches, nb_val_samples=nb_val_samples)
+                validation_data=val_batches, nb_val_samples=nb_val_samples,
+                callbacks=callbacks)
+
+    def fit_features(self, batches, val_batches, nb_train_samples, nb_val_samples, nb_epoch=1,
+                     callbacks=None):
+        """Like fit, but `batches` carry trunk features (see
+        cached_features) in place of images. A copy of the head is trained
+        on them and its weights are then copied into the full model. The
+        trunk's last Dropout layer is applied to the features; dropout
+        inside the trunk is not."""
+        features = Sequential()
+        features.add(Dropout(0.5, input_shape=self.trunk.output_shape[1:]))
+        speed_branch, classifier, head = self.head(features)
+        self.compile(model=head)
+        head.fit_generator(batches, samples_per_epoch=nb_train_samples, nb_epoch=nb_epoch,
+                validation_data=val_batches, nb_val_samples=nb_val_samples,
+                callbacks=callbacks)
+        self.speed_branch.set_weights(speed_branch.get_weights())
+        self.classifier.set_weights(classifier.get_weights())
 
     def test(self, path, batch_size=8):
         test_batches = self.get_batches(path, shuffle=False, batch_size=batch_size, class_mode=None)
@@ -13,14 +13,24 @@ from flask import (
 from flask_socketio import SocketIO, send, emit
 
 sys.path.append("..")
+sys.path.append("../driving")
 
 import streaming
 import streaming_plugins
-from motion import MotionController
+from control import Driver
 from video import VideoWriter
 import cam
+from steering import SteeringChannel
+
+# The motor worker is forked before eventlet patches this process, so that it
+# keeps real threads, and its blocking I2C writes hold up nothing here.
+driver = Driver()
+driver.start_drive_mode(acks=True)
+atexit.register(driver.quit)
+steering = SteeringChannel(driver.q, driver.acks)
 
 import eventlet
+from eventlet import tpool
 eventlet.monkey_patch()
 
 app = Flask(__name__)
@@ -32,11 +42,8 @@ app.config.update(dict(
     PASSWORD="default",
 ))
 
-motionctl = MotionController()
-
 def start_preview_process():
-    streamer = streaming.Streamer(plugins=streaming_plugins.plugins,
-                                  output_root="/home/pi/aveta/stream")
+    streamer = streaming.Streamer(plugins=streaming_plugins.plugins)
     proc = mp.Process(target=streamer.run)
     def shutdown():
         pid = proc.pid()
@@ -63,17 +70,13 @@ def home():
     return render_template("index.html")
 
 
-def video_stream():
-    while True:
-        with open("../stream/simple.jpeg", "rb") as fp:
-            data = fp.read()
-        yield(b'--frame\r\nContent-Type: image/jpeg\r\n\n' + data + b'\r\n\n')
+# Encodes each camera frame once for all the viewers of /videofeed.
+video_hub = streaming.MJPEGHub("simple")
 
 
 @app.route("/videofeed")
 def video_feed():
-    return Response(video_stream(),
-                    mimetype="multipart/x-mixed-replace;boundary=frame")
+    return Response(video_hub.frames(), mimetype=streaming.MJPEG_MIMETYPE)
 
 socketio = SocketIO(app)
 
@@ -89,19 +92,23 @@ def handle_json(json_msg):
 
 @socketio.on("steer")
 def handle_steer(data):
-    print("Received args: data={}".format(data))
-    cmd = data["cmd"]
-    if cmd == "left":
-        motionctl.turn_left()
-    elif cmd == "right":
-        motionctl.turn_right()
-    elif cmd == "up":
-        motionctl.speed_ahead()
-    elif cmd == "down":
-        motionctl.speed_back()
-    elif cmd == "stop":
-        motionctl.stop()
-        
+    """Binary STEER messages; see steering.py."""
+    try:
+        steering.handle(request.sid, data)
+    except ValueError as e:
+        print("Bad steering message: {}".format(e))
+
+
+def send_steer_acks():
+    while True:
+        record = tpool.execute(steering.wait_ack, 1.)
+        ack = steering.match_ack(record) if record is not None else None
+        if ack is not None:
+            client, data = ack
+            socketio.emit("steer_ack", bytearray(data), room=client)
+
+# Started along with the Driver, however the app is run.
+eventlet.spawn(send_steer_acks)
 
 
 if __name__ == "__main__":
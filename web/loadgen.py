@@ -0,0 +1,200 @@
+"""Simulated viewer load test for the MJPEG video feed.
+
+Opens `--viewers` connections to the feed and reads frames off each for
+`--duration` seconds; `--slow` of them only read a frame every `--slow_delay`
+seconds. Prints the frames each kind of viewer got, and the frames they
+skipped or got twice, going by the X-Sequence header of each part.
+
+Without --url, the feed is served in-process from an MJPEGHub, on a frame bus
+fed with synthetic `--fps` frames per second, and the number of JPEG encodes
+and the CPU time used are printed as well.
+
+    python loadgen.py --viewers 50 --slow 10
+    python loadgen.py --url http://raspberrypi:5000/videofeed --viewers 20
+
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import socket
+import urlparse
+import argparse
+import tempfile
+import threading
+import SocketServer
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+from os.path import dirname, abspath
+
+import numpy as np
+
+AVETA_DIR = dirname(dirname(abspath(__file__)))
+
+sys.path.append(os.path.join(AVETA_DIR, "streaming"))
+from framebus import FramePublisher
+from mjpeg import MJPEGHub, MIMETYPE
+
+
+class _ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # Loopback send buffers grow to megabytes, seconds of video, that the
+        # kernel would queue for a slow viewer. Keep them to what a slow link
+        # would hold, so that frames are skipped by the hub instead.
+        conn, addr = WSGIServer.get_request(self)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+        return conn, addr
+
+    def handle_error(self, request, client_address):
+        pass # viewers hanging up
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def get_stderr(self):
+        return open(os.devnull, "w")
+
+
+def serve_hub(hub):
+    """Serve `hub` over HTTP on a free local port. Returns the feed URL."""
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", MIMETYPE)])
+        return hub.frames()
+    server = make_server("127.0.0.1", 0, app,
+                         server_class=_ThreadingWSGIServer,
+                         handler_class=_QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return "http://127.0.0.1:{}/".format(server.server_port)
+
+
+def publish_frames(publisher, fps, stop):
+    """Publish noise frames at `fps` until `stop` is set."""
+    frames = [np.random.randint(0, 256, publisher.frame_shape).astype(np.uint8)
+              for _ in range(4)]
+    next_time = time.time()
+    while not stop.is_set():
+        publisher.publish(frames[publisher.seq % len(frames)])
+        next_time += 1. / fps
+        time.sleep(max(0, next_time - time.time()))
+
+
+def viewer(url, duration, delay, result):
+    """Read the feed at `url` for `duration` seconds, sleeping `delay`
+    seconds after each frame. Appends the sequence numbers seen to
+    `result`."""
+    parts = urlparse.urlparse(url)
+    sock = socket.socket()
+    if delay:
+        # Like a slow link: keep the kernel from buffering many frames for us.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+    sock.connect((parts.hostname, parts.port or 80))
+    sock.sendall("GET {} HTTP/1.0\r\nHost: {}\r\n\r\n".format(
+                 parts.path or "/", parts.netloc))
+    fp = sock.makefile("rb")
+    end = time.time() + duration
+    try:
+        while fp.readline().strip(): # response headers
+            pass
+        while time.time() < end:
+            headers = {}
+            line = fp.readline()
+            if not line:
+                break
+            while line.strip():
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                line = fp.readline()
+            if "content-length" not in headers:
+                continue # the boundary line
+            fp.read(int(headers["content-length"]))
+            result.append(int(headers.get("x-sequence", -1)))
+            if delay:
+                time.sleep(delay)
+    finally:
+        fp.close()
+        sock.close()
+
+
+def summarize(name, results, duration):
+    if not results:
+        return
+    counts = np.array([len(seqs) for seqs in results])
+    repeated = sum(len(seqs) - len(set(seqs)) for seqs in results)
+    skipped = sum(max(seqs) - min(seqs) + 1 - len(set(seqs))
+                  for seqs in results if seqs)
+    print("{} {} viewers: {:.1f} fps each (min {:.1f}), "
+          "{} frames skipped, {} repeated".format(
+              len(results), name, counts.mean() / duration,
+              counts.min() / duration, skipped, repeated))
+
+
+def main(url, nb_viewers, nb_slow, slow_delay, duration, fps, shape):
+    hub = stop = root = None
+    if url is None:
+        root = tempfile.mkdtemp()
+        publisher = FramePublisher("loadgen", shape, root=root)
+        stop = threading.Event()
+        threading.Thread(target=publish_frames,
+                         args=(publisher, fps, stop)).start()
+        hub = MJPEGHub("loadgen", root=root)
+        url = serve_hub(hub)
+
+    results = [[] for _ in range(nb_viewers)]
+    threads = [threading.Thread(target=viewer,
+                                args=(url, duration,
+                                      slow_delay if i < nb_slow else 0,
+                                      results[i]))
+               for i in range(nb_viewers)]
+    cpu_start, start = os.times(), time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    cpu = sum(os.times()[:2]) - sum(cpu_start[:2])
+
+    summarize("slow", results[:nb_slow], elapsed)
+    summarize("full speed", results[nb_slow:], elapsed)
+    if hub is not None:
+        print("{} frames published, {} encoded; {:.2f}s CPU for {:.1f}s "
+              "(includes the viewers)".format(publisher.seq, hub.nb_encoded,
+                                              cpu, elapsed))
+        stop.set()
+        hub.stop()
+        publisher.close()
+        shutil.rmtree(root)
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=None,
+                        help="Feed URL, e.g. http://host:5000/videofeed. "
+                             "Serves a synthetic feed in-process if omitted.")
+    parser.add_argument("--viewers", type=int, default=20,
+                        help="Number of simultaneous viewers.")
+    parser.add_argument("--slow", type=int, default=5,
+                        help="How many of the viewers are slow.")
+    parser.add_argument("--slow_delay", type=float, default=0.2,
+                        help="Seconds a slow viewer waits after each frame.")
+    parser.add_argument("--duration", type=float, default=5.,
+                        help="Seconds each viewer watches for.")
+    parser.add_argument("--fps", type=float, default=30.,
+                        help="Frame rate of the synthetic feed.")
+    parser.add_argument("--size", default="320x240",
+                        help="WIDTHxHEIGHT of the synthetic frames.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    width, height = map(int, args.size.split("x"))
+    sys.exit(main(args.url, args.viewers, args.slow, args.slow_delay,
+                  args.duration, args.fps, (height, width, 3)))
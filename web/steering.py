@@ -0,0 +1,94 @@
+"""Binary steering messages between the web UI and the motor worker.
+
+The browser sends a STEER message per key press, with a sequence number and
+its own clock's timestamp in milliseconds, and gets an ACK back once the
+command has been applied to the motors. The ACK echoes the sequence number
+and timestamp, so the browser measures the round trip on its own clock, and
+adds the time the server took from receiving the command to the motors.
+
+    STEER: command character, seq (uint32), client timestamp (float64 ms)
+    ACK:   seq (uint32), client timestamp (float64 ms),
+           receive to motor time (float64 ms)
+
+All little endian.
+"""
+import time
+import Queue
+import struct
+
+STEER_FORMAT = "<cId"
+ACK_FORMAT = "<Idd"
+
+# Commands of driving.control.control_main the web UI may send.
+COMMANDS = "udlrsh"
+
+
+def pack_steer(cmd, seq, client_time):
+    return struct.pack(STEER_FORMAT, cmd, seq, client_time)
+
+
+def unpack_steer(data):
+    """(cmd, seq, client timestamp) of a STEER message. Raises ValueError if
+    it is not one."""
+    try:
+        cmd, seq, client_time = struct.unpack(STEER_FORMAT, bytes(data))
+    except struct.error as e:
+        raise ValueError(str(e))
+    if cmd not in COMMANDS:
+        raise ValueError("unknown command {!r}".format(cmd))
+    return cmd, seq, client_time
+
+
+def pack_ack(seq, client_time, motor_ms):
+    return struct.pack(ACK_FORMAT, seq, client_time, motor_ms)
+
+
+def unpack_ack(data):
+    return struct.unpack(ACK_FORMAT, bytes(data))
+
+
+class SteeringChannel(object):
+    """Hands STEER messages to the motor worker, and matches up its acks.
+
+    `cmd_ring` and `acks` are the command and ack shmipc.CommandRings of a
+    driving.control.Driver started with acks. Messages from all clients go
+    on the one command ring; the acks come back in the same order and with
+    the same seqs, which is how they are matched to the client and message
+    they are for. The motor worker drops acks when the ack ring is full, so
+    commands older than an ack that arrives never get one.
+    """
+
+    def __init__(self, cmd_ring, acks):
+        self.cmd_ring = cmd_ring
+        self.acks = acks
+        self._pending = {} # ring seq: (client, seq, client time, received)
+
+    def handle(self, client, data):
+        """Queue the command of STEER message `data` from `client`."""
+        received = time.time()
+        cmd, seq, client_time = unpack_steer(data)
+        ring_seq = self.cmd_ring.put(cmd, received)
+        self._pending[ring_seq] = (client, seq, client_time, received)
+
+    def wait_ack(self, timeout=None):
+        """Wait up to `timeout` seconds (forever if None) for the motor worker
+        to apply a command. Returns its ack record, or None. This only
+        touches the ack ring, so it may block in another thread."""
+        try:
+            return self.acks.get(timeout)
+        except Queue.Empty:
+            return None
+
+    def match_ack(self, record):
+        """The client an ack record of wait_ack() is for, and the ACK message
+        to send it; None if it is not for a STEER message. Call from the
+        thread that calls handle()."""
+        _, applied, ring_seq = record
+        pending = self._pending.pop(ring_seq, None)
+        for seq in [seq for seq in self._pending if seq < ring_seq]:
+            del self._pending[seq] # its ack was dropped
+        if pending is None:
+            return None
+        client, seq, client_time, received = pending
+        return client, pack_ack(seq, client_time,
+                                1000. * (applied - received))